@@ -1,9 +1,15 @@
+import json
+import sys
+import time
+
+import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
 import paste.script
 
 from ckanext.mapactionimporter.plugin import (
-    create_product_themes
+    create_product_themes,
+    register_translator,
 )
 
 
@@ -12,7 +18,18 @@ class MapactionImporterCommand(toolkit.CkanCommand):
     ckanext-mapactionimporter management commands
 
     Usage::
-        paster mapactionimporter create_product_themes
+        paster mapactionimporter create_product_themes [--dry-run]
+            Bring the product_themes vocabulary up to date
+        paster mapactionimporter worker [--once] [--poll-interval=SECONDS]
+            Run map package imports queued in the background
+        paster mapactionimporter import <dir|glob>... [--processes=N]
+                [--user=NAME] [--owner-org=ORG]
+            Import every map package found, oldest version of each map first
+        paster mapactionimporter benchmark [--iterations=N] [--members=N]
+                [--member-size=BYTES] [--xml-size=BYTES] [--themes=N]
+                [--countries=N] [--stage=STAGE]... [--output=FILE]
+            Time imports of synthetic map packages against a stubbed
+            action layer, writing the results as JSON
 
     """
     summary = __doc__.split('\n')[0]
@@ -22,6 +39,42 @@ class MapactionImporterCommand(toolkit.CkanCommand):
     parser.add_option('-c', '--config', dest='config',
                       default='development.ini',
                       help='Config file to use.')
+    parser.add_option('--dry-run', dest='dry_run', action='store_true',
+                      default=False,
+                      help='Report vocabulary changes without making them.')
+    parser.add_option('--once', dest='once', action='store_true',
+                      default=False,
+                      help='Exit once there are no more queued imports.')
+    parser.add_option('--poll-interval', dest='poll_interval', type='int',
+                      default=5,
+                      help='Seconds to wait between checks for new imports.')
+    parser.add_option('--processes', dest='processes', type='int',
+                      default=1,
+                      help='Number of packages to import at the same time.')
+    parser.add_option('--user', dest='user', default=None,
+                      help='User to import as (default: the site user).')
+    parser.add_option('--owner-org', dest='owner_org', default=None,
+                      help='Organization to own the imported datasets.')
+    parser.add_option('--iterations', dest='iterations', type='int',
+                      default=10,
+                      help='Number of packages to time for each stage.')
+    parser.add_option('--members', dest='members', type='int', default=2,
+                      help='Number of files in each generated package.')
+    parser.add_option('--member-size', dest='member_size', type='int',
+                      default=2 ** 20,
+                      help='Size in bytes of each generated file.')
+    parser.add_option('--xml-size', dest='xml_size', type='int', default=0,
+                      help='Bytes of padding to add to the metadata XML.')
+    parser.add_option('--themes', dest='themes', type='int', default=1,
+                      help='Number of themes in the metadata.')
+    parser.add_option('--countries', dest='countries', type='int',
+                      default=1,
+                      help='Number of countries in the metadata.')
+    parser.add_option('--stage', dest='stages', action='append',
+                      default=None,
+                      help='Stage to time, may be repeated (default: all).')
+    parser.add_option('--output', dest='output', default=None,
+                      help='File to write the results to (default: stdout).')
 
     def command(self):
         cmd = None
@@ -31,6 +84,118 @@ class MapactionImporterCommand(toolkit.CkanCommand):
         self._load_config()
 
         if cmd == 'create_product_themes':
-            create_product_themes()
+            self._create_product_themes()
+        elif cmd == 'worker':
+            self._worker()
+        elif cmd == 'import':
+            self._import(self.args[1:])
+        elif cmd == 'benchmark':
+            self._benchmark()
         else:
             print self.__doc__
+
+    def _create_product_themes(self):
+        report = create_product_themes(dry_run=self.options.dry_run)
+
+        if self.options.dry_run:
+            print 'Dry run, no changes made'
+        if report['created']:
+            print 'Create vocabulary {0}'.format(report['vocabulary'])
+        for tag in report['added']:
+            print 'Add {0}'.format(tag)
+        for tag in report['removed']:
+            print 'Remove {0}'.format(tag)
+        if not (report['created'] or report['added'] or report['removed']):
+            print 'Vocabulary {0} is up to date'.format(report['vocabulary'])
+
+    def _worker(self):
+        from ckanext.mapactionimporter.lib.jobs import job_store_from_config
+        from ckanext.mapactionimporter.logic.action.create import (
+            run_import_job
+        )
+
+        register_translator()
+        store = job_store_from_config(toolkit.config)
+
+        while True:
+            job = store.claim_next()
+            if job is None:
+                if self.options.once:
+                    return
+                time.sleep(self.options.poll_interval)
+                continue
+
+            print 'Importing job {0} for {1}'.format(job['id'], job['user'])
+            job = run_import_job(store, job)
+            print 'Job {0}: {1}'.format(job['id'], job['status'])
+
+            # Start each job with a clean session
+            model.Session.remove()
+
+    def _import(self, patterns):
+        from ckanext.mapactionimporter.lib import bulk
+
+        register_translator()
+
+        paths = bulk.find_packages(patterns)
+        if not paths:
+            print 'No map packages found'
+            return
+
+        user = self.options.user
+        if user is None:
+            user = toolkit.get_action('get_site_user')(
+                {'ignore_auth': True}, {})['name']
+
+        data_dict = {}
+        if self.options.owner_org:
+            data_dict['owner_org'] = self.options.owner_org
+
+        groups = bulk.plan_imports(paths)
+        print 'Importing {0} packages for {1} maps with {2} processes'.format(
+            len(paths), len(groups), self.options.processes)
+
+        start = time.time()
+        results = []
+        for result in bulk.run_imports(groups, user,
+                                       processes=self.options.processes,
+                                       data_dict=data_dict):
+            results.append(result)
+            print '{0:<7} {1:>7.2f}s  {2}  {3}'.format(
+                'OK' if result.succeeded else 'FAILED',
+                result.seconds,
+                result.path,
+                result.name if result.succeeded else result.error)
+        elapsed = max(time.time() - start, 0.001)
+
+        succeeded = [r for r in results if r.succeeded]
+        megabytes = sum(r.size for r in results) / float(2 ** 20)
+        print
+        print '{0} imported, {1} failed in {2:.1f}s'.format(
+            len(succeeded), len(results) - len(succeeded), elapsed)
+        print '{0:.2f} packages/s, {1:.2f} MB/s'.format(
+            len(results) / elapsed, megabytes / elapsed)
+
+    def _benchmark(self):
+        from ckanext.mapactionimporter.lib import benchmark
+
+        register_translator()
+
+        spec = benchmark.PackageSpec(
+            members=self.options.members,
+            member_size=self.options.member_size,
+            xml_size=self.options.xml_size,
+            themes=self.options.themes,
+            countries=self.options.countries,
+        )
+        results = benchmark.run_benchmark(
+            spec,
+            iterations=self.options.iterations,
+            stages=self.options.stages or benchmark.STAGES)
+
+        if self.options.output:
+            with open(self.options.output, 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        else:
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            print
@@ -1,6 +1,12 @@
+import json
+
+import paste.fileapp
+
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.mapactionimporter.lib import profiling, staging
+
 
 class ZipImportController(toolkit.BaseController):
     def new(self, data=None, errors=None, error_summary=None):
@@ -41,6 +47,9 @@ class ZipImportController(toolkit.BaseController):
                     context,
                     params,
                 )
+            if 'job_id' in dataset:
+                toolkit.redirect_to('import_mapactionzip_job',
+                                    id=dataset['job_id'])
             toolkit.redirect_to(controller='package',
                                 action='edit',
                                 id=dataset['name'])
@@ -51,6 +60,142 @@ class ZipImportController(toolkit.BaseController):
                             errors=errors,
                             error_summary=error_summary)
 
+    def job(self, id):
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': toolkit.c.user,
+        }
+
+        try:
+            job = toolkit.get_action('mapaction_import_job_status')(
+                context, {'id': id})
+        except toolkit.ObjectNotFound:
+            toolkit.abort(404, toolkit._('Import job not found'))
+        except toolkit.NotAuthorized:
+            toolkit.abort(401,
+                toolkit._('Unauthorized to see this import job'))
+
+        if job['status'] == 'complete':
+            toolkit.redirect_to(controller='package',
+                                action='edit',
+                                id=job['result']['name'])
+
+        return toolkit.render(
+            'mapactionimporter/import_job.html',
+            extra_vars={'job': job}
+        )
+
+    def upload_start(self):
+        """
+        Start a chunked upload. Takes the package's total ``size`` (if
+        known) and ``filename``, and returns the upload session as JSON.
+        """
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': toolkit.c.user,
+        }
+        self._authorize_or_abort(context)
+
+        params = toolkit.request.params
+        try:
+            size = int(params['size']) if params.get('size') else None
+        except ValueError:
+            toolkit.abort(400, toolkit._('Size must be a number of bytes'))
+
+        store = staging.staging_store_from_config(toolkit.config)
+        try:
+            session = store.start(toolkit.c.user, size=size,
+                                  filename=params.get('filename'))
+        except staging.UploadTooLarge as e:
+            toolkit.abort(413, toolkit._(e.args[0]))
+
+        toolkit.response.status_int = 201
+        return self._json(session)
+
+    def upload_status(self, id):
+        """ How much of the upload has arrived, to know where to resume """
+        return self._json(self._get_upload_or_abort(id))
+
+    def upload_chunk(self, id):
+        """
+        Append the request body to the upload. The Content-Range header
+        says where the chunk goes and must start where the upload has got
+        to; if it doesn't, 409 is returned with the session so the client
+        can resume from the right place. A chunk that isn't as long as its
+        range says gets a 400 and is discarded.
+        """
+        self._get_upload_or_abort(id)
+
+        try:
+            first, last, total = staging.parse_content_range(
+                toolkit.request.headers.get('Content-Range'))
+        except ValueError:
+            toolkit.abort(400, toolkit._('Invalid Content-Range header'))
+
+        store = staging.staging_store_from_config(toolkit.config)
+        try:
+            session = store.append(id, first, last,
+                                   toolkit.request.body_file, total=total)
+        except staging.UploadRangeError as e:
+            toolkit.response.status_int = 409
+            return self._json(e.session)
+        except staging.InvalidChunk as e:
+            toolkit.abort(400, toolkit._(e.args[0]))
+        except staging.UploadTooLarge as e:
+            toolkit.abort(413, toolkit._(e.args[0]))
+
+        return self._json(session)
+
+    def _get_upload_or_abort(self, id):
+        store = staging.staging_store_from_config(toolkit.config)
+        try:
+            session = store.get(id)
+        except staging.UploadNotFound:
+            session = None
+
+        if session is None or session['user'] != toolkit.c.user:
+            toolkit.abort(404, toolkit._('Upload not found'))
+
+        return session
+
+    def _json(self, data):
+        toolkit.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(data)
+
+    def profile(self, id):
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': toolkit.c.user,
+        }
+
+        try:
+            record = toolkit.get_action('mapaction_import_profile_show')(
+                context, {'id': id})
+        except toolkit.ObjectNotFound:
+            toolkit.abort(404, toolkit._('Import profile not found'))
+        except toolkit.NotAuthorized:
+            toolkit.abort(401,
+                toolkit._('Unauthorized to see import profiles'))
+
+        # As the package controller serves uploaded resources
+        store = profiling.profile_store_from_config(toolkit.config)
+        fileapp = paste.fileapp.FileApp(store.stats_path(record['id']))
+        try:
+            status, headers, app_iter = toolkit.request.call_application(
+                fileapp)
+        except OSError:
+            toolkit.abort(404, toolkit._('Import profile not found'))
+
+        toolkit.response.headers.update(dict(headers))
+        toolkit.response.headers['Content-Type'] = 'application/octet-stream'
+        toolkit.response.headers['Content-Disposition'] = \
+            'attachment; filename="{0}.prof"'.format(record['id'])
+        toolkit.response.status = status
+        return app_iter
+
     def _authorize_or_abort(self, context):
         try:
             toolkit.check_access('package_create', context)
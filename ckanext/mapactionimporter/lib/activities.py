@@ -0,0 +1,120 @@
+import contextlib
+import threading
+
+import ckan.lib.activity_streams_session_extension as activity_extension
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+# Names of the packages the current thread isn't recording activities for
+_local = threading.local()
+
+# How many threads are in a suppressed() block, and CKAN's own
+# activity_stream_item, put back once none are
+_install_lock = threading.Lock()
+_install_count = 0
+_original_activity_stream_item = None
+
+
+@contextlib.contextmanager
+def suppressed(package_name, enabled=True):
+    """
+    Don't record activities for the named package for anything this thread
+    commits in the block, so that a multi-step import can record one
+    activity for the lot. Other packages changed along the way, such as the
+    other versions of a map, have theirs recorded as usual. Does nothing
+    unless enabled.
+    """
+    if not enabled:
+        yield
+        return
+
+    if getattr(_local, 'package_names', None) is None:
+        _local.package_names = []
+
+    _install()
+    _local.package_names.append(package_name)
+    try:
+        yield
+    finally:
+        _local.package_names.remove(package_name)
+        _uninstall()
+
+
+def import_summary(dataset_info, dataset):
+    """ What an import did, for the one activity it records """
+    dataset_dict = dataset_info['dataset_dict']
+    map_number = _extra(dataset_dict, 'mapNumber') or dataset['name']
+    resources = len(dataset.get('resources', []))
+
+    summary = {
+        'summary': 'Imported {0} v{1} with {2} resource{3}'.format(
+            map_number, dataset_dict.get('version'), resources,
+            '' if resources == 1 else 's'),
+        'map_number': map_number,
+        'version': dataset_dict.get('version'),
+        'status': dataset_info['status'],
+        'resources': resources,
+    }
+    if 'resource_changes' in dataset:
+        summary['resource_changes'] = dataset['resource_changes']
+
+    return summary
+
+
+def collapse_enabled(config):
+    return toolkit.asbool(config.get(
+        'ckanext.mapactionimporter.collapse_activities', True))
+
+
+def _extra(dataset_dict, key):
+    if dataset_dict.get(key):
+        return dataset_dict[key]
+
+    for extra in dataset_dict.get('extras', []):
+        if extra['key'] == key:
+            return extra['value']
+
+    return None
+
+
+def _install():
+    """
+    Have CKAN's activity session extension skip the packages that the
+    thread committing is suppressing activities for, until _uninstall() has
+    been called as many times. CKAN has no hook for leaving out activities.
+    """
+    global _install_count, _original_activity_stream_item
+
+    with _install_lock:
+        _install_count += 1
+        if _install_count > 1:
+            return
+
+        activity_stream_item = _original_activity_stream_item = \
+            activity_extension.activity_stream_item
+
+        def suppressible_activity_stream_item(obj, activity_type, revision,
+                                              user_id):
+            # The extension leaves out packages that have no activity
+            if (isinstance(obj, model.Package) and
+                    obj.name in getattr(_local, 'package_names', ())):
+                return None
+
+            return activity_stream_item(obj, activity_type, revision,
+                                        user_id)
+
+        activity_extension.activity_stream_item = \
+            suppressible_activity_stream_item
+
+
+def _uninstall():
+    global _install_count, _original_activity_stream_item
+
+    with _install_lock:
+        _install_count -= 1
+        if _install_count:
+            return
+
+        activity_extension.activity_stream_item = \
+            _original_activity_stream_item
+        _original_activity_stream_item = None
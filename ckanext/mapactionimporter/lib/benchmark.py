@@ -0,0 +1,377 @@
+import os
+
+import contextlib
+import io
+import json
+import math
+import resource
+import shutil
+import tempfile
+import time
+import traceback
+import uuid
+import zipfile
+
+from xml.sax.saxutils import escape
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+import ckan.lib.uploader as uploader
+
+from ckanext.mapactionimporter.lib import bulk, mappackage
+
+STAGES = ('to_dataset', 'transform_for_schema', 'create_dataset_from_zip')
+
+# Directories of the stores an import writes to
+STORE_DIRS = ('hash_index_dir', 'scratch_dir', 'blob_dir', 'profile_dir',
+              'jobs_dir', 'staging_dir')
+
+METADATA_TEMPLATE = u'''<?xml version="1.0" encoding="utf-8"?>
+<mapdoc>
+  <mapdata>
+    <operationID>{operation_id}</operationID>
+    <sourceorg>MapAction</sourceorg>
+    <title>Benchmark map {map_number}</title>
+    <mapNumber>{map_number}</mapNumber>
+    <versionNumber>01</versionNumber>
+    <ref>{map_number}_Benchmark</ref>
+    <language>English</language>
+    <countries>{countries}</countries>
+    <countries-iso3>{countries_iso3}</countries-iso3>
+    <createdate>2016-02-08 12:18:24</createdate>
+    <status>New</status>
+    <summary>Synthetic map package for benchmarking the importer</summary>
+    <themes>{themes}</themes>
+    <accessnotes>{padding}</accessnotes>
+  </mapdata>
+</mapdoc>
+'''
+
+
+class PackageSpec(object):
+    """ Shape of the synthetic map packages to generate """
+    def __init__(self, members=2, member_size=2 ** 20, xml_size=0,
+                 themes=1, countries=1, compressible=False):
+        self.members = members
+        self.member_size = member_size
+        self.xml_size = xml_size
+        self.themes = themes
+        self.countries = countries
+        self.compressible = compressible
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def generate_package(spec, map_number='MA001', operation_id='189'):
+    """
+    Build a map package in memory, returning it as a file object.
+
+    Member contents are random unless ``spec.compressible`` is set, so that
+    decompression costs about what it does for real JPEGs and PDFs.
+    """
+    themes = [mappackage.PRODUCT_THEMES[i % len(mappackage.PRODUCT_THEMES)]
+              for i in range(spec.themes)]
+    countries = ['COUNTRY {0}'.format(i) for i in range(spec.countries)]
+
+    metadata = METADATA_TEMPLATE.format(
+        operation_id=operation_id,
+        map_number=map_number,
+        countries=', '.join(countries),
+        countries_iso3=''.join(
+            '<country-iso3>C{0:02d}</country-iso3>'.format(i % 100)
+            for i in range(spec.countries)),
+        themes=''.join('<theme>{0}</theme>'.format(escape(t))
+                       for t in themes),
+        padding='x' * spec.xml_size,
+    )
+
+    package = io.BytesIO()
+    with zipfile.ZipFile(package, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for i in range(spec.members):
+            if spec.compressible:
+                data = b'\0' * spec.member_size
+            else:
+                data = os.urandom(spec.member_size)
+            zip_file.writestr(
+                '{0}_Benchmark-{1}.jpeg'.format(map_number, i), data)
+
+        zip_file.writestr('{0}_Benchmark.xml'.format(map_number),
+                          metadata.encode('utf-8'))
+
+    package.seek(0)
+    return package
+
+
+class StubActions(object):
+    """
+    In-memory stand-in for the CKAN actions the importer calls, so that the
+    import itself is measured rather than the database and file store.
+    Uploads are read to the end, as a storage backend would.
+    """
+    def __init__(self):
+        self.packages = {}
+        self.bytes_uploaded = 0
+        self.actions = {
+            'package_show': self.package_show,
+            'package_create': self.package_create,
+            'package_update': self.package_update,
+            'package_delete': self.package_delete,
+            'dataset_purge': self.package_delete,
+            'member_create': self.noop,
+            'resource_create': self.resource_create,
+            'resource_delete': self.noop,
+            'dataset_version_create': self.noop,
+        }
+
+    def get_action(self, name):
+        return self.actions[name]
+
+    def package_show(self, context, data_dict):
+        for package in self.packages.values():
+            if data_dict['id'] in (package['id'], package['name']):
+                return dict(package)
+
+        raise toolkit.ObjectNotFound()
+
+    def package_create(self, context, data_dict):
+        package = dict(data_dict, id=str(uuid.uuid4()), resources=[])
+        self.packages[package['id']] = package
+        return dict(package)
+
+    def package_update(self, context, data_dict):
+        self.packages[data_dict['id']].update(data_dict)
+        return dict(self.packages[data_dict['id']])
+
+    def package_delete(self, context, data_dict):
+        self.packages.pop(data_dict['id'], None)
+
+    def resource_create(self, context, data_dict):
+        upload = data_dict.pop('upload', None)
+        if upload is not None:
+            self._read(upload.file)
+
+        resource = dict(data_dict, id=str(uuid.uuid4()))
+        self.packages[data_dict['package_id']]['resources'].append(resource)
+        return resource
+
+    def noop(self, context, data_dict):
+        return {}
+
+    def get_resource_uploader(self, resource):
+        return _StubUploader(self, resource.get('upload'))
+
+    def _read(self, fp):
+        fp.seek(0)
+        while True:
+            data = fp.read(2 ** 20)
+            if not data:
+                break
+            self.bytes_uploaded += len(data)
+
+
+class _StubUploader(object):
+    def __init__(self, actions, upload):
+        self.actions = actions
+        self.upload_file = upload.file if upload is not None else None
+
+    def upload(self, id, max_size=10):
+        if self.upload_file is not None:
+            self.actions._read(self.upload_file)
+
+
+@contextlib.contextmanager
+def stub_action_layer(actions):
+    get_action = toolkit.get_action
+    get_resource_uploader = uploader.get_resource_uploader
+    toolkit.get_action = actions.get_action
+    uploader.get_resource_uploader = actions.get_resource_uploader
+    try:
+        yield actions
+    finally:
+        toolkit.get_action = get_action
+        uploader.get_resource_uploader = get_resource_uploader
+
+
+def run_benchmark(spec, iterations=10, stages=STAGES):
+    """
+    Time each stage of the import over ``iterations`` generated packages,
+    returning the results as a JSON-serialisable dict.
+    """
+    packages = [generate_package(spec, map_number='MA{0:03d}'.format(i))
+                for i in range(iterations)]
+    package_size = len(packages[0].getvalue())
+
+    results = {
+        'spec': spec.as_dict(),
+        'iterations': iterations,
+        'package_size': package_size,
+        'stages': {},
+    }
+
+    with temporary_stores():
+        for stage in stages:
+            measured = _measure_in_child(stage, packages)
+            results['stages'][stage] = _summarise(
+                measured['latencies'], package_size, measured['memory'])
+
+    return results
+
+
+@contextlib.contextmanager
+def temporary_stores():
+    """
+    Point every store an import writes to at a temporary directory, removed
+    afterwards, so that the stubbed imports leave nothing in the real ones,
+    such as the ids of datasets that were never created in the hash index.
+    """
+    root = tempfile.mkdtemp(prefix='mapactionimporter-benchmark-')
+    saved = {}
+    for name in STORE_DIRS:
+        key = 'ckanext.mapactionimporter.' + name
+        saved[key] = toolkit.config.get(key)
+        toolkit.config[key] = os.path.join(root, name)
+
+    try:
+        yield root
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                toolkit.config.pop(key, None)
+            else:
+                toolkit.config[key] = value
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of values """
+    values = sorted(values)
+    if not values:
+        return None
+
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def _measure_in_child(stage, packages):
+    """
+    Time the stage over the packages in a forked child process, so that the
+    peak memory measured is that stage's alone rather than the whole run's
+    so far. Returns the latencies and the memory used, in kilobytes.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            measured = _measure(stage, packages)
+            status = 0
+        except Exception:
+            measured = {'error': traceback.format_exc()}
+        finally:
+            with os.fdopen(write_fd, 'w') as result_file:
+                json.dump(measured, result_file)
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result_file:
+        output = result_file.read()
+    os.waitpid(pid, 0)
+
+    measured = json.loads(output) if output else {}
+    if 'latencies' not in measured:
+        raise RuntimeError('Benchmark of {0} failed: {1}'.format(
+            stage, measured.get('error', 'no result')))
+
+    return measured
+
+
+def _measure(stage, packages):
+    run = globals()['_run_' + stage]
+
+    # A forked child starts with a high water mark of what it shares with
+    # its parent, so what the stage used is how far it rises from there
+    start_rss = _peak_rss()
+    latencies = []
+    for package in packages:
+        package.seek(0)
+        start = time.time()
+        run(package)
+        latencies.append(time.time() - start)
+
+    peak_rss = _peak_rss()
+    return {
+        'latencies': latencies,
+        'memory': {
+            'peak_rss_kb': peak_rss,
+            'rss_growth_kb': peak_rss - start_rss,
+        },
+    }
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_to_dataset(package):
+    return mappackage.to_dataset(_context(), package)
+
+
+def _run_transform_for_schema(package):
+    from ckanext.mapactionimporter.logic.action.create import (
+        transform_for_schema
+    )
+
+    context = _context()
+    return transform_for_schema(
+        context, mappackage.to_dataset(context, package))
+
+
+def _run_create_dataset_from_zip(package):
+    from ckanext.mapactionimporter.logic.action.create import (
+        create_dataset_from_zip
+    )
+
+    with stub_action_layer(StubActions()), _stub_operation('189'):
+        return create_dataset_from_zip(
+            _context(), {'upload': bulk.FileUpload(package), 'background': False})
+
+
+@contextlib.contextmanager
+def _stub_operation(operation_id):
+    from ckanext.mapactionimporter.logic.action.create import (
+        operation_cache
+    )
+
+    # Stands in for the operation group, which is looked up in the database
+    operation_cache.set(operation_id, True)
+    try:
+        yield
+    finally:
+        operation_cache.invalidate(operation_id)
+
+
+def _context():
+    return {
+        'model': model,
+        'session': model.Session,
+        'user': '',
+        'ignore_auth': True,
+    }
+
+
+def _summarise(latencies, package_size, memory):
+    total = sum(latencies) or 0.000001
+    summary = {
+        'mean': total / len(latencies),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies),
+        'packages_per_second': len(latencies) / total,
+        'megabytes_per_second':
+        len(latencies) * package_size / float(2 ** 20) / total,
+    }
+    summary.update(memory)
+    return summary
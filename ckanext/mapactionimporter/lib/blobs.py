@@ -0,0 +1,290 @@
+import os
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import shutil
+import uuid
+
+from ckan.common import _
+import ckan.lib.uploader as uploader
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib.hashes import SHA256_HEX
+
+log = logging.getLogger(__name__)
+
+
+class BlobStore(object):
+    """
+    Content-addressed store for the files of imported resources.
+
+    Each distinct file is kept once, as a blob named by its SHA-256, and
+    every resource with the same contents is a hard link to it. A reference
+    is recorded for each resource linked to a blob, and the blob is removed
+    with its last reference, so that storage is only freed once no resource
+    uses it.
+
+    References are changed under an exclusive lock on the store. Blobs are
+    written outside it, so that one large upload doesn't hold up the rest.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def add(self, resource_id, path, data_file, sha256=None, max_bytes=0):
+        """
+        Store the file for a resource at path, as a link to the blob with
+        its contents. If the SHA-256 is given and the blob is already
+        stored, the file isn't read at all.
+
+        Returns the SHA-256 of the file.
+        """
+        tmp_path = None
+        try:
+            if sha256 is None or not os.path.exists(self.blob_path(sha256)):
+                tmp_path, sha256 = self._write_temp(data_file, max_bytes)
+
+            with self._locked():
+                blob_path = self.blob_path(sha256)
+                if not os.path.exists(blob_path):
+                    if tmp_path is None:
+                        # Removed since we looked
+                        tmp_path, sha256 = self._write_temp(
+                            data_file, max_bytes)
+                    _makedirs(os.path.dirname(blob_path))
+                    os.rename(tmp_path, blob_path)
+                    tmp_path = None
+
+                # A resource being replaced lets go of its old blob only
+                # once it holds the new one, which may be the same
+                old_sha256 = self._blob_of(resource_id)
+                _link(blob_path, path)
+                self._add_ref(sha256, resource_id)
+                if old_sha256 not in (None, sha256):
+                    self._drop_ref(old_sha256, resource_id)
+        finally:
+            if tmp_path is not None:
+                os.remove(tmp_path)
+
+        return sha256
+
+    def release(self, resource_id, path=None):
+        """
+        Drop the resource's reference, and its file at path, removing the
+        blob if nothing else refers to it. Returns the SHA-256 it referred
+        to, or None if the resource isn't in the store.
+        """
+        if not os.path.exists(self._resource_path(resource_id)):
+            return None
+
+        with self._locked():
+            sha256 = self._release(resource_id)
+            if sha256 is not None and path is not None:
+                _remove(path)
+
+        return sha256
+
+    def stats(self):
+        """ How many blobs there are and how many bytes sharing saved """
+        blobs = references = stored_bytes = referenced_bytes = 0
+
+        for sha256 in self._blob_names():
+            try:
+                size = os.path.getsize(self.blob_path(sha256))
+            except OSError:
+                continue
+
+            count = len(_listdir(self._refs_dir(sha256)))
+            blobs += 1
+            references += count
+            stored_bytes += size
+            referenced_bytes += size * count
+
+        return {
+            'blobs': blobs,
+            'references': references,
+            'stored_bytes': stored_bytes,
+            'referenced_bytes': referenced_bytes,
+            'saved_bytes': referenced_bytes - stored_bytes,
+        }
+
+    def blob_path(self, sha256):
+        if not SHA256_HEX.match(sha256 or ''):
+            raise ValueError(sha256)
+
+        return os.path.join(self.root, 'blobs', sha256[:2], sha256)
+
+    def _write_temp(self, data_file, max_bytes):
+        tmp_dir = os.path.join(self.root, 'tmp')
+        _makedirs(tmp_dir)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+
+        digest = hashlib.sha256()
+        size = 0
+        data_file.seek(0)
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                while True:
+                    data = data_file.read(2 ** 20)
+                    if not data:
+                        break
+                    size += len(data)
+                    if max_bytes and size > max_bytes:
+                        raise toolkit.ValidationError(
+                            {'upload': [_('File upload too large')]})
+                    digest.update(data)
+                    tmp_file.write(data)
+        except:
+            _remove(tmp_path)
+            raise
+
+        return (tmp_path, digest.hexdigest())
+
+    def _add_ref(self, sha256, resource_id):
+        _makedirs(self._refs_dir(sha256))
+        open(os.path.join(self._refs_dir(sha256), resource_id), 'w').close()
+
+        _makedirs(os.path.dirname(self._resource_path(resource_id)))
+        with open(self._resource_path(resource_id), 'w') as resource_file:
+            resource_file.write(sha256)
+
+    def _release(self, resource_id):
+        # Only with the lock held
+        sha256 = self._blob_of(resource_id)
+        if sha256 is not None:
+            _remove(self._resource_path(resource_id))
+            self._drop_ref(sha256, resource_id)
+
+        return sha256
+
+    def _drop_ref(self, sha256, resource_id):
+        # Only with the lock held
+        _remove(os.path.join(self._refs_dir(sha256), resource_id))
+        if not _listdir(self._refs_dir(sha256)):
+            _remove(self.blob_path(sha256))
+            shutil.rmtree(self._refs_dir(sha256), ignore_errors=True)
+            log.debug('Removed unreferenced blob {0}'.format(sha256))
+
+    def _blob_of(self, resource_id):
+        try:
+            with open(self._resource_path(resource_id)) as resource_file:
+                sha256 = resource_file.read().strip()
+        except IOError:
+            return None
+
+        return sha256 if SHA256_HEX.match(sha256) else None
+
+    def _refs_dir(self, sha256):
+        return os.path.join(self.root, 'refs', sha256[:2], sha256)
+
+    def _resource_path(self, resource_id):
+        return os.path.join(self.root, 'resources', resource_id[:2],
+                            resource_id)
+
+    def _blob_names(self):
+        blobs_dir = os.path.join(self.root, 'blobs')
+        for fanout in _listdir(blobs_dir):
+            for name in _listdir(os.path.join(blobs_dir, fanout)):
+                if SHA256_HEX.match(name):
+                    yield name
+
+    @contextlib.contextmanager
+    def _locked(self):
+        _makedirs(self.root)
+        with open(os.path.join(self.root, 'lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class ContentAddressedUpload(uploader.ResourceUpload):
+    """
+    Resource uploader that stores the file in a BlobStore, linked from the
+    path the default uploader would have written it to, so that resources
+    are served as usual.
+    """
+    def __init__(self, resource, store):
+        # Set by the importer, which has already hashed the file
+        sha256 = resource.get('hash')
+        super(ContentAddressedUpload, self).__init__(resource)
+        self.store = store
+        self.sha256 = sha256 if SHA256_HEX.match(sha256 or '') else None
+
+    def upload(self, id, max_size=10):
+        if not self.storage_path or not self.filename:
+            return super(ContentAddressedUpload, self).upload(id, max_size)
+
+        max_bytes = max_size * 2 ** 20
+        if self.filesize > max_bytes:
+            raise toolkit.ValidationError(
+                {'upload': [_('File upload too large')]})
+
+        self.store.add(id, self.get_path(id), self.upload_file,
+                       sha256=self.sha256, max_bytes=max_bytes)
+
+
+def release_resources(store, resource_ids):
+    """ Release the blobs of deleted resources """
+    # Only used to find where the default uploader keeps each file
+    upload = uploader.ResourceUpload({'url': ''})
+    for resource_id in resource_ids:
+        path = upload.get_path(resource_id) if upload.storage_path else None
+        store.release(resource_id, path)
+
+
+def content_addressed_storage_enabled(config):
+    return toolkit.asbool(config.get(
+        'ckanext.mapactionimporter.content_addressed_storage', False))
+
+
+def blob_store_from_config(config):
+    root = config.get('ckanext.mapactionimporter.blob_dir')
+    if not root:
+        root = os.path.join(config.get('ckan.storage_path', ''),
+                            'mapactionimporter', 'blobs')
+
+    return BlobStore(root)
+
+
+def _link(blob_path, path):
+    """ Hard link path to the blob, replacing anything already there """
+    _makedirs(os.path.dirname(path))
+    tmp_path = '{0}.{1}~'.format(path, uuid.uuid4().hex)
+    try:
+        os.link(blob_path, tmp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        # Can't link from here, so this file won't share its storage
+        log.warning('Could not link {0} to blob: {1}'.format(path, e))
+        shutil.copyfile(blob_path, tmp_path)
+
+    os.rename(tmp_path, path)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
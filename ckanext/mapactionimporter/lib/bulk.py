@@ -0,0 +1,175 @@
+import os
+
+import glob
+import logging
+import multiprocessing
+import time
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import indexing, mappackage
+
+log = logging.getLogger(__name__)
+
+# Within a map, earlier versions first and, for the same version, the new
+# dataset before anything that changes it
+STATUS_ORDER = {'New': 0, 'Update': 1, 'Correction': 2}
+
+
+class ImportResult(object):
+    def __init__(self, path, size, seconds, name=None, error=None):
+        self.path = path
+        self.size = size
+        self.seconds = seconds
+        self.name = name
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+def find_packages(patterns):
+    """
+    Expand directories and glob patterns into a sorted list of zip files.
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.zip')
+
+        paths.update(p for p in glob.glob(pattern) if os.path.isfile(p))
+
+    return sorted(paths)
+
+
+def plan_imports(paths):
+    """
+    Group the packages so that every version of a map is imported in order
+    by the same worker, and different maps can be imported side by side.
+
+    Packages whose metadata can't be read get a group of their own so that
+    their import fails with the usual error.
+    """
+    groups = {}
+    for path in paths:
+        key = _package_key(path)
+        if key is None:
+            groups[(path,)] = [((0, 0), path)]
+            continue
+
+        map_key, order = key
+        groups.setdefault(map_key, []).append((order, path))
+
+    return [[path for version_order, path in sorted(groups[k])]
+            for k in sorted(groups)]
+
+
+def run_imports(groups, user, processes=1, data_dict=None):
+    """
+    Import each group of packages, yielding an ImportResult per package as
+    it finishes. A failure is recorded and the rest carry on.
+    """
+    tasks = [(group, user, data_dict or {}) for group in groups]
+
+    if processes <= 1:
+        # Indexed together once everything has been imported
+        with indexing.deferred():
+            for task in tasks:
+                for result in _import_group(task):
+                    yield result
+        return
+
+    # Each process needs its own database connections
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+    pool = multiprocessing.Pool(processes, _init_worker)
+    try:
+        for results in pool.imap_unordered(_import_group, tasks):
+            for result in results:
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def import_package(path, user, data_dict=None):
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': user,
+    }
+    data_dict = dict(data_dict or {}, background=False)
+    size = os.path.getsize(path)
+    start = time.time()
+
+    try:
+        with open(path, 'rb') as package_file:
+            data_dict['upload'] = FileUpload(package_file)
+            dataset = toolkit.get_action('create_dataset_from_mapaction_zip')(
+                context, data_dict)
+    except toolkit.ValidationError as e:
+        model.Session.rollback()
+        return ImportResult(path, size, time.time() - start,
+                            error=_format_errors(e.error_summary))
+    except Exception as e:
+        log.exception('Failed to import {0}'.format(path))
+        model.Session.rollback()
+        return ImportResult(path, size, time.time() - start,
+                            error=unicode(e))
+
+    return ImportResult(path, size, time.time() - start,
+                        name=dataset['name'])
+
+
+def _import_group(task):
+    group, user, data_dict = task
+    with indexing.deferred():
+        return [import_package(path, user, data_dict) for path in group]
+
+
+def _init_worker():
+    from ckanext.mapactionimporter.plugin import register_translator
+
+    register_translator()
+
+
+def package_key(package_file):
+    """
+    Return ((operationID, mapNumber), (version, status rank)) from the
+    package's metadata, or None if it can't be read.
+    """
+    try:
+        zip_file = mappackage.open_zip(package_file)
+        et, members = mappackage.read_metadata(zip_file)
+        operation_id = mappackage.get_mandatory_text_node(et, 'operationID')
+        map_number = mappackage.get_mandatory_text_node(et, 'mapNumber')
+        version = int(mappackage.get_mandatory_text_node(
+            et, 'versionNumber'))
+        status = mappackage.get_text_node(et, 'status')
+    except (mappackage.MapPackageException, IOError, ValueError):
+        return None
+
+    return ((operation_id, map_number),
+            (version, STATUS_ORDER.get(status, len(STATUS_ORDER))))
+
+
+def _package_key(path):
+    try:
+        with open(path, 'rb') as package_file:
+            return package_key(package_file)
+    except IOError:
+        return None
+
+
+def _format_errors(error_summary):
+    return '; '.join('{0}: {1}'.format(k, v)
+                     for k, v in sorted(error_summary.items()))
+
+
+class FileUpload(object):
+    """ Stands in for the upload field of a request """
+    def __init__(self, fp):
+        self.file = fp
@@ -0,0 +1,68 @@
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    Bounded mapping whose entries expire ``ttl`` seconds after they were
+    set. When full, expired entries are dropped first and then the oldest.
+    Safe to share between threads.
+
+    ``hits`` and ``misses`` count the lookups that found, or didn't find, a
+    live entry.
+    """
+    def __init__(self, max_size=1000, ttl=300, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires <= self._clock():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.max_size:
+                self._evict()
+            self._entries[key] = (self._clock() + self.ttl, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        now = self._clock()
+        for key, (expires, value) in self._entries.items():
+            if expires <= now:
+                del self._entries[key]
+
+        while len(self._entries) >= self.max_size:
+            self._entries.popitem(last=False)
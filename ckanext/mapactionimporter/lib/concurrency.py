@@ -0,0 +1,91 @@
+import logging
+
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+
+def map_bounded(func, items, workers):
+    """
+    Call func on each item using at most ``workers`` threads, returning the
+    results in the same order as items.
+
+    Every call is allowed to finish before anything is raised, so callers
+    can safely roll back. If any call failed, the exception from the first
+    failing item is then re-raised.
+
+    The translator and request objects registered for the calling thread
+    are made available to the workers, so that _() and friends still work
+    in them.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    func = _with_request_globals(func)
+
+    def call(item):
+        try:
+            return (True, func(item))
+        except Exception as e:
+            log.debug('Error in worker thread', exc_info=True)
+            return (False, e)
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        outcomes = pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+    for succeeded, value in outcomes:
+        if not succeeded:
+            raise value
+
+    return [value for succeeded, value in outcomes]
+
+
+def _with_request_globals(func):
+    proxies = _registered_proxies()
+    request_context = _flask_request_context()
+
+    def wrapped(item):
+        for proxy, obj in proxies:
+            proxy._push_object(obj)
+        try:
+            if request_context is None:
+                return func(item)
+
+            with request_context.copy():
+                return func(item)
+        finally:
+            for proxy, obj in reversed(proxies):
+                proxy._pop_object(obj)
+
+    return wrapped
+
+
+def _flask_request_context():
+    try:
+        import flask
+    except ImportError:
+        return None
+
+    return flask._request_ctx_stack.top
+
+
+def _registered_proxies():
+    try:
+        import pylons
+    except ImportError:
+        return []
+
+    proxies = []
+    for proxy in (pylons.translator, pylons.request, pylons.tmpl_context):
+        try:
+            proxies.append((proxy, proxy._current_obj()))
+        except TypeError:
+            # Nothing registered for this thread
+            pass
+
+    return proxies
@@ -0,0 +1,167 @@
+import os
+
+import errno
+import hashlib
+import mmap
+import re
+import threading
+
+# Name of the dataset extra recording the hash of the package it came from
+HASH_EXTRA = 'package_sha256'
+
+SHA256_HEX = re.compile(r'^[0-9a-f]{64}$')
+
+
+def hash_file(fp, chunk_size=2 ** 20):
+    """ SHA-256 of the whole file, which is left rewound to the start """
+    fp.seek(0)
+    digest = hashlib.sha256()
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            break
+        digest.update(data)
+
+    fp.seek(0)
+    return digest.hexdigest()
+
+
+def copy_and_hash(src, dst, chunk_size=2 ** 20):
+    """ Copy src to dst, returning the SHA-256 of what was copied """
+    digest = hashlib.sha256()
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        digest.update(data)
+        dst.write(data)
+
+    return digest.hexdigest()
+
+
+class BackgroundHash(object):
+    """
+    SHA-256 of a whole file, worked out on another thread while the file is
+    read for other things, such as its metadata.
+
+    The thread reads through a memory map, so it doesn't move the file's
+    position under whatever else is reading it. Files that can't be mapped,
+    such as small uploads held in memory, are hashed straight away.
+    """
+    def __init__(self, fp, chunk_size=2 ** 20):
+        self.size = None
+        self._chunk_size = chunk_size
+        self._sha256 = None
+        self._error = None
+        self._thread = None
+
+        try:
+            fileno = fp.fileno()
+            self.size = os.fstat(fileno).st_size
+            self._map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            # No file descriptor, or empty
+            self._sha256 = hash_file(fp, chunk_size)
+            fp.seek(0, os.SEEK_END)
+            self.size = fp.tell()
+            fp.seek(0)
+            return
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def result(self):
+        """ Wait for the SHA-256 and return it """
+        if self._thread is not None:
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+        return self._sha256
+
+    def _run(self):
+        digest = hashlib.sha256()
+        try:
+            for offset in range(0, self.size, self._chunk_size):
+                digest.update(buffer(self._map, offset, self._chunk_size))
+            self._sha256 = digest.hexdigest()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._map.close()
+
+
+def dataset_hash(dataset):
+    """
+    The package hash recorded on a dataset, whether the schema made it a
+    field or it was left as an extra.
+    """
+    if dataset.get(HASH_EXTRA):
+        return dataset[HASH_EXTRA]
+
+    for extra in dataset.get('extras', []):
+        if extra['key'] == HASH_EXTRA:
+            return extra['value']
+
+    return None
+
+
+class PackageHashIndex(object):
+    """
+    Index from the SHA-256 of an imported map package to the dataset it
+    was imported as, one small file per hash.
+
+    Entries are never trusted on their own: the dataset has to still exist
+    and still carry the same hash, as a correction may since have replaced
+    its files.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def get(self, digest):
+        if not SHA256_HEX.match(digest or ''):
+            return None
+
+        try:
+            with open(self._path(digest)) as entry_file:
+                return entry_file.read().strip() or None
+        except IOError:
+            return None
+
+    def add(self, digest, dataset_id):
+        directory = os.path.dirname(self._path(digest))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Write then rename so readers never see a partial entry
+        tmp_path = '{0}.{1}.tmp'.format(self._path(digest), os.getpid())
+        with open(tmp_path, 'w') as entry_file:
+            entry_file.write(dataset_id)
+        os.rename(tmp_path, self._path(digest))
+
+    def remove(self, digest):
+        if not SHA256_HEX.match(digest or ''):
+            return
+
+        try:
+            os.remove(self._path(digest))
+        except OSError:
+            pass
+
+    def _path(self, digest):
+        # Fan out so that no one directory gets too large
+        return os.path.join(self.root, digest[:2], digest)
+
+
+def hash_index_from_config(config):
+    root = config.get('ckanext.mapactionimporter.hash_index_dir')
+    if not root:
+        root = os.path.join(config.get('ckan.storage_path', ''),
+                            'mapactionimporter', 'hashes')
+
+    return PackageHashIndex(root)
@@ -0,0 +1,155 @@
+import collections
+import contextlib
+import logging
+import threading
+
+import ckan.lib.search as search
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+log = logging.getLogger(__name__)
+
+# The IndexBatch that the current thread's index updates are going to
+_local = threading.local()
+
+# How many threads are in a deferred() block, and the search plugin's own
+# notify, put back once none are
+_install_lock = threading.Lock()
+_install_count = 0
+_original_notify = None
+
+
+class IndexBatch(object):
+    """
+    Packages whose search index updates have been held back. Each is
+    indexed once, as it is by then, when the batch is flushed, and the
+    search index is committed once for the lot.
+
+    Several threads may add to the same batch.
+    """
+    def __init__(self):
+        self.package_ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, package_id):
+        with self._lock:
+            self.package_ids[package_id] = True
+
+    def flush(self):
+        with self._lock:
+            package_ids = list(self.package_ids)
+            self.package_ids.clear()
+
+        if not package_ids or not toolkit.asbool(toolkit.config.get(
+                'ckan.search.automatic_indexing', True)):
+            return
+
+        package_index = search.index_for(model.Package)
+        for package_id in package_ids:
+            try:
+                _index_package(package_index, package_id)
+            except Exception:
+                # The package is saved whatever happens to its index entry
+                log.exception(
+                    'Failed to index package {0}, rebuild the search index '
+                    'for it with "paster search-index rebuild {0}"'.format(
+                        package_id))
+
+        try:
+            package_index.commit()
+        except Exception:
+            # Nor should the import fail, or its own error be lost, because
+            # the search index couldn't be committed
+            log.exception(
+                'Failed to commit the search index after indexing packages '
+                '{0}, rebuild it for them with "paster search-index '
+                'rebuild"'.format(', '.join(package_ids)))
+
+
+@contextlib.contextmanager
+def deferred(batch=None):
+    """
+    Hold back the search index updates made by this thread in the block,
+    adding the packages to ``batch`` instead. Without a batch a new one is
+    used and flushed when the block ends, whether or not it succeeds.
+
+    Nested blocks go to the outermost block's batch.
+    """
+    current = getattr(_local, 'batch', None)
+    if current is not None:
+        yield current
+        return
+
+    own_batch = batch is None
+    if own_batch:
+        batch = IndexBatch()
+
+    _install()
+    _local.batch = batch
+    try:
+        yield batch
+    finally:
+        _local.batch = None
+        _uninstall()
+        if own_batch:
+            batch.flush()
+
+
+def _index_package(package_index, package_id):
+    package = model.Package.get(package_id)
+    if package is None:
+        # Purged, e.g. after a failed import
+        package_index.remove_dict({'id': package_id})
+        return
+
+    # As SynchronousSearchPlugin reads the package to index it
+    pkg_dict = toolkit.get_action('package_show')({
+        'model': model,
+        'ignore_auth': True,
+        'validate': False,
+        'use_cache': False,
+    }, {'id': package_id})
+    package_index.update_dict(pkg_dict, defer_commit=True)
+
+
+def _install():
+    """
+    Route the package updates CKAN's search plugin is notified of through
+    the batch of the thread they are made in, if it has one, until
+    _uninstall() has been called as many times.
+
+    CKAN has no hook for holding back index updates, and its
+    automatic_indexing setting would turn them off for every thread.
+    """
+    global _install_count, _original_notify
+
+    plugin_class = search.SynchronousSearchPlugin
+    with _install_lock:
+        _install_count += 1
+        if _install_count > 1:
+            return
+
+        notify = _original_notify = getattr(
+            plugin_class.notify, '__func__', plugin_class.notify)
+
+        def deferrable_notify(self, entity, operation):
+            batch = getattr(_local, 'batch', None)
+            if batch is not None and isinstance(entity, model.Package):
+                batch.add(entity.id)
+                return
+
+            return notify(self, entity, operation)
+
+        plugin_class.notify = deferrable_notify
+
+
+def _uninstall():
+    global _install_count, _original_notify
+
+    with _install_lock:
+        _install_count -= 1
+        if _install_count:
+            return
+
+        search.SynchronousSearchPlugin.notify = _original_notify
+        _original_notify = None
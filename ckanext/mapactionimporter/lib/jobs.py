@@ -0,0 +1,276 @@
+import os
+
+import contextlib
+import datetime
+import errno
+import fcntl
+import json
+import logging
+import shutil
+import socket
+import time
+import uuid
+
+from ckanext.mapactionimporter.lib.hashes import copy_and_hash
+from ckanext.mapactionimporter.lib.scratch import process_exists
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETE = 'complete'
+ERROR = 'error'
+
+
+class JobNotFound(Exception):
+    pass
+
+
+class ImportJobStore(object):
+    """
+    Directory of background import jobs, one subdirectory per job holding
+    the uploaded map package and a JSON record of the job's progress.
+
+    Workers claim a job by creating its claim file exclusively, so any
+    number of them can share the store without a broker. A claim left by a
+    worker on this host that has since died is broken by the next worker,
+    as is one from another host that hasn't been updated for claim_timeout
+    seconds (never, if 0). Each update to a job refreshes its claim.
+    """
+    PACKAGE_FILENAME = 'package.zip'
+    RECORD_FILENAME = 'job.json'
+    CLAIM_FILENAME = 'claim'
+    LOCK_FILENAME = 'claim.lock'
+
+    def __init__(self, root, claim_timeout=0):
+        self.root = root
+        self.claim_timeout = claim_timeout
+
+    def create(self, upload_file, user, params=None):
+        """ Persist the upload and queue a job for it, returning the job """
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._job_dir(job_id))
+
+        # Hashed as it is copied, so the worker needn't read it again
+        upload_file.seek(0)
+        with open(self.package_path(job_id), 'wb') as package_file:
+            sha256 = copy_and_hash(upload_file, package_file)
+
+        return self._queue(job_id, user, params, sha256)
+
+    def create_from_path(self, path, user, params=None):
+        """
+        Queue a job for a package already on disk, moving it into the store
+        rather than copying it.
+        """
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._job_dir(job_id))
+        shutil.move(path, self.package_path(job_id))
+
+        return self._queue(job_id, user, params)
+
+    def get(self, job_id):
+        # Ids are only ever hex, don't let them escape the directory
+        if not _is_id(job_id):
+            raise JobNotFound(job_id)
+
+        try:
+            with open(self._record_path(job_id)) as record_file:
+                return json.load(record_file)
+        except (IOError, ValueError):
+            raise JobNotFound(job_id)
+
+    def update(self, job_id, **fields):
+        job = self.get(job_id)
+        job.update(fields)
+        job['updated'] = _now()
+        self._write(job)
+
+        # Shows the worker running it is still alive
+        try:
+            os.utime(self._claim_path(job_id), None)
+        except OSError:
+            pass
+
+        return job
+
+    def package_path(self, job_id):
+        return os.path.join(self._job_dir(job_id), self.PACKAGE_FILENAME)
+
+    def claim_next(self):
+        """
+        Claim the oldest pending job, returning it, or None if there are
+        no jobs waiting.
+        """
+        pending = []
+        for job_id in self._job_ids():
+            try:
+                job = self.get(job_id)
+            except JobNotFound:
+                # Still being created
+                continue
+
+            if job['status'] in (PENDING, RUNNING):
+                pending.append(job)
+
+        for job in sorted(pending, key=lambda j: j['created']):
+            if self._claim(job['id']):
+                return self.update(job['id'], status=RUNNING)
+
+        return None
+
+    def finish(self, job_id, **fields):
+        """ Record the outcome of a job and remove its package """
+        job = self.update(job_id, **fields)
+        try:
+            os.remove(self.package_path(job_id))
+        except OSError:
+            pass
+
+        return job
+
+    def sweep(self, max_age):
+        """
+        Remove finished jobs not updated for max_age seconds, and jobs
+        whose creation never finished. Pending and running jobs are left
+        for a worker to claim.
+        """
+        now = time.time()
+        removed = []
+        for job_id in self._job_ids():
+            if not _is_id(job_id):
+                continue
+
+            try:
+                finished = self.get(job_id)['status'] in (COMPLETE, ERROR)
+                age = now - os.path.getmtime(self._record_path(job_id))
+            except (JobNotFound, OSError):
+                # Never fully created, so gone once its directory is old
+                finished = True
+                try:
+                    age = now - os.path.getmtime(self._job_dir(job_id))
+                except OSError:
+                    continue
+
+            if finished and age > max_age:
+                shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+                removed.append(job_id)
+
+        if removed:
+            log.info('Removed {0} old import jobs from {1}'.format(
+                len(removed), self.root))
+
+        return removed
+
+    def _queue(self, job_id, user, params, sha256=None):
+        now = _now()
+        job = {
+            'id': job_id,
+            'user': user,
+            'params': params or {},
+            'sha256': sha256,
+            'status': PENDING,
+            'stage': None,
+            'created': now,
+            'updated': now,
+            'result': None,
+            'error': None,
+        }
+        self._write(job)
+
+        return job
+
+    def _claim(self, job_id):
+        claim_path = self._claim_path(job_id)
+        owner = '{0} {1}'.format(socket.gethostname(), os.getpid())
+
+        # Held while a stale claim is broken, so that no other worker can
+        # take it for stale and remove the new claim in the meantime
+        with self._claim_locked(job_id):
+            try:
+                fd = os.open(claim_path,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if not self._claim_is_stale(claim_path):
+                    return False
+
+                log.warning('Breaking stale claim on import job {0}'.format(
+                    job_id))
+                os.remove(claim_path)
+                fd = os.open(claim_path,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+
+            with os.fdopen(fd, 'w') as claim_file:
+                claim_file.write(owner)
+
+        return True
+
+    def _claim_is_stale(self, claim_path):
+        try:
+            with open(claim_path) as claim_file:
+                host, pid = claim_file.read().split()
+            age = time.time() - os.path.getmtime(claim_path)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if host == socket.gethostname():
+            return not process_exists(int(pid))
+
+        # Whether a worker on another host is alive can only be told from
+        # how long ago it last updated its job
+        return bool(self.claim_timeout) and age > self.claim_timeout
+
+    @contextlib.contextmanager
+    def _claim_locked(self, job_id):
+        lock_path = os.path.join(self._job_dir(job_id), self.LOCK_FILENAME)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _claim_path(self, job_id):
+        return os.path.join(self._job_dir(job_id), self.CLAIM_FILENAME)
+
+    def _job_ids(self):
+        try:
+            return os.listdir(self.root)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def _record_path(self, job_id):
+        return os.path.join(self._job_dir(job_id), self.RECORD_FILENAME)
+
+    def _write(self, job):
+        # Write then rename so readers never see a partial record
+        record_path = self._record_path(job['id'])
+        tmp_path = record_path + '.tmp'
+        with open(tmp_path, 'w') as record_file:
+            json.dump(job, record_file)
+        os.rename(tmp_path, record_path)
+
+
+def job_store_from_config(config):
+    root = config.get('ckanext.mapactionimporter.jobs_dir')
+    if not root:
+        root = os.path.join(config.get('ckan.storage_path', ''),
+                            'mapactionimporter', 'jobs')
+
+    return ImportJobStore(root, claim_timeout=int(config.get(
+        'ckanext.mapactionimporter.claim_timeout', 3600)))
+
+
+def _is_id(job_id):
+    return bool(job_id) and all(c in '0123456789abcdef' for c in job_id)
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat()
@@ -1,17 +1,27 @@
 import os
 
+import copy
+import hashlib
 import logging
-import shutil
-import tempfile
+import threading
+import weakref
 import zipfile
+import zlib
 
 from ckan.common import _
 
-from defusedxml.ElementTree import parse, ParseError
+from defusedxml.ElementTree import iterparse, parse, ParseError
 from slugify import slugify
 
+from ckanext.mapactionimporter.lib.hashes import copy_and_hash
+from ckanext.mapactionimporter.lib.timing import timed
+
 log = logging.getLogger(__name__)
 
+# Serialises the reads from each zip file that member streams share
+_zip_read_locks = weakref.WeakKeyDictionary()
+_zip_read_locks_lock = threading.Lock()
+
 # Valid CKAN tags must only contain alphanumeric characters or symbols: -_.
 PRODUCT_THEMES = (
     "Affected Population",
@@ -53,19 +63,183 @@ class MapPackageException(Exception):
     pass
 
 
+class PackageLimits(object):
+    """
+    Limits on what a map package may decompress to.
+
+    The sizes declared in the central directory are checked before anything
+    is extracted, and the bytes actually produced are checked again as each
+    member is decompressed, in case the central directory lies. A value of 0
+    disables that limit. One instance should be used per import, as it
+    counts the bytes decompressed so far, by all of its member streams.
+    """
+    # Small members compress too well for the ratio to mean anything
+    RATIO_MIN_SIZE = 2 ** 20
+
+    def __init__(self, max_total_size=0, max_members=0, max_member_size=0,
+                 max_ratio=0):
+        self.max_total_size = max_total_size
+        self.max_members = max_members
+        self.max_member_size = max_member_size
+        self.max_ratio = max_ratio
+        self.total_size = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            max_total_size=int(config.get(
+                'ckanext.mapactionimporter.max_uncompressed_size', 0)),
+            max_members=int(config.get(
+                'ckanext.mapactionimporter.max_members', 0)),
+            max_member_size=int(config.get(
+                'ckanext.mapactionimporter.max_member_size', 0)),
+            max_ratio=int(config.get(
+                'ckanext.mapactionimporter.max_compression_ratio', 0)),
+        )
+
+    def check_members(self, infos):
+        """ Check the central directory before anything is extracted """
+        if self.max_members and len(infos) > self.max_members:
+            raise MapPackageException(
+                _("Zip file contains {count} files, the maximum is {max}".format(
+                    count=len(infos), max=self.max_members)))
+
+        total_size = 0
+        for i in infos:
+            self.check_member(i, i.file_size)
+            total_size += i.file_size
+
+        self._check_total(total_size)
+
+    def check_member(self, info, size):
+        name = info.filename.encode('cp437')
+
+        if self.max_member_size and size > self.max_member_size:
+            raise MapPackageException(
+                _("File '{name}' is larger than the maximum of {max} bytes".format(
+                    name=name, max=self.max_member_size)))
+
+        if (self.max_ratio and size > self.RATIO_MIN_SIZE and
+                size > info.compress_size * self.max_ratio):
+            raise MapPackageException(
+                _("File '{name}' is compressed more than {max} to 1".format(
+                    name=name, max=self.max_ratio)))
+
+    def consume(self, info, size, nbytes):
+        """
+        Account for nbytes more decompressed from a member, which has now
+        produced size bytes in all.
+        """
+        if size > info.file_size:
+            raise MapPackageException(
+                _("Corrupt file '{0}' in zip file: larger than its "
+                  "declared size".format(info.filename.encode('cp437'))))
+
+        self.check_member(info, size)
+        # Members may be uploaded from several threads at once
+        with self._lock:
+            self.total_size += nbytes
+            total_size = self.total_size
+        self._check_total(total_size)
+
+    def _check_total(self, total_size):
+        if self.max_total_size and total_size > self.max_total_size:
+            raise MapPackageException(
+                _("Zip file is larger than the maximum of {max} bytes "
+                  "uncompressed".format(max=self.max_total_size)))
+
+
+class MapMetadata(object):
+    """
+    Indexed view of the <mapdata> fields of a map package's metadata.
+
+    The document is walked once and every accessor below is served from the
+    resulting field map instead of searching the tree again.
+    """
+    def __init__(self, items, themes):
+        # (tag, value) for each <mapdata> child in document order. The value
+        # of <countries-iso3> is the list of its <country-iso3> codes.
+        self.items = items
+        self.themes = themes
+        self.fields = {}
+        for tag, value in items:
+            self.fields.setdefault(tag, value)
+
+    @classmethod
+    def from_tree(cls, et):
+        items = []
+        themes = []
+        for mapdata in et.iter('mapdata'):
+            for e in mapdata:
+                if _is_element(e):
+                    items.append(_metadata_item(e))
+
+            themes.extend(theme.text for theme in mapdata.iter('theme'))
+
+        return cls(items, themes)
+
+    @classmethod
+    def from_file(cls, metadata_file):
+        """
+        Build the field map with iterparse, discarding each element once it
+        has been read so that memory use stays flat however large the file.
+        """
+        items = []
+        themes = []
+        path = []
+        root = None
+        for event, e in iterparse(metadata_file, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = e
+                path.append(e.tag)
+                continue
+
+            path.pop()
+            if e.tag == 'theme' and 'mapdata' in path:
+                themes.append(e.text)
+
+            if path and path[-1] == 'mapdata':
+                items.append(_metadata_item(e))
+                e.clear()
+            elif len(path) == 1:
+                root.clear()
+
+        return cls(items, themes)
+
+    def get(self, name):
+        return self.fields.get(name)
+
+
+def _is_element(e):
+    # lxml yields comments and processing instructions as children too
+    return isinstance(e.tag, basestring)
+
+
+def _metadata_item(e):
+    if e.tag == 'countries-iso3':
+        return (e.tag, get_countries_iso3(e))
+
+    return (e.tag, e.text)
+
+
+def get_metadata(et):
+    """ Return the MapMetadata for a parsed tree (or MapMetadata) """
+    if isinstance(et, MapMetadata):
+        return et
+
+    return MapMetadata.from_tree(et)
+
+
 def map_metadata_to_ckan_extras(et):
     map_metadata = {}
-    for e in et.findall('./mapdata/*'):
-        tag_name = e.tag
-
+    for tag_name, tag_value in get_metadata(et).items:
         if tag_name in EXCLUDE_TAGS:
             continue
 
-        tag_value = e.text
-
         if tag_name == 'countries-iso3':
             tag_name = 'country-iso3'
-            tag_value = get_countries_iso3(e)
 
         map_metadata[tag_name] = tag_value
     return map_metadata
@@ -88,51 +262,276 @@ def join_lines(text):
     return ' '.join(text.splitlines())
 
 
-def extract_zip(map_package):
-    # Extract the map package
-    tempdir = tempfile.mkdtemp('-mapactionzip')
-
-    metadata_paths = []
-    file_paths = []
+class ZipMemberStream(object):
+    """
+    Read-only file object over a single member of a map package.
+
+    The member is decompressed as it is read and its CRC-32 is checked
+    against the central directory once the last byte has gone through, so
+    it can be handed straight to a resource upload without being written
+    to a scratch directory first.
+
+    Only rewinding to the start (or seeking to the end to find the size) is
+    supported, which is all the CKAN uploaders need.
+
+    The member's SHA-256 is worked out on the same pass, and is available
+    as ``sha256`` once the member has been read to the end.
+
+    If PackageLimits are given they are enforced on the bytes as they are
+    decompressed.
+    """
+    def __init__(self, zip_file, info, limits=None):
+        self.info = info
+        self.name = info.filename.encode('cp437')
+        self._zip_file = zip_file
+        self._limits = limits
+        self._fp = None
+        self._pos = 0
+        self._crc = 0
+        self._digest = hashlib.sha256()
+        self._counted = 0
+        self._verified = False
+
+    @property
+    def sha256(self):
+        """ SHA-256 of the member, or None until it has all been read """
+        if not self._verified:
+            return None
+
+        return self._digest.hexdigest()
+
+    def read(self, size=-1):
+        if self._fp is None:
+            if self._pos:
+                # Positioned at the end by seek()
+                return b''
+            # Each stream reads through its own view of the zip file, so
+            # several members can be read at once, even from other threads.
+            # The central directory that has been read already is shared.
+            view = copy.copy(self._zip_file)
+            view.fp = _FileView(self._zip_file.fp,
+                                _zip_read_lock(self._zip_file))
+            self._fp = view.open(self.info)
+
+        try:
+            data = self._fp.read(size)
+        except zipfile.BadZipfile as e:
+            raise MapPackageException(
+                _("Corrupt file '{0}' in zip file: {1}".format(
+                    self.name, e)))
+
+        self._crc = zlib.crc32(data, self._crc)
+        self._digest.update(data)
+        self._pos += len(data)
+
+        if self._limits is not None and self._pos > self._counted:
+            # Bytes read again after a rewind have already been counted
+            self._limits.consume(
+                self.info, self._pos, self._pos - self._counted)
+            self._counted = self._pos
+
+        if size is None or size < 0 or not data:
+            self._verify()
+
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.info.file_size
+
+        if offset == self._pos:
+            return
+
+        if offset not in (0, self.info.file_size):
+            raise IOError('Zip member streams can only be rewound')
+
+        self.close()
+        self._pos = offset
+        self._crc = 0
+        self._digest = hashlib.sha256()
+        self._verified = False
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def _verify(self):
+        if self._verified:
+            return
+
+        crc = self._crc & 0xffffffff
+        if self._pos != self.info.file_size or crc != self.info.CRC:
+            raise MapPackageException(
+                _("Corrupt file '{0}' in zip file: CRC check failed".format(
+                    self.name)))
+
+        self._verified = True
+
+
+def _zip_read_lock(zip_file):
+    with _zip_read_locks_lock:
+        lock = _zip_read_locks.get(zip_file)
+        if lock is None:
+            lock = _zip_read_locks[zip_file] = threading.Lock()
+        return lock
+
+
+class _FileView(object):
+    """ Independent read position over a file shared by member streams """
+    def __init__(self, fp, lock):
+        self._fp = fp
+        self._lock = lock
+        self._pos = 0
+
+    def read(self, size=-1):
+        with self._lock:
+            self._fp.seek(self._pos)
+            data = self._fp.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            with self._lock:
+                self._fp.seek(0, os.SEEK_END)
+                offset += self._fp.tell()
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        # The shared file is left open for the other streams
+        pass
+
+
+def open_zip(map_package):
+    """ Read the central directory of the map package """
     try:
-        with zipfile.ZipFile(map_package, 'r') as z:
-            for i in z.infolist():
-                filename = i.filename.encode('cp437')
-                full_path = os.path.join(tempdir, filename)
-
-                with open(full_path, 'wb') as outputfile:
-                    shutil.copyfileobj(z.open(i.filename), outputfile)
-
-                if filename.endswith('.xml'):
-                    metadata_paths.append(full_path)
-                else:
-                    file_paths.append(full_path)
+        return zipfile.ZipFile(map_package, 'r')
     except zipfile.BadZipfile:
         raise MapPackageException(_('File is not a zip file'))
 
+
+def read_metadata(zip_file, incremental=False, limits=None):
+    """
+    Parse the metadata XML without decompressing any other member.
+
+    Returns the MapMetadata and the ZipInfo of every other member. Any
+    PackageLimits are checked against the central directory first.
+    """
+    infos = zip_file.infolist()
+    if limits is not None:
+        limits.check_members(infos)
+
+    metadata_members = []
+    members = []
+    for i in infos:
+        if i.filename.encode('cp437').endswith('.xml'):
+            metadata_members.append(i)
+        else:
+            members.append(i)
+
     # Expect a single metadata file
-    if len(metadata_paths) == 0:
+    if len(metadata_members) == 0:
         raise MapPackageException(_('Could not find metadata XML in zip file'))
-    metadata_file = metadata_paths[0]
 
+    metadata_file = ZipMemberStream(zip_file, metadata_members[0], limits)
+    try:
+        et = parse_metadata(metadata_file, incremental=incremental)
+    finally:
+        metadata_file.close()
+
+    return (et, members)
+
+
+def parse_metadata(metadata_file, incremental=False):
+    """
+    Read the metadata XML into a MapMetadata. With ``incremental`` the file
+    is streamed rather than loaded into a tree, for very large files.
+    """
     try:
-        et = parse(metadata_file)
+        if incremental:
+            return MapMetadata.from_file(metadata_file)
+
+        return MapMetadata.from_tree(parse(metadata_file))
     except ParseError as e:
         raise MapPackageException(_("Error parsing XML: '{0}'".format(
             e.msg.args[0])))
 
-    return (et, file_paths)
 
+def extract_members(zip_file, members, workspace, limits=None,
+                    file_hashes=None):
+    """
+    Extract members to the import's scratch workspace, returning their
+    paths.
+
+    The SHA-256 of each member is added to ``file_hashes``, if given, by
+    file name.
+    """
+    file_paths = []
+    for i in members:
+        directory = workspace.reserve(i.file_size)
+
+        member = ZipMemberStream(zip_file, i, limits)
+        full_path = os.path.join(directory, member.name)
+
+        try:
+            with open(full_path, 'wb') as outputfile:
+                sha256 = copy_and_hash(member, outputfile)
+        finally:
+            member.close()
+
+        if file_hashes is not None:
+            file_hashes[os.path.basename(full_path)] = sha256
+
+        file_paths.append(full_path)
+
+    return file_paths
+
+
+def stream_members(zip_file, members, limits=None):
+    """ Return a ZipMemberStream for each member, nothing is read yet """
+    return [ZipMemberStream(zip_file, i, limits) for i in members]
+
+
+def to_dataset(context, map_package, incremental=False, limits=None,
+               timer=None):
+    """
+    Build the dataset_info from the metadata alone.
+
+    Only the central directory and the metadata XML are read, the other
+    members are left in the zip file until extract_resources is called.
+    Each step is recorded on the StageTimer, if one is given.
+    """
+    with timed(timer, 'open_zip'):
+        zip_file = open_zip(map_package)
 
-def to_dataset(context, map_package):
-    et, file_paths = extract_zip(map_package)
-    dataset_dict = populate_dataset_dict_from_xml(et)
+    with timed(timer, 'parse_metadata') as record:
+        et, members = read_metadata(
+            zip_file, incremental=incremental, limits=limits)
+        record['bytes'] = (sum(i.file_size for i in zip_file.infolist()) -
+                           sum(i.file_size for i in members))
+
+    with timed(timer, 'populate_dataset'):
+        et = get_metadata(et)
+        dataset_dict = populate_dataset_dict_from_xml(et)
     # Not currently in the metadata
     dataset_dict['license_id'] = 'notspecified'
     dataset_info = {
         'status': get_mandatory_text_node(et, 'status'),
         'dataset_dict': dataset_dict,
-        'file_paths': file_paths,
+        'zip_file': zip_file,
+        'members': members,
+        'limits': limits,
         'name': dataset_dict['name'],
         'operation_id': get_mandatory_text_node(et, 'operationID'),
     }
@@ -140,7 +539,42 @@ def to_dataset(context, map_package):
     return dataset_info
 
 
+def extract_resources(dataset_info, stream=False, workspace=None,
+                      timer=None):
+    """
+    Extract (or open streams for) the files to upload as resources.
+
+    Called once the metadata has passed every check so that rejected
+    packages never have their binary members decompressed.
+
+    The SHA-256 of each extracted file is kept in dataset_info's
+    ``file_hashes``, by file name. Streamed members are hashed as they are
+    uploaded instead. Extracted files go in the import's scratch workspace,
+    which is required unless streaming.
+    """
+    zip_file = dataset_info['zip_file']
+    members = dataset_info['members']
+    limits = dataset_info.get('limits')
+    file_hashes = {}
+
+    if stream:
+        # Decompressed as they are uploaded, so timed there
+        file_paths = stream_members(zip_file, members, limits)
+    else:
+        with timed(timer, 'extract',
+                   sum(i.file_size for i in members)):
+            file_paths = extract_members(
+                zip_file, members, workspace, limits, file_hashes)
+
+    dataset_info['file_paths'] = file_paths
+    dataset_info['file_hashes'] = file_hashes
+
+    return file_paths
+
+
 def populate_dataset_dict_from_xml(et):
+    et = get_metadata(et)
+
     # Extract key metadata
     dataset_dict = {}
     dataset_dict['title'] = join_lines(get_text_node(et, 'title'))
@@ -161,13 +595,13 @@ def populate_dataset_dict_from_xml(et):
     dataset_dict['version'] = version_number
     dataset_dict['type'] = product_type
 
-    for theme in et.findall('.//mapdata//theme'):
-        if theme.text in PRODUCT_THEMES:
-            dataset_dict.setdefault('product_themes', []).append(theme.text)
+    for theme in et.themes:
+        if theme in PRODUCT_THEMES:
+            dataset_dict.setdefault('product_themes', []).append(theme)
         else:
             log.error(
                 "Product theme '{0}' not defined in PRODUCT_THEMES".format(
-                    theme.text))
+                    theme))
 
     summary = get_text_node(et, 'summary')
     dataset_dict['notes'] = join_lines(summary)
@@ -190,8 +624,4 @@ def get_mandatory_text_node(et, name):
 
 
 def get_text_node(et, name):
-    element = et.find('.//mapdata/{0}'.format(name))
-    if element is not None:
-        return element.text
-
-    return None
+    return get_metadata(et).get(name)
@@ -0,0 +1,138 @@
+import os
+
+import datetime
+import errno
+import json
+import logging
+import random
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+class ProfileNotFound(Exception):
+    pass
+
+
+class ProfileStore(object):
+    """
+    Directory of profiles captured from imports. Each capture is a
+    cProfile stats file, loadable with pstats, and a JSON record of the
+    import it came from.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def save(self, profiler, **info):
+        """ Dump the profiler's stats, returning the record for them """
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        profile_id = uuid.uuid4().hex
+        profiler.dump_stats(self.stats_path(profile_id))
+
+        record = dict(info, id=profile_id,
+                      created=datetime.datetime.utcnow().isoformat(),
+                      size=os.path.getsize(self.stats_path(profile_id)))
+        with open(self._record_path(profile_id), 'w') as record_file:
+            json.dump(record, record_file)
+
+        return record
+
+    def get(self, profile_id):
+        # Ids are only ever hex, don't let them escape the directory
+        if not profile_id or not all(c in '0123456789abcdef'
+                                     for c in profile_id):
+            raise ProfileNotFound(profile_id)
+
+        try:
+            with open(self._record_path(profile_id)) as record_file:
+                return json.load(record_file)
+        except (IOError, ValueError):
+            raise ProfileNotFound(profile_id)
+
+    def list(self):
+        """ Every capture, most recent first """
+        records = []
+        for profile_id in self._profile_ids():
+            try:
+                records.append(self.get(profile_id))
+            except ProfileNotFound:
+                pass
+
+        return sorted(records, key=lambda r: r['created'], reverse=True)
+
+    def sweep(self, max_age):
+        """
+        Remove captures older than max_age seconds, including any whose
+        record was never written.
+        """
+        now = time.time()
+        removed = []
+        for profile_id in self._profile_ids():
+            paths = [self.stats_path(profile_id),
+                     self._record_path(profile_id)]
+            try:
+                age = now - max(os.path.getmtime(p) for p in paths
+                                if os.path.exists(p))
+            except (OSError, ValueError):
+                continue
+
+            if age > max_age:
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                removed.append(profile_id)
+
+        if removed:
+            log.info('Removed {0} old profiles from {1}'.format(
+                len(removed), self.root))
+
+        return removed
+
+    def stats_path(self, profile_id):
+        return os.path.join(self.root, profile_id + '.prof')
+
+    def _record_path(self, profile_id):
+        return os.path.join(self.root, profile_id + '.json')
+
+    def _profile_ids(self):
+        try:
+            names = os.listdir(self.root)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+
+        return set(os.path.splitext(name)[0] for name in names
+                   if name.endswith(('.json', '.prof')))
+
+
+def profile_store_from_config(config):
+    root = config.get('ckanext.mapactionimporter.profile_dir')
+    if not root:
+        root = os.path.join(config.get('ckan.storage_path', ''),
+                            'mapactionimporter', 'profiles')
+
+    return ProfileStore(root)
+
+
+def should_profile(config, requested=False, is_sysadmin=False,
+                   sample=random.random):
+    """
+    Whether to profile an import: always when a sysadmin asks for it,
+    otherwise for the configured fraction of imports.
+    """
+    if requested and is_sysadmin:
+        return True
+
+    rate = float(config.get('ckanext.mapactionimporter.profile_sample_rate',
+                            0))
+    return rate > 0 and sample() < rate
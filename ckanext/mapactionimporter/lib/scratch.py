@@ -0,0 +1,218 @@
+import os
+
+import contextlib
+import errno
+import logging
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from ckan.common import _
+
+from ckanext.mapactionimporter.lib.mappackage import MapPackageException
+
+log = logging.getLogger(__name__)
+
+WORKSPACE_SUFFIX = '-mapactionzip'
+
+
+class ScratchSpaceExceeded(MapPackageException):
+    pass
+
+
+class ScratchSpace(object):
+    """
+    Directory holding the per-import workspaces used to extract map
+    packages.
+
+    Each workspace is removed when its import finishes, whether it succeeded
+    or not. The total size of all workspaces can be capped, and workspaces
+    left behind by workers that died mid-import are removed by sweep().
+
+    The cap counts the space reserved by every import in this process, plus
+    whatever other processes' workspaces were using when this process last
+    created one.
+    """
+    def __init__(self, root, max_bytes=0, max_age=0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._other_usage = 0
+
+    @contextlib.contextmanager
+    def workspace(self):
+        workspace = Workspace(self)
+        try:
+            yield workspace
+        finally:
+            workspace.release()
+
+    def usage(self):
+        """ Total bytes used by every workspace under the root """
+        return sum(_directory_size(path) for path in self._workspace_paths())
+
+    def reserve(self, nbytes):
+        """ Raise ScratchSpaceExceeded if nbytes more would exceed the cap """
+        with self._lock:
+            if (self.max_bytes and self._other_usage + self._reserved +
+                    nbytes > self.max_bytes):
+                raise ScratchSpaceExceeded(
+                    _('Not enough scratch space to import this map package'))
+
+            self._reserved += nbytes
+
+    def unreserve(self, nbytes):
+        with self._lock:
+            self._reserved -= nbytes
+
+    def _create_workspace(self):
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        owner = (socket.gethostname(), os.getpid())
+        other_usage = sum(_directory_size(path)
+                          for path in self._workspace_paths()
+                          if _workspace_owner(path) != owner)
+        with self._lock:
+            self._other_usage = other_usage
+
+        prefix = '{0}-{1}-'.format(*owner)
+        return tempfile.mkdtemp(WORKSPACE_SUFFIX, prefix=prefix, dir=self.root)
+
+    def sweep(self):
+        """
+        Remove workspaces whose owning process on this host has gone, and
+        any older than max_age seconds whoever owns them.
+        """
+        host = socket.gethostname()
+        now = time.time()
+        removed = []
+
+        for path in self._workspace_paths():
+            owner_host, owner_pid = _workspace_owner(path)
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+
+            orphaned = (owner_host == host and owner_pid is not None
+                        and not process_exists(owner_pid))
+            expired = self.max_age and age > self.max_age
+
+            if orphaned or expired:
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path)
+
+        if removed:
+            log.info('Removed {0} orphaned import workspaces from {1}'.format(
+                len(removed), self.root))
+
+        return removed
+
+    def _workspace_paths(self):
+        try:
+            names = os.listdir(self.root)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+
+        return [os.path.join(self.root, name) for name in names
+                if name.endswith(WORKSPACE_SUFFIX)]
+
+
+class Workspace(object):
+    """
+    Scratch directory for a single import. The directory is only created
+    when it is first used, so imports that stream their files never touch
+    the disk.
+    """
+    def __init__(self, scratch_space):
+        self.scratch_space = scratch_space
+        self.bytes_used = 0
+        self._path = None
+        self._reserved = 0
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = self.scratch_space._create_workspace()
+
+        return self._path
+
+    def reserve(self, nbytes):
+        """
+        Reserve nbytes of the scratch space for this import, returning the
+        workspace directory. Raises ScratchSpaceExceeded if that would
+        exceed the cap.
+        """
+        path = self.path
+        self.scratch_space.reserve(nbytes)
+        self._reserved += nbytes
+        return path
+
+    def release(self):
+        self.scratch_space.unreserve(self._reserved)
+        self._reserved = 0
+
+        if self._path is None:
+            return
+
+        self.bytes_used = _directory_size(self._path)
+        shutil.rmtree(self._path, ignore_errors=True)
+        log.info('Import workspace {0} used {1} bytes'.format(
+            self._path, self.bytes_used))
+        self._path = None
+
+
+def scratch_space_from_config(config):
+    root = config.get('ckanext.mapactionimporter.scratch_dir')
+    if not root:
+        root = os.path.join(tempfile.gettempdir(), 'ckanext-mapactionimporter')
+
+    return ScratchSpace(
+        root,
+        max_bytes=int(config.get(
+            'ckanext.mapactionimporter.scratch_max_bytes', 0)),
+        max_age=int(config.get(
+            'ckanext.mapactionimporter.scratch_max_age', 24 * 60 * 60)),
+    )
+
+
+def _workspace_owner(path):
+    # Workspace names are "<host>-<pid>-<random><WORKSPACE_SUFFIX>"
+    name = os.path.basename(path)[:-len(WORKSPACE_SUFFIX)]
+    try:
+        host, pid, random = name.rsplit('-', 2)
+        return (host, int(pid))
+    except ValueError:
+        return (None, None)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
+
+
+def _directory_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+
+    return size
@@ -0,0 +1,294 @@
+import os
+
+import datetime
+import errno
+import fcntl
+import json
+import logging
+import re
+import shutil
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+class UploadNotFound(Exception):
+    pass
+
+
+class UploadRangeError(Exception):
+    """ A chunk doesn't start where the upload has got to """
+    def __init__(self, session):
+        super(UploadRangeError, self).__init__(
+            'Expected a chunk starting at byte {0}'.format(
+                session['received']))
+        self.session = session
+
+
+class InvalidChunk(Exception):
+    """ A chunk isn't the length its range says, or goes past the end """
+    pass
+
+
+class UploadTooLarge(Exception):
+    """ An upload would go over the size limit of one upload or the store """
+    pass
+
+
+class UploadIncomplete(Exception):
+    pass
+
+
+class UploadStagingStore(object):
+    """
+    Directory of map packages being uploaded in chunks, so that an upload
+    that is interrupted can be resumed from the last byte received.
+
+    Each upload session has its own subdirectory holding the staged
+    package and a JSON record of the session. Chunks are appended to the
+    staged file under an exclusive lock, and only if they start exactly
+    where the file ends and are exactly as long as their range says.
+
+    ``max_size`` limits the size of any one upload, and ``max_bytes`` the
+    total size of all the staged uploads. 0 disables a limit.
+    """
+    PACKAGE_FILENAME = 'package.zip'
+    RECORD_FILENAME = 'upload.json'
+
+    # Used when neither staging_max_size nor max_uncompressed_size is set
+    DEFAULT_MAX_SIZE = 2 * 2 ** 30
+
+    def __init__(self, root, max_size=0, max_bytes=0):
+        self.root = root
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+
+    def start(self, user, size=None, filename=None):
+        self._check_size(size or 0, size or 0)
+
+        session_id = uuid.uuid4().hex
+        os.makedirs(self._session_dir(session_id))
+        open(self.package_path(session_id), 'wb').close()
+
+        now = _now()
+        session = {
+            'id': session_id,
+            'user': user,
+            'filename': filename,
+            'size': size,
+            'received': 0,
+            'created': now,
+            'updated': now,
+        }
+        self._write(session)
+
+        return session
+
+    def get(self, session_id):
+        if not _is_id(session_id):
+            raise UploadNotFound(session_id)
+
+        try:
+            with open(self._record_path(session_id)) as record_file:
+                return json.load(record_file)
+        except (IOError, ValueError):
+            raise UploadNotFound(session_id)
+
+    def append(self, session_id, first, last, data_file, total=None,
+               chunk_size=2 ** 20):
+        """
+        Append the chunk read from data_file, which is bytes ``first`` to
+        ``last`` of the package. Returns the updated session.
+
+        A chunk that isn't that long is discarded, so the upload resumes
+        from ``first``.
+        """
+        length = last - first + 1
+        session = self.get(session_id)
+
+        with open(self.package_path(session_id), 'ab') as package_file:
+            fcntl.flock(package_file, fcntl.LOCK_EX)
+            try:
+                # Re-read under the lock, another chunk may have landed
+                session = self.get(session_id)
+                if total is not None:
+                    if session['size'] is None:
+                        session['size'] = total
+                    elif session['size'] != total:
+                        raise UploadRangeError(session)
+
+                package_file.seek(0, os.SEEK_END)
+                if first != package_file.tell():
+                    raise UploadRangeError(session)
+
+                if session['size'] is not None and last >= session['size']:
+                    raise InvalidChunk(
+                        'Chunk ends at byte {0}, past the end of the {1} '
+                        'byte upload'.format(last, session['size']))
+
+                self._check_size(max(last + 1, session['size'] or 0),
+                                 length)
+                self._write_chunk(package_file, data_file, first, length,
+                                  chunk_size)
+
+                package_file.flush()
+                session['received'] = package_file.tell()
+                session['updated'] = _now()
+                self._write(session)
+            finally:
+                fcntl.flock(package_file, fcntl.LOCK_UN)
+
+        return session
+
+    def usage(self):
+        """ Total size in bytes of the staged uploads """
+        usage = 0
+        for name in _listdir(self.root):
+            try:
+                usage += os.path.getsize(self.package_path(name))
+            except OSError:
+                continue
+
+        return usage
+
+    def complete(self, session_id):
+        """
+        Return the path of the staged package once every byte has arrived.
+        """
+        session = self.get(session_id)
+        if session['size'] is None or session['received'] != session['size']:
+            raise UploadIncomplete(session_id)
+
+        return self.package_path(session_id)
+
+    def discard(self, session_id):
+        if _is_id(session_id):
+            shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def sweep(self, max_age):
+        """ Remove sessions not added to for max_age seconds """
+        names = _listdir(self.root)
+
+        now = time.time()
+        removed = []
+        for name in names:
+            path = self._record_path(name)
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+
+            if age > max_age:
+                self.discard(name)
+                removed.append(name)
+
+        if removed:
+            log.info('Removed {0} abandoned uploads from {1}'.format(
+                len(removed), self.root))
+
+        return removed
+
+    def _check_size(self, size, nbytes):
+        """ Check that an upload of size bytes can grow by nbytes """
+        if self.max_size and size > self.max_size:
+            raise UploadTooLarge(
+                'Uploads can be at most {0} bytes'.format(self.max_size))
+
+        if self.max_bytes and self.usage() + nbytes > self.max_bytes:
+            raise UploadTooLarge('Not enough space to stage this upload')
+
+    def _write_chunk(self, package_file, data_file, first, length,
+                     chunk_size):
+        written = 0
+        while written <= length:
+            # Read one byte past the end to spot a chunk that's too long
+            data = data_file.read(min(chunk_size, length - written + 1))
+            if not data:
+                break
+            written += len(data)
+            if written <= length:
+                package_file.write(data)
+
+        if written != length:
+            package_file.truncate(first)
+            raise InvalidChunk(
+                'Chunk is {0} bytes, its range is {1} bytes'.format(
+                    written, length))
+
+    def package_path(self, session_id):
+        return os.path.join(self._session_dir(session_id),
+                            self.PACKAGE_FILENAME)
+
+    def _session_dir(self, session_id):
+        return os.path.join(self.root, session_id)
+
+    def _record_path(self, session_id):
+        return os.path.join(self._session_dir(session_id),
+                            self.RECORD_FILENAME)
+
+    def _write(self, session):
+        # Write then rename so readers never see a partial record
+        record_path = self._record_path(session['id'])
+        tmp_path = record_path + '.tmp'
+        with open(tmp_path, 'w') as record_file:
+            json.dump(session, record_file)
+        os.rename(tmp_path, record_path)
+
+
+def parse_content_range(header):
+    """
+    Parse a "bytes <first>-<last>/<total>" Content-Range header, returning
+    (first, last, total). total is None when given as "*".
+    """
+    match = CONTENT_RANGE.match((header or '').strip())
+    if match is None:
+        raise ValueError(header)
+
+    first, last = int(match.group(1)), int(match.group(2))
+    total = None if match.group(3) == '*' else int(match.group(3))
+    if last < first or (total is not None and last >= total):
+        raise ValueError(header)
+
+    return (first, last, total)
+
+
+def staging_store_from_config(config):
+    root = config.get('ckanext.mapactionimporter.staging_dir')
+    if not root:
+        root = os.path.join(config.get('ckan.storage_path', ''),
+                            'mapactionimporter', 'staging')
+
+    max_size = config.get('ckanext.mapactionimporter.staging_max_size')
+    if max_size is None:
+        # A package can't usefully be larger than what it may decompress to
+        max_size = (int(config.get(
+            'ckanext.mapactionimporter.max_uncompressed_size', 0)) or
+            UploadStagingStore.DEFAULT_MAX_SIZE)
+
+    return UploadStagingStore(
+        root,
+        max_size=int(max_size),
+        max_bytes=int(config.get(
+            'ckanext.mapactionimporter.staging_max_bytes', 0)),
+    )
+
+
+def _is_id(session_id):
+    return bool(session_id) and all(c in '0123456789abcdef'
+                                    for c in session_id)
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat()
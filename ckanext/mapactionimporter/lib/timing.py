@@ -0,0 +1,55 @@
+import contextlib
+import threading
+import time
+
+
+class StageTimer(object):
+    """
+    Records the wall time and bytes processed by each stage of an import,
+    in the order the stages finished. Stages may be timed from several
+    threads at once, e.g. concurrent uploads.
+    """
+    def __init__(self, clock=time.time):
+        self.stages = []
+        self._clock = clock
+        self._start = clock()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, nbytes=0, item=None):
+        """
+        Time the enclosed block as stage ``name``. The record is yielded so
+        that the block can set 'bytes' once it knows them.
+        """
+        record = {'stage': name, 'bytes': nbytes}
+        if item is not None:
+            record['item'] = item
+
+        start = self._clock()
+        try:
+            yield record
+        finally:
+            record['seconds'] = self._clock() - start
+            with self._lock:
+                self.stages.append(record)
+
+    def as_dict(self):
+        with self._lock:
+            stages = [dict(s) for s in self.stages]
+
+        return {
+            'total_seconds': self._clock() - self._start,
+            'total_bytes': sum(s['bytes'] for s in stages),
+            'stages': stages,
+        }
+
+
+@contextlib.contextmanager
+def timed(timer, name, nbytes=0, item=None):
+    """ timer.stage(), or a record that goes nowhere if timer is None """
+    if timer is None:
+        yield {'stage': name, 'bytes': nbytes}
+        return
+
+    with timer.stage(name, nbytes, item) as record:
+        yield record
@@ -0,0 +1,75 @@
+import logging
+
+import ckan.plugins.toolkit as toolkit
+
+log = logging.getLogger(__name__)
+
+
+def sync_vocabulary(context, name, tags, dry_run=False):
+    """
+    Make the vocabulary ``name`` hold exactly ``tags``, creating it if it
+    doesn't exist.
+
+    The differences are worked out once and applied in a single
+    transaction. Returns what changed (or, with ``dry_run``, what would
+    change) as a dict with the keys 'vocabulary', 'created', 'added' and
+    'removed'.
+    """
+    model = context['model']
+    session = context['session']
+
+    vocab = model.Vocabulary.get(name)
+    toolkit.check_access(
+        'vocabulary_create' if vocab is None else 'vocabulary_update',
+        context, {'name': name})
+
+    existing = dict((t.name, t) for t in vocab.tags) if vocab else {}
+    wanted = set(tags)
+    added = sorted(wanted - set(existing))
+    removed = sorted(set(existing) - wanted)
+
+    report = {
+        'vocabulary': name,
+        'created': vocab is None,
+        'added': added,
+        'removed': removed,
+    }
+
+    if dry_run or not (vocab is None or added or removed):
+        return report
+
+    for tag_name in added:
+        _validate_tag_name(context, tag_name)
+
+    try:
+        if vocab is None:
+            vocab = model.Vocabulary(name)
+            session.add(vocab)
+            session.flush()
+
+        for tag_name in added:
+            session.add(model.Tag(name=tag_name, vocabulary_id=vocab.id))
+
+        for tag_name in removed:
+            # Also removes the tag from any datasets
+            session.delete(existing[tag_name])
+
+        model.repo.commit()
+    except:
+        session.rollback()
+        raise
+
+    log.info('Vocabulary {0}: added {1}, removed {2}'.format(
+        name, added, removed))
+
+    return report
+
+
+def _validate_tag_name(context, tag_name):
+    # As tag_create would
+    for validator in ('tag_length_validator', 'tag_name_validator'):
+        try:
+            toolkit.get_validator(validator)(tag_name, context)
+        except toolkit.Invalid as e:
+            raise toolkit.ValidationError({'name': [
+                u'{0}: {1}'.format(tag_name, e.error)]})
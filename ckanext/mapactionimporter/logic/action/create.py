@@ -1,15 +1,40 @@
 import os
 import cgi
-import uuid
+import collections
+import cProfile
+import copy
+import functools
+import json
+import logging
+import threading
 
 from ckan.common import _
+import ckan.authz as authz
 import ckan.logic as logic
+import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
 import ckan.lib.plugins as lib_plugins
+import ckan.lib.uploader as uploader
 import ckanext.scheming.helpers as scheming_helpers
 
-from ckanext.mapactionimporter.lib import mappackage
+from ckanext.mapactionimporter.lib import (
+    activities,
+    blobs,
+    bulk,
+    cache,
+    concurrency,
+    hashes,
+    indexing,
+    jobs,
+    mappackage,
+    profiling,
+    scratch,
+    staging,
+    timing,
+)
+
+log = logging.getLogger(__name__)
 
 
 ## MapAction Zipfile importer
@@ -18,10 +43,11 @@ from ckanext.mapactionimporter.lib import mappackage
 #
 # Achieve this in a multiple step process:
 #
-# 1. Zip file extraction and validation.
+# 1. Zip file central directory and metadata validation.
 #
 #   Implementated by:
-#   - map_package.extract_zip()
+#   - map_package.open_zip()
+#   - map_package.read_metadata()
 #
 #   Validates:
 #   - The zipfile contain a well formed metadata XML.
@@ -31,14 +57,21 @@ from ckanext.mapactionimporter.lib import mappackage
 #   Implementated by:
 #   - map_package.to_dataset()
 #   - Calls:
-#   -- map_package.extract_zip()
+#   -- map_package.open_zip()
+#   -- map_package.read_metadata()
 #   -- map_package.populate_dataset_dict_from_xml()
 #
 # 3. Transform Python representation into CKAN compatable dataset.
 #
 #   - requires knowledge of CKAN schemas
 #   - transform python repr of MA metadata into dataset, using schema def.
-#   - validate schema
+#
+# 4. Check the status against existing datasets and that the operation
+#    exists. A new dataset is validated once here, with
+#    validate_new_dataset(), and package_create reuses the result; a
+#    correction or update is validated with validate_dataset_update(). Only
+#    once all of that passes are the other files extracted (or streamed)
+#    with map_package.extract_resources().
 #
 # CKAN Actions:
 #
@@ -50,43 +83,44 @@ from ckanext.mapactionimporter.lib import mappackage
 #
 ###
 
+# Package plugin, create schema and scheming dataset fields for each package
+# type. These only change when plugins are loaded or the config is reloaded,
+# when clear_schema_cache() is called.
+_schema_cache = {}
+
+# Key for datasets that don't give a type
+_NO_TYPE = object()
+
+
+def clear_schema_cache():
+    _schema_cache.clear()
+
+
+# Whether each operation (event or country group) exists, by name or id.
+# Cleared by the plugin whenever a group is created, changed or deleted.
+operation_cache = cache.TTLCache()
+
+
+def configure_operation_cache(config):
+    operation_cache.max_size = toolkit.asint(config.get(
+        'ckanext.mapactionimporter.operation_cache_size', 1000))
+    operation_cache.ttl = toolkit.asint(config.get(
+        'ckanext.mapactionimporter.operation_cache_ttl', 300))
+    operation_cache.clear()
+
+
 def transform_for_schema(context, dataset_info):
     """
         Transforms dataset_info structure for the given schema:
             extras in schema should become first class values
     """
     data_dict = dataset_info['dataset_dict']
-    schema = None
-
-    # Schema lookup from ckan.logic.action.create:package_create()
-    if 'type' not in data_dict:
-        package_plugin = lib_plugins.lookup_package_plugin()
-        try:
-            # use first type as default if user didn't provide type
-            package_type = package_plugin.package_types()[0]
-        except (AttributeError, IndexError):
-            package_type = 'dataset'
-            # in case a 'dataset' plugin was registered w/o fallback
-            package_plugin = lib_plugins.lookup_package_plugin(package_type)
-        data_dict['type'] = package_type
-    else:
-        package_plugin = lib_plugins.lookup_package_plugin(data_dict['type'])
 
-    if 'schema' in context:
-        schema = context['schema']
-    else:
-        schema = package_plugin.create_package_schema()
-
-    # The scheming extension doesn't implement the internal CKAN's
-    # create_package_schema methods, it only builds the scheming schema at
-    # validation time.
-    #
-    # create_package_schema doesn't get us a full scheming schema, so we get the
-    # schema manually and promote fields from exists if they are defined:
-    scheming_schema = scheming_helpers.scheming_get_dataset_schema(data_dict['type'])
-    if scheming_schema:
-        schema_dataset_fields = set(f['field_name'] for f in scheming_schema['dataset_fields'])
+    package_type, package_plugin, schema, schema_dataset_fields = \
+        _schema_for_type(data_dict.get('type', _NO_TYPE))
+    data_dict['type'] = package_type
 
+    if schema_dataset_fields is not None:
         new_extras = []
         # promote extras defined in the schema to dataset fields
         for i, extra in enumerate(data_dict['extras']):
@@ -103,163 +137,1079 @@ def transform_for_schema(context, dataset_info):
 
         data_dict['extras'] = new_extras
 
-    data, errors = lib_plugins.plugin_validate(
-            package_plugin, context, data_dict, schema, 'package_create')
-
     # Replace data_dict with new version
     dataset_info.update(dataset_dict=data_dict)
 
     return dataset_info
 
 
+def validate_new_dataset(context, data_dict, dataset_info):
+    """
+    Set the owner and visibility of a new dataset and validate it as
+    package_create would, raising a ValidationError before anything is
+    written.
+
+    The validated dict is kept in dataset_info so that package_create can
+    use it rather than validating the same dict again.
+    """
+    dataset_dict = dataset_info['dataset_dict']
+
+    owner_org = data_dict.get('owner_org')
+    if owner_org:
+        dataset_dict['owner_org'] = owner_org
+        dataset_dict['private'] = data_dict.get('private', True)
+    else:
+        dataset_dict['private'] = False
+
+    dataset_dict['groups'] = [{'name': dataset_info['operation_id']}]
+
+    package_type, package_plugin, schema, schema_dataset_fields = \
+        _schema_for_type(dataset_dict['type'])
+    if 'schema' in context:
+        schema = context['schema']
+
+    data, errors = lib_plugins.plugin_validate(
+        package_plugin, _get_context(context), dataset_dict, schema,
+        'package_create')
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    dataset_info['validated_dict'] = data
+
+    return data
+
+
+def validate_dataset_update(context, old_dataset, dataset_info):
+    """
+    Validate the existing dataset with the metadata of the package as
+    package_update would, raising a ValidationError before any of its
+    resources are uploaded or deleted.
+    """
+    dataset_dict = copy.deepcopy(old_dataset)
+    dataset_dict.update(dataset_info['dataset_dict'])
+
+    package_type, package_plugin, schema, schema_dataset_fields = \
+        _schema_for_type(dataset_dict['type'])
+    schema = context.get('schema') or package_plugin.update_package_schema()
+
+    # As package_update, so that the dataset's own name isn't taken to be
+    # in use
+    validate_context = _get_context(context)
+    validate_context['package'] = context['model'].Package.get(
+        old_dataset['id'])
+
+    data, errors = lib_plugins.plugin_validate(
+        package_plugin, validate_context, dataset_dict, schema,
+        'package_update')
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    return data
+
+
+def prevalidated(context, data_dict, action):
+    """
+    Return the dict validated by validate_new_dataset() and no errors, as
+    IDatasetForm.validate() does, if it is for this package_create call,
+    otherwise None.
+    """
+    validated = context.get('mapactionimporter_validated')
+    if (action != 'package_create' or validated is None or
+            validated.get('name') != data_dict.get('name')):
+        return None
+
+    return (copy.deepcopy(validated), {})
+
+
+def _schema_for_type(package_type):
+    """
+    Return the package type to use, its plugin, create schema and the names
+    of the scheming dataset fields (None without a scheming schema).
+    """
+    try:
+        return _schema_cache[package_type]
+    except KeyError:
+        pass
+
+    # Schema lookup from ckan.logic.action.create:package_create()
+    if package_type is _NO_TYPE:
+        package_plugin = lib_plugins.lookup_package_plugin()
+        try:
+            # use first type as default if user didn't provide type
+            resolved_type = package_plugin.package_types()[0]
+        except (AttributeError, IndexError):
+            resolved_type = 'dataset'
+            # in case a 'dataset' plugin was registered w/o fallback
+            package_plugin = lib_plugins.lookup_package_plugin(resolved_type)
+    else:
+        resolved_type = package_type
+        package_plugin = lib_plugins.lookup_package_plugin(package_type)
+
+    schema = package_plugin.create_package_schema()
+
+    # The scheming extension doesn't implement the internal CKAN's
+    # create_package_schema methods, it only builds the scheming schema at
+    # validation time.
+    #
+    # create_package_schema doesn't get us a full scheming schema, so we get the
+    # schema manually and promote fields from exists if they are defined:
+    schema_dataset_fields = None
+    scheming_schema = scheming_helpers.scheming_get_dataset_schema(resolved_type)
+    if scheming_schema:
+        schema_dataset_fields = frozenset(
+            f['field_name'] for f in scheming_schema['dataset_fields'])
+
+    entry = (resolved_type, package_plugin, schema, schema_dataset_fields)
+    _schema_cache[package_type] = entry
+
+    return entry
+
 
 def create_dataset_from_zip(context, data_dict):
+    if data_dict.get('staged_upload'):
+        return _import_staged_upload(context, data_dict)
+
     upload = data_dict.get('upload')
     if not _upload_attribute_is_valid(upload):
         msg = {'upload': [_('You must select a file to be imported')]}
         raise toolkit.ValidationError(msg)
 
-    # Build and validate dataset from upload
+    if _run_in_background(data_dict):
+        return _queue_import(context, data_dict, upload)
+
+    timer = timing.StageTimer()
+    context['mapactionimporter_timer'] = timer
+    profiler = _start_profiler(context, data_dict)
     try:
-        dataset_info = mappackage.to_dataset(context, upload.file)
-        # transform dataset_info for schema.
-        dataset_info = transform_for_schema(context, dataset_info)
+        # Every step of the import would otherwise reindex the dataset
+        with indexing.deferred():
+            dataset = _import(context, data_dict, upload, timer)
+    except Exception as e:
+        _finish_profiler(context, profiler, timer, type(e).__name__)
+        _log_timings(timer, outcome=type(e).__name__)
+        raise
+
+    _finish_profiler(context, profiler, timer, 'success', dataset['name'])
+    _log_timings(timer, outcome='success', name=dataset['name'])
+    if toolkit.asbool(data_dict.get('debug', False)):
+        dataset['import_timings'] = timer.as_dict()
+
+    return dataset
+
+
+def _import(context, data_dict, upload, timer):
+    # An exact copy of a package that has already been imported gets the
+    # dataset it was imported as, without going any further. A queued or
+    # staged package was hashed as it was copied; a direct upload is hashed
+    # on another thread while its metadata is read.
+    sha256 = context.get('mapactionimporter_sha256')
+    if sha256 is not None:
+        duplicate = _find_duplicate(context, sha256)
+        if duplicate is not None:
+            return duplicate
+        hashing = None
+    else:
+        hashing = hashes.BackgroundHash(upload.file)
+
+    try:
+        dataset_info = _read_package(context, upload.file, timer)
+    finally:
+        if hashing is not None:
+            with timing.timed(timer, 'hash', hashing.size):
+                sha256 = hashing.result()
+
+    if hashing is not None:
+        duplicate = _find_duplicate(context, sha256)
+        if duplicate is not None:
+            return duplicate
+
+    old_dataset = _check_dataset(
+        context, data_dict, dataset_info, timer, sha256)
+
+    # Extracted files are removed when the import finishes, whatever happens
+    scratch_space = scratch.scratch_space_from_config(toolkit.config)
+    with scratch_space.workspace() as workspace:
+        # Only now that the metadata has passed do we touch the other files
+        _report_progress(context, 'extracting')
+        try:
+            mappackage.extract_resources(
+                dataset_info, stream=_stream_uploads(), workspace=workspace,
+                timer=timer)
+        except (mappackage.MapPackageException) as e:
+            msg = {'upload': [e.args[0]]}
+            raise toolkit.ValidationError(msg)
+
+        # Update or Create dataset, as one activity rather than one for
+        # every resource and step along the way
+        collapse = activities.collapse_enabled(toolkit.config)
+        with activities.suppressed(dataset_info['name'], collapse):
+            if old_dataset is not None:
+                dataset = _update_dataset(context, old_dataset, dataset_info)
+            else:
+                dataset = _create_dataset(context, data_dict, dataset_info)
+
+    if collapse:
+        _create_import_activity(context, dataset_info, dataset,
+                                created=old_dataset is None)
+
+    hashes.hash_index_from_config(toolkit.config).add(sha256, dataset['id'])
+
+    return dataset
+
+
+def _create_import_activity(context, dataset_info, dataset, created):
+    # As CKAN itself records no activities for private datasets, nor for
+    # changes made by no one in particular
+    user = context['model'].User.get(context.get('user') or '')
+    if dataset.get('private') or user is None:
+        return
+
+    package = dict(dataset)
+    package.pop('resource_changes', None)
+
+    activity_context = _get_context(context)
+    activity_context['ignore_auth'] = True
+    with timing.timed(_timer(context), 'activity'):
+        toolkit.get_action('activity_create')(activity_context, {
+            'user_id': user.id,
+            'object_id': dataset['id'],
+            'activity_type': 'new package' if created else 'changed package',
+            'data': {
+                'package': package,
+                'import': activities.import_summary(dataset_info, dataset),
+            },
+        })
+
+
+def _read_package(context, package_file, timer):
+    """ Build the dataset_info from the metadata alone """
+    _report_progress(context, 'reading_metadata')
+    try:
+        return mappackage.to_dataset(
+            context, package_file, incremental=_incremental_metadata(),
+            limits=mappackage.PackageLimits.from_config(toolkit.config),
+            timer=timer)
     except (mappackage.MapPackageException) as e:
         msg = {'upload': [e.args[0]]}
         raise toolkit.ValidationError(msg)
 
-    # Update or Create dataset
+
+def _check_dataset(context, data_dict, dataset_info, timer, sha256=None):
+    """
+    Transform and validate the dataset read from the metadata, and check it
+    against any existing dataset and its operation.
+
+    Returns the existing dataset, or None if this is a new one.
+    """
+    if sha256 is not None:
+        dataset_info['dataset_dict']['extras'].append(
+            {'key': hashes.HASH_EXTRA, 'value': sha256})
+    # transform dataset_info for schema.
     try:
-        old_dataset = toolkit.get_action('package_show')(
-            _get_context(context), {'id': dataset_info['name']})
+        with timing.timed(timer, 'transform_for_schema'):
+            dataset_info = transform_for_schema(context, dataset_info)
+    except (mappackage.MapPackageException) as e:
+        msg = {'upload': [e.args[0]]}
+        raise toolkit.ValidationError(msg)
 
-        if dataset_info['status'] in ('New', 'Update'):
-            msg = {'upload': [_("Status is '{status}' but dataset '{name}' already exists").format(
-                status=dataset_info['status'], name=dataset_info['name'])]}
-            raise toolkit.ValidationError(msg)
+    _report_progress(context, 'checking')
+    with timing.timed(timer, 'check_status'):
+        old_dataset = _check_status(context, dataset_info)
+    if old_dataset is None:
+        with timing.timed(timer, 'check_operation'):
+            _check_operation_exists(context, dataset_info['operation_id'])
+        with timing.timed(timer, 'validate'):
+            validate_new_dataset(context, data_dict, dataset_info)
+    else:
+        with timing.timed(timer, 'validate'):
+            validate_dataset_update(context, old_dataset, dataset_info)
+
+    return old_dataset
+
+
+def validate_zip(context, data_dict):
+    """
+    Check a map package as create_dataset_from_mapaction_zip would, without
+    importing it. Only the central directory and the metadata are read;
+    nothing is extracted or written.
+
+    Raises a ValidationError for anything the import would reject, or
+    returns the dataset that would be created or updated and a manifest of
+    the files that would become its resources.
+    """
+    toolkit.check_access('package_create', _get_context(context))
+
+    if data_dict.get('staged_upload'):
+        store = staging.staging_store_from_config(toolkit.config)
+        path = _staged_upload_path(context, store, data_dict['staged_upload'])
+        with open(path, 'rb') as package_file:
+            return _validate_package(context, data_dict, package_file)
+
+    upload = data_dict.get('upload')
+    if not _upload_attribute_is_valid(upload):
+        msg = {'upload': [_('You must select a file to be imported')]}
+        raise toolkit.ValidationError(msg)
+
+    return _validate_package(context, data_dict, upload.file)
+
+
+def _validate_package(context, data_dict, package_file):
+    dataset_info = _read_package(context, package_file, None)
+    old_dataset = _check_dataset(context, data_dict, dataset_info, None)
+
+    dataset_dict = dataset_info['dataset_dict']
+    if old_dataset is not None:
+        dataset_dict = dict(old_dataset, **dataset_dict)
+        dataset_dict.pop('resources', None)
 
-        return _update_dataset(context, old_dataset, dataset_info)
+    return {
+        'action': 'create' if old_dataset is None else 'update',
+        'status': dataset_info['status'],
+        'operation_id': dataset_info['operation_id'],
+        'dataset': dataset_dict,
+        'resources': [{
+            'name': os.path.basename(i.filename.encode('cp437')),
+            'size': i.file_size,
+            'compressed_size': i.compress_size,
+        } for i in dataset_info['members']],
+    }
+
+
+def _find_duplicate(context, sha256):
+    """
+    Return the dataset an identical package was imported as, if it still
+    exists and hasn't since been replaced by a correction.
+    """
+    index = hashes.hash_index_from_config(toolkit.config)
+    dataset_id = index.get(sha256)
+    if dataset_id is None:
+        return None
+
+    try:
+        dataset = toolkit.get_action('package_show')(
+            _get_context(context), {'id': dataset_id})
+    except logic.NotFound:
+        index.remove(sha256)
+        return None
+    except toolkit.NotAuthorized:
+        # Let the import fail as it would have without the index
+        return None
+
+    if (dataset.get('state') != 'active' or
+            hashes.dataset_hash(dataset) != sha256):
+        return None
+
+    log.info('Package {0} already imported as {1}'.format(
+        sha256, dataset['name']))
+    return dataset
+
+
+def _start_profiler(context, data_dict):
+    if not profiling.should_profile(
+            toolkit.config,
+            requested=toolkit.asbool(data_dict.get('profile', False)),
+            is_sysadmin=authz.is_sysadmin(context.get('user'))):
+        return None
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _finish_profiler(context, profiler, timer, outcome, name=None):
+    if profiler is None:
+        return
+
+    profiler.disable()
+    store = profiling.profile_store_from_config(toolkit.config)
+    try:
+        record = store.save(
+            profiler,
+            user=context.get('user'),
+            job_id=context.get('mapactionimporter_job_id'),
+            name=name,
+            outcome=outcome,
+            total_seconds=timer.as_dict()['total_seconds'])
+    except (IOError, OSError):
+        # Never fail an import because its profile couldn't be saved
+        log.exception('Failed to save import profile')
+        return
+
+    log.info('Saved import profile {0}'.format(record['id']))
+
+
+def _import_staged_upload(context, data_dict):
+    """
+    Import a package uploaded in chunks, in place. The staged file is
+    removed once the import succeeds, or moved into the job queue.
+    """
+    session_id = data_dict['staged_upload']
+    store = staging.staging_store_from_config(toolkit.config)
+    path = _staged_upload_path(context, store, session_id)
+
+    data_dict = dict(data_dict)
+    del data_dict['staged_upload']
+
+    if _run_in_background(data_dict):
+        toolkit.check_access('package_create', context)
+        job = jobs.job_store_from_config(toolkit.config).create_from_path(
+            path, context['user'], _job_params(data_dict))
+        store.discard(session_id)
+        return {'job_id': job['id'], 'status': job['status']}
+
+    with open(path, 'rb') as package_file:
+        data_dict['upload'] = bulk.FileUpload(package_file)
+        dataset = create_dataset_from_zip(context, data_dict)
+
+    # Kept if the import failed, so that it can be retried without
+    # uploading it again
+    store.discard(session_id)
+    return dataset
+
+
+def _staged_upload_path(context, store, session_id):
+    """ Path of the user's staged package, once every byte has arrived """
+    try:
+        session = store.get(session_id)
+        if session['user'] != context['user']:
+            raise staging.UploadNotFound(session_id)
+        return store.complete(session_id)
+    except staging.UploadNotFound:
+        raise toolkit.ValidationError(
+            {'staged_upload': [_('Upload not found')]})
+    except staging.UploadIncomplete:
+        raise toolkit.ValidationError(
+            {'staged_upload': [_('Upload is not complete')]})
+
+
+def create_datasets_from_zips(context, data_dict):
+    """
+    Import several map packages in one call, given as repeated ``upload``
+    fields and/or ``staged_upload`` ids, returning a result for each in the
+    order given. Any other parameters, e.g. owner_org, apply to them all.
+
+    Versions of the same map are imported one after another, in the order
+    given, and different maps side by side on up to batch_workers threads.
+    A failed import doesn't stop the others unless ``stop_on_error`` is set,
+    in which case nothing more is started and the packages not yet
+    imported are reported as skipped.
+    """
+    items = ([{'upload': u} for u in _as_list(data_dict.get('upload'))] +
+             [{'staged_upload': s}
+              for s in _as_list(data_dict.get('staged_upload'))])
+    if not items or not all(_upload_attribute_is_valid(i['upload'])
+                            for i in items if 'upload' in i):
+        msg = {'upload': [_('You must select a file to be imported')]}
+        raise toolkit.ValidationError(msg)
+
+    # Checked once for the whole batch rather than per package
+    toolkit.check_access('package_create', _get_context(context))
+
+    params = dict((k, v) for k, v in data_dict.items()
+                  if k not in ('upload', 'staged_upload', 'stop_on_error'))
+    stop_on_error = toolkit.asbool(data_dict.get('stop_on_error', False))
+    stopped = threading.Event()
+
+    workers = _batch_workers()
+    if workers > 1:
+        groups = _plan_batch(context, items)
+    else:
+        groups = [list(enumerate(items))]
+    concurrent = workers > 1 and len(groups) > 1
+
+    def import_group(group):
+        results = []
+        try:
+            with indexing.deferred(index_batch):
+                for index, item in group:
+                    if stopped.is_set():
+                        results.append(_batch_result(index, item, 'skipped'))
+                        continue
+
+                    result = _import_batch_item(context, params, index, item)
+                    if result['status'] == 'error' and stop_on_error:
+                        stopped.set()
+                    results.append(result)
+        finally:
+            if concurrent:
+                # Return this thread's database connection to the pool
+                model.Session.remove()
+
+        return results
+
+    # Every package in the batch is indexed once, at the end
+    results = []
+    with indexing.deferred() as index_batch:
+        for group_results in concurrency.map_bounded(
+                import_group, groups, workers):
+            results.extend(group_results)
+
+    return sorted(results, key=lambda r: r['index'])
+
+
+def _plan_batch(context, items):
+    """
+    Group the batch by map, keeping the order given within each group, so
+    that each map's versions are imported in turn. Packages whose metadata
+    can't be read are left on their own to fail as usual.
+    """
+    store = staging.staging_store_from_config(toolkit.config)
+    groups = collections.OrderedDict()
+    for index, item in enumerate(items):
+        key = None
+        if 'upload' in item:
+            key = bulk.package_key(item['upload'].file)
+        else:
+            try:
+                path = _staged_upload_path(
+                    context, store, item['staged_upload'])
+                with open(path, 'rb') as package_file:
+                    key = bulk.package_key(package_file)
+            except (toolkit.ValidationError, IOError):
+                pass
+
+        map_key = key[0] if key is not None else ('item', index)
+        groups.setdefault(map_key, []).append((index, item))
+
+    return groups.values()
+
+
+def _import_batch_item(context, params, index, item):
+    # Each import gets its own copy of the context, as it adds to it
+    item_dict = dict(params, **item)
+    try:
+        result = create_dataset_from_zip(dict(context), item_dict)
+    except toolkit.ValidationError as e:
+        model.Session.rollback()
+        return _batch_result(index, item, 'error', error=e.error_summary)
+    except Exception as e:
+        log.exception('Failed to import package {0} of batch'.format(index))
+        model.Session.rollback()
+        return _batch_result(index, item, 'error',
+                             error={_('Import'): unicode(e)})
+
+    return _batch_result(index, item, 'success', result=result)
+
+
+def _batch_result(index, item, status, result=None, error=None):
+    if 'upload' in item:
+        source = {'filename': getattr(item['upload'], 'filename', None)}
+    else:
+        source = {'staged_upload': item['staged_upload']}
+
+    return dict(source, index=index, status=status, result=result,
+                error=error)
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+
+    return [value]
+
+
+def _log_timings(timer, **fields):
+    timings = dict(timer.as_dict(), **fields)
+    log.info('Map package import timings: {0}'.format(
+        json.dumps(timings, sort_keys=True)),
+        extra={'import_timings': timings})
+
+
+def run_import_job(store, job):
+    """
+    Run a queued import as the user who queued it, recording its progress
+    and outcome in the job store.
+    """
+    def progress(stage):
+        store.update(job['id'], stage=stage)
+
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': job['user'],
+        'mapactionimporter_progress': progress,
+        'mapactionimporter_job_id': job['id'],
+        'mapactionimporter_sha256': job.get('sha256'),
+    }
+    data_dict = dict(job['params'], background=False)
+
+    try:
+        with open(store.package_path(job['id']), 'rb') as package_file:
+            data_dict['upload'] = bulk.FileUpload(package_file)
+            dataset = create_dataset_from_zip(context, data_dict)
+    except toolkit.ValidationError as e:
+        return store.finish(job['id'], status=jobs.ERROR,
+                            error=e.error_summary)
+    except Exception as e:
+        log.exception('Import job {0} failed'.format(job['id']))
+        return store.finish(job['id'], status=jobs.ERROR,
+                            error={_('Import'): unicode(e)})
+
+    return store.finish(job['id'], status=jobs.COMPLETE, stage='complete',
+                        result={'id': dataset['id'], 'name': dataset['name']})
+
+
+def _queue_import(context, data_dict, upload):
+    toolkit.check_access('package_create', context)
+
+    job = jobs.job_store_from_config(toolkit.config).create(
+        upload.file, context['user'], _job_params(data_dict))
+
+    return {'job_id': job['id'], 'status': job['status']}
+
+
+def _job_params(data_dict):
+    return dict((k, data_dict[k])
+                for k in ('owner_org', 'private', 'profile')
+                if k in data_dict)
+
+
+def _run_in_background(data_dict):
+    default = toolkit.config.get(
+        'ckanext.mapactionimporter.background_imports', False)
+
+    return toolkit.asbool(data_dict.get('background', default))
+
+
+def _timer(context):
+    return context.get('mapactionimporter_timer')
+
+
+def _report_progress(context, stage):
+    progress = context.get('mapactionimporter_progress')
+    if progress is not None:
+        progress(stage)
+
+
+def _check_status(context, dataset_info):
+    """
+    Check the status in the metadata against any existing dataset.
+
+    Returns the existing dataset, or None if this is a new one.
+    """
+    try:
+        old_dataset = toolkit.get_action('package_show')(
+            _get_context(context), {'id': dataset_info['name']})
     except logic.NotFound:
         if dataset_info['status'] == 'Correction':
             msg = {'upload': [_("Status is '{status}' but dataset '{name}' does not exist").format(
                 status=dataset_info['status'], name=dataset_info['name'])]}
             raise toolkit.ValidationError(msg)
 
-        return _create_dataset(context, data_dict, dataset_info)
+        return None
+
+    if dataset_info['status'] in ('New', 'Update'):
+        msg = {'upload': [_("Status is '{status}' but dataset '{name}' already exists").format(
+            status=dataset_info['status'], name=dataset_info['name'])]}
+        raise toolkit.ValidationError(msg)
+
+    return old_dataset
+
+
+def _check_operation_exists(context, operation_id):
+    if not _operation_exists(context, operation_id):
+        msg = {'upload': [
+            _("Event or country code '{}' does not exist").format(
+                operation_id)]}
+        raise toolkit.ValidationError(msg)
+
+
+def _operation_exists(context, operation_id):
+    if operation_cache.get(operation_id):
+        return True
+
+    # Only existence matters, group_show would serialize the group. Like
+    # group_show, organizations don't count.
+    group = context['model'].Group.get(operation_id)
+    exists = (group is not None and not group.is_organization and
+              group.state == 'active')
+
+    # Only remembered if it exists, so that an operation created by another
+    # process can be imported into straight away
+    if exists:
+        operation_cache.set(operation_id, True)
+
+    return exists
 
 
 def _update_dataset(context, dataset_dict, dataset_info):
-    old_resource_ids = [r['id'] for r in dataset_dict.pop('resources')]
+    """
+    Bring the existing dataset in line with the package. Only the files
+    that were added or changed are uploaded, and only the resources for
+    changed or removed files are deleted. Files with the same name, size
+    and SHA-256 as an existing resource are left alone.
+    """
+    old_resources = dataset_dict.pop('resources')
+    old_resource_ids = [r['id'] for r in old_resources]
 
+    file_paths = dataset_info['file_paths']
+    file_hashes = dataset_info.get('file_hashes', {})
+    _hash_unextracted_files(context, file_paths, file_hashes, old_resources)
+    changes = _diff_resources(old_resources, file_paths, file_hashes)
+
+    _report_progress(context, 'uploading')
     try:
-        _create_resources(context, dataset_dict, dataset_info['file_paths'])
+        _create_resources(context, dataset_dict, changes['upload'],
+                          file_hashes)
+
+        _report_progress(context, 'saving')
+        timer = _timer(context)
+        with timing.timed(timer, 'package_show'):
+            dataset_dict = toolkit.get_action('package_show')(
+                _get_context(context), {'id': dataset_dict['id']})
+
+        # The resources for changed and removed files are deleted by the
+        # same package_update, so they are only gone if it succeeds
+        delete_ids = set(r['id'] for r in changes['delete'])
+        dataset_dict['resources'] = [r for r in dataset_dict['resources']
+                                     if r['id'] not in delete_ids]
+        dataset_dict.update(dataset_info['dataset_dict'])
+
+        with timing.timed(timer, 'package_update'):
+            dataset = toolkit.get_action('package_update')(
+                _get_context(context), dataset_dict)
     except Exception as e:
-        # Resource creation failed, rollback
-        dataset_dict = toolkit.get_action('package_show')(
-            _get_context(context), {'id': dataset_dict['id']})
-        for resource in dataset_dict['resources']:
-            if resource['id'] not in old_resource_ids:
-                toolkit.get_action('resource_delete')(
-                    _get_context(context), {'id': resource['id']})
+        # Resource creation or the update failed, rollback
+        _delete_new_resources(context, dataset_dict['id'], old_resource_ids)
         raise e
 
-    for resource_id in old_resource_ids:
-        toolkit.get_action('resource_delete')(
-            _get_context(context), {'id': resource_id})
+    # Free the files of the deleted resources if they were shared blobs, as
+    # resource_delete would have
+    blobs.release_resources(blobs.blob_store_from_config(toolkit.config),
+                            delete_ids)
+
+    dataset['resource_changes'] = changes['report']
+    return dataset
+
 
+def _delete_new_resources(context, dataset_id, old_resource_ids):
     dataset_dict = toolkit.get_action('package_show')(
-        _get_context(context), {'id': dataset_dict['id']})
+        _get_context(context), {'id': dataset_id})
+    for resource in dataset_dict['resources']:
+        if resource['id'] not in old_resource_ids:
+            toolkit.get_action('resource_delete')(
+                _get_context(context), {'id': resource['id']})
 
-    dataset_dict.update(dataset_info['dataset_dict'])
 
-    return toolkit.get_action('package_update')(
-        _get_context(context), dataset_dict)
+def _hash_unextracted_files(context, file_paths, file_hashes,
+                            old_resources):
+    """
+    Add to file_hashes the SHA-256 of each streamed file that can't be told
+    apart from an existing resource without reading it, as it has the same
+    name and size. Every other file is hashed as it is extracted or
+    uploaded, so isn't read here.
+    """
+    old_sizes = dict((r.get('name'), _as_int(r.get('size')))
+                     for r in old_resources if r.get('hash'))
+    to_hash = [f for f in file_paths
+               if _file_name(f) not in file_hashes and
+               old_sizes.get(_file_name(f), -1) == _file_size(f)]
+    if not to_hash:
+        return
 
+    with timing.timed(_timer(context), 'hash_resources',
+                      sum(_file_size(f) for f in to_hash)):
+        for resource_file in to_hash:
+            try:
+                sha256 = hashes.hash_file(resource_file)
+            except mappackage.MapPackageException as e:
+                raise toolkit.ValidationError({'upload': [e.args[0]]})
 
-def _create_dataset(context, data_dict, dataset_info):
-    private = data_dict.get('private', True)
+            file_hashes[_file_name(resource_file)] = sha256
 
-    owner_org = data_dict.get('owner_org')
 
-    update_dict = dataset_info['dataset_dict']
+def _diff_resources(old_resources, file_paths, file_hashes):
+    """
+    Match the files in the package against the existing resources by
+    name, size and SHA-256.
 
-    if owner_org:
-        update_dict['owner_org'] = owner_org
-    else:
-        private = False
+    Returns the files to upload, the resources to delete once they have
+    been, and a report of the names of the files that were added, changed,
+    removed or left unchanged.
+    """
+    unmatched = list(old_resources)
+    report = {'added': [], 'changed': [], 'removed': [], 'unchanged': []}
+    upload = []
+    delete = []
 
-    update_dict['private'] = private
+    for resource_file in file_paths:
+        name = _file_name(resource_file)
+        old = next((r for r in unmatched if r.get('name') == name), None)
+        if old is None:
+            report['added'].append(name)
+            upload.append(resource_file)
+            continue
 
-    operation_id = dataset_info['operation_id']
+        unmatched.remove(old)
+        if (file_hashes.get(name) and old.get('hash') == file_hashes[name] and
+                _as_int(old.get('size')) == _file_size(resource_file)):
+            report['unchanged'].append(name)
+        else:
+            report['changed'].append(name)
+            upload.append(resource_file)
+            delete.append(old)
 
-    try:
-        toolkit.get_action('group_show')(
-            _get_context(context),
-            data_dict={'id': operation_id})
-    except (logic.NotFound) as e:
-        msg = {'upload': [
-            _("Event or country code '{}' does not exist").format(
-                operation_id)]}
-        raise toolkit.ValidationError(msg)
+    for old in unmatched:
+        report['removed'].append(old.get('name'))
+        delete.append(old)
 
-    # TODO:
-    # If we do this, we get an error "User foo not authorized to edit these groups
-    # update_dict['groups'] = [{'name': operation_id]
+    return {'upload': upload, 'delete': delete, 'report': report}
 
-    final_name = update_dict['name']
-    update_dict['name'] = '{0}-{1}'.format(final_name, uuid.uuid4())
-    dataset = toolkit.get_action('package_create')(
-        _get_context(context), update_dict)
 
+def _as_int(value):
     try:
-        _create_resources(context, dataset, dataset_info['file_paths'])
-    except:
-        toolkit.get_action('package_delete')(_get_context(context),
-                                             {'id': dataset['id']})
-        raise
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
-    toolkit.get_action('member_create')(_get_context(context), {
-        'id': operation_id,
-        'object': dataset['id'],
-        'object_type': 'package',
-        'capacity': 'member',  # TODO: What does capacity mean in this context?
-    })
 
-    update_dict = toolkit.get_action('package_show')(
-        context, {'id': dataset['id']})
-    update_dict['name'] = final_name
+def _create_dataset(context, data_dict, dataset_info):
+    owner_org = data_dict.get('owner_org')
+
+    create_dict = dataset_info['dataset_dict']
+    final_name = create_dict['name']
+
+    # The package is written once, with its final name and its operation
+    # group. The name was checked to be free by _check_status() and by
+    # validation; the unique constraint on the name covers any race.
+    _report_progress(context, 'saving')
+    create_context = _get_create_context(context, dataset_info)
+    create_context['mapactionimporter_validated'] = \
+        dataset_info['validated_dict']
 
     try:
-        dataset = toolkit.get_action('package_update')(
-            _get_context(context), update_dict)
+        with timing.timed(_timer(context), 'package_create'):
+            dataset = toolkit.get_action('package_create')(
+                create_context, create_dict)
     except toolkit.ValidationError as e:
         if _('That URL is already in use.') in e.error_dict.get('name', []):
             e.error_dict['name'] = [_('"%s" already exists.' % final_name)]
         raise e
 
+    _report_progress(context, 'uploading')
+    try:
+        # Recorded on the resources so that a correction can tell which
+        # files have changed
+        resources = _create_resources(
+            context, dataset, dataset_info['file_paths'],
+            dataset_info.get('file_hashes'))
+    except:
+        # Purge rather than delete so that the name is free to try again
+        toolkit.get_action('dataset_purge')(
+            _get_context(dict(context, ignore_auth=True)),
+            {'id': dataset['id']})
+        raise
+
+    dataset['resources'] = resources
+    dataset['num_resources'] = len(resources)
+
     # TODO: Is there a neater way so we don't have to reverse engineer the
     # base name?
     base_name = '-'.join(final_name.split('-')[0:-1])
 
-    toolkit.get_action('dataset_version_create')(
-        _get_context(context), {
-            'id': dataset['id'],
-            'base_name': base_name,
-            'owner_org': owner_org
-        }
-    )
+    _report_progress(context, 'versioning')
+
+    with timing.timed(_timer(context), 'dataset_version_create'):
+        toolkit.get_action('dataset_version_create')(
+            _get_context(context), {
+                'id': dataset['id'],
+                'base_name': base_name,
+                'owner_org': owner_org
+            }
+        )
 
     return dataset
 
 
-def _create_resources(context, dataset, file_paths):
+def _get_create_context(context, dataset_info):
+    """
+    Check that the user may create the dataset and add it to its operation,
+    returning the context for package_create.
+
+    package_create would also require the user to be able to update the
+    operation group to add the dataset to it. Adding a dataset with
+    member_create only needs membership of the group, so those are the
+    permissions checked here before the package is created without further
+    checks.
+    """
+    create_context = _get_context(context)
+    if create_context['ignore_auth']:
+        return create_context
+
+    dataset_dict = dict(dataset_info['dataset_dict'])
+    dataset_dict.pop('groups', None)
+    toolkit.check_access('package_create', _get_context(context),
+                         dataset_dict)
+    toolkit.check_access('member_create', _get_context(context), {
+        'id': dataset_info['operation_id'],
+        'object_type': 'package',
+        'capacity': 'member',
+    })
+
+    create_context['ignore_auth'] = True
+    return create_context
+
+
+def _create_resources(context, dataset, file_paths, file_hashes=None):
+    """
+    Create and upload a resource for each file, returning the resources in
+    the same order as the files. Each resource's hash is taken from
+    file_hashes, by name.
+    """
+    file_hashes = file_hashes or {}
+    workers = _upload_workers()
+    if workers > 1 and len(file_paths) > 1:
+        return _create_resources_concurrently(
+            context, dataset, file_paths, workers, file_hashes)
+
+    timer = _timer(context)
+    resources = []
     for resource_file in file_paths:
+        with timing.timed(timer, 'upload', _file_size(resource_file),
+                          _file_name(resource_file)):
+            if isinstance(resource_file, mappackage.ZipMemberStream):
+                resource = {
+                    'package_id': dataset['id'],
+                    'hash': file_hashes.get(_file_name(resource_file), ''),
+                }
+                resources.append(_create_and_upload_zip_member(
+                    _get_context(context), resource, resource_file))
+            else:
+                resource = {
+                    'package_id': dataset['id'],
+                    'hash': file_hashes.get(_file_name(resource_file), ''),
+                    'path': resource_file,
+                }
+                resources.append(_create_and_upload_local_resource(
+                    _get_context(context), resource))
+
+    return resources
+
+
+def _create_resources_concurrently(context, dataset, file_paths, workers,
+                                   file_hashes):
+    # resource_create rewrites the package's whole resource list, so the
+    # resource records are still created one at a time. Only the uploads
+    # to storage, which is where the time goes, are run on the pool.
+    timer = _timer(context)
+    uploads = []
+    try:
+        for resource_file in file_paths:
+            with timing.timed(timer, 'resource_create', 0,
+                              _file_name(resource_file)):
+                uploads.append(_create_resource_for_upload(
+                    _get_context(context), dataset, resource_file,
+                    file_hashes.get(_file_name(resource_file), '')))
+
+        resources = concurrency.map_bounded(
+            functools.partial(_upload_resource, timer), uploads, workers)
+    finally:
+        for upload, resource, the_file in uploads:
+            the_file.close()
+
+    _save_uploaded_hashes(context, uploads)
+    return resources
+
+
+def _save_uploaded_hashes(context, uploads):
+    """
+    Save the hashes of the streamed files, which are only known once they
+    have been uploaded. These uploads ran after resource_create had
+    committed, so only the resource rows are written, in one commit.
+    """
+    streamed = [(resource, the_file.sha256)
+                for upload, resource, the_file in uploads
+                if isinstance(the_file, mappackage.ZipMemberStream) and
+                the_file.sha256 and not resource.get('hash')]
+    if not streamed:
+        return
+
+    with timing.timed(_timer(context), 'save_hashes'):
+        context['model'].repo.new_revision()
+        for resource, sha256 in streamed:
+            context['model'].Resource.get(resource['id']).hash = sha256
+            resource['hash'] = sha256
+        context['model'].repo.commit()
+
+
+def _create_resource_for_upload(context, dataset, resource_file, sha256=''):
+    """
+    Create the resource record for a file, returning it with the uploader
+    that will store the file's contents.
+    """
+    if isinstance(resource_file, mappackage.ZipMemberStream):
+        the_file = resource_file
+    else:
+        the_file = open(resource_file, 'r')
+
+    try:
         resource = {
             'package_id': dataset['id'],
-            'path': resource_file,
+            'hash': sha256,
         }
-        _create_and_upload_local_resource(
-            _get_context(context), resource)
+        _set_upload(resource, the_file)
+        upload = uploader.get_resource_uploader(resource)
+        resource = toolkit.get_action('resource_create')(context, resource)
+    except:
+        the_file.close()
+        raise
+
+    return (upload, resource, the_file)
+
+
+def _upload_resource(timer, args):
+    upload, resource, the_file = args
+    # No resource_create commit follows to record the hash in, that's left
+    # to _save_uploaded_hashes()
+    if isinstance(upload, HashRecordingUpload):
+        upload = upload.wrapped
+
+    try:
+        with timing.timed(timer, 'upload', _file_size(the_file),
+                          resource['name']):
+            upload.upload(resource['id'], uploader.get_max_resource_size())
+    except mappackage.MapPackageException as e:
+        raise toolkit.ValidationError({'upload': [e.args[0]]})
+
+    return resource
+
+
+def _file_name(resource_file):
+    if isinstance(resource_file, basestring):
+        return os.path.basename(resource_file)
+
+    return os.path.basename(resource_file.name)
+
+
+def _file_size(resource_file):
+    if isinstance(resource_file, mappackage.ZipMemberStream):
+        return resource_file.info.file_size
+    if isinstance(resource_file, basestring):
+        return os.path.getsize(resource_file)
+
+    return os.fstat(resource_file.fileno()).st_size
+
+
+def _incremental_metadata():
+    return toolkit.asbool(toolkit.config.get(
+        'ckanext.mapactionimporter.incremental_metadata', False))
+
+
+def _batch_workers():
+    return toolkit.asint(
+        toolkit.config.get('ckanext.mapactionimporter.batch_workers', 1))
+
+
+def _upload_workers():
+    return toolkit.asint(
+        toolkit.config.get('ckanext.mapactionimporter.upload_workers', 1))
+
+
+def _stream_uploads():
+    return toolkit.asbool(
+        toolkit.config.get('ckanext.mapactionimporter.stream_uploads', False))
 
 
 def _get_context(context):
@@ -279,15 +1229,62 @@ def _create_and_upload_local_resource(context, resource):
     path = resource['path']
     del resource['path']
     with open(path, 'r') as the_file:
-        _create_and_upload_resource(context, resource, the_file)
+        return _create_and_upload_resource(context, resource, the_file)
+
+
+def _create_and_upload_zip_member(context, resource, member):
+    try:
+        return _create_and_upload_resource(context, resource, member)
+    except mappackage.MapPackageException as e:
+        raise toolkit.ValidationError({'upload': [e.args[0]]})
+    finally:
+        member.close()
 
 
 def _create_and_upload_resource(context, resource, the_file):
+    _set_upload(resource, the_file)
+    return toolkit.get_action('resource_create')(context, resource)
+
+
+def _set_upload(resource, the_file):
     resource['url'] = 'url'
     resource['url_type'] = 'upload'
     resource['upload'] = _UploadLocalFileStorage(the_file)
     resource['name'] = os.path.basename(the_file.name)
-    toolkit.get_action('resource_create')(context, resource)
+    resource['size'] = _file_size(the_file)
+
+
+def is_imported_file(upload):
+    """ Whether a resource's upload is a file from a map package """
+    return isinstance(upload, _UploadLocalFileStorage)
+
+
+def is_streamed_file(upload):
+    """ Whether a resource's upload is streamed straight from a package """
+    return (is_imported_file(upload) and
+            isinstance(upload.file, mappackage.ZipMemberStream))
+
+
+class HashRecordingUpload(object):
+    """
+    Uploader for a file streamed from a map package, whose SHA-256 is only
+    known once it has been uploaded. Sets it on the resource, which
+    resource_create commits along with the rest of the resource.
+    """
+    def __init__(self, upload, member):
+        self.wrapped = upload
+        self.member = member
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def upload(self, id, max_size=10):
+        self.wrapped.upload(id, max_size)
+
+        resource = model.Resource.get(id)
+        if (resource is not None and not resource.hash and
+                self.member.sha256):
+            resource.hash = self.member.sha256
 
 
 class _UploadLocalFileStorage(cgi.FieldStorage):
@@ -0,0 +1,68 @@
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import blobs, jobs, profiling
+
+
+def import_job_status(context, data_dict):
+    """
+    Return the status of a background map package import, as queued by
+    create_dataset_from_mapaction_zip.
+    """
+    job_id = toolkit.get_or_bust(data_dict, 'id')
+    store = jobs.job_store_from_config(toolkit.config)
+
+    try:
+        job = store.get(job_id)
+    except jobs.JobNotFound:
+        job = None
+
+    # Checked before saying whether there is such a job, so that only
+    # sysadmins can tell a missing job from someone else's
+    context['mapactionimporter_job'] = job
+    toolkit.check_access('mapaction_import_job_status', context, data_dict)
+
+    if job is None:
+        raise toolkit.ObjectNotFound(toolkit._('Import job not found'))
+
+    return job
+
+
+def import_profile_list(context, data_dict):
+    """
+    Return the profiles captured from imports, most recent first.
+    """
+    toolkit.check_access('mapaction_import_profile_list', context, data_dict)
+
+    store = profiling.profile_store_from_config(toolkit.config)
+    return [_with_download_url(r) for r in store.list()]
+
+
+def import_profile_show(context, data_dict):
+    """
+    Return the record of a profile captured from an import, including the
+    URL to download its cProfile stats from.
+    """
+    toolkit.check_access('mapaction_import_profile_show', context, data_dict)
+
+    profile_id = toolkit.get_or_bust(data_dict, 'id')
+    store = profiling.profile_store_from_config(toolkit.config)
+
+    try:
+        return _with_download_url(store.get(profile_id))
+    except profiling.ProfileNotFound:
+        raise toolkit.ObjectNotFound(toolkit._('Import profile not found'))
+
+
+def blob_stats(context, data_dict):
+    """
+    Return how many files of imported resources are stored as shared blobs,
+    and how many bytes sharing them has saved.
+    """
+    toolkit.check_access('mapaction_blob_stats', context, data_dict)
+
+    return blobs.blob_store_from_config(toolkit.config).stats()
+
+
+def _with_download_url(record):
+    return dict(record, download_url=toolkit.url_for(
+        'import_mapactionzip_profile', id=record['id'], qualified=True))
@@ -0,0 +1,27 @@
+from ckan.common import _
+
+
+def import_job_status(context, data_dict):
+    # Sysadmins never reach this; everyone else may only see their own jobs
+    job = context.get('mapactionimporter_job')
+    if job is None or job['user'] != context.get('user'):
+        return {'success': False,
+                'msg': _('Not authorized to see this import job')}
+
+    return {'success': True}
+
+
+def import_profile_list(context, data_dict):
+    # Sysadmins only
+    return {'success': False,
+            'msg': _('Only sysadmins may see import profiles')}
+
+
+def import_profile_show(context, data_dict):
+    return import_profile_list(context, data_dict)
+
+
+def blob_stats(context, data_dict):
+    # Sysadmins only
+    return {'success': False,
+            'msg': _('Only sysadmins may see blob storage statistics')}
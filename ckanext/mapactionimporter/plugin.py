@@ -1,9 +1,25 @@
+import ckan.lib.uploader as uploader
+import ckan.model as model
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import ckanext.mapactionimporter.logic.action.create
+import ckanext.mapactionimporter.logic.action.get
+import ckanext.mapactionimporter.logic.auth
 
 from collections import OrderedDict
+from .lib.blobs import (
+    ContentAddressedUpload,
+    blob_store_from_config,
+    content_addressed_storage_enabled,
+    release_resources,
+)
+from .lib.cache import TTLCache
+from .lib.jobs import job_store_from_config
 from .lib.mappackage import PRODUCT_THEMES
+from .lib.profiling import profile_store_from_config
+from .lib.scratch import scratch_space_from_config
+from .lib.staging import staging_store_from_config
+from .lib.vocabulary import sync_vocabulary
 
 def register_translator():
     # https://github.com/ckan/ckanext-archiver/blob/master/ckanext/archiver/bin/common.py
@@ -22,33 +38,34 @@ def register_translator():
         translator_obj = MockTranslator()
         registry.register(translator, translator_obj)
 
-def create_product_themes():
+# Results of the product_themes helper by query. The vocabulary only changes
+# when create_product_themes is run or its tags are created or deleted, which
+# clear it; the TTL covers changes made by other processes.
+product_themes_cache = TTLCache(max_size=100, ttl=3600)
+
+
+def create_product_themes(dry_run=False):
+    """
+    Bring the product_themes vocabulary in line with PRODUCT_THEMES,
+    returning what changed.
+    """
     register_translator()
 
     user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name']}
-    try:
-        data = {'id': 'product_themes'}
-        vocab = toolkit.get_action('vocabulary_show')(context, data)
-        tags = toolkit.get_action('tag_list')(context, {'vocabulary_id': vocab['id']})
-        for tag in PRODUCT_THEMES:
-            if tag in tags:
-                tags.remove(tag)
-            else:
-                data = {'name': tag, 'vocabulary_id': vocab['id'], 'display_name': "Foo"}
-                toolkit.get_action('tag_create')(context, data)
-        for tag in tags:
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            toolkit.get_action('tag_delete')(context, data)
-    except toolkit.ObjectNotFound:
-        data = {'name': 'product_themes'}
-        vocab = toolkit.get_action('vocabulary_create')(context, data)
-        for tag in PRODUCT_THEMES:
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            toolkit.get_action('tag_create')(context, data)
+    context = {'model': model, 'session': model.Session, 'user': user['name']}
+    report = sync_vocabulary(
+        context, 'product_themes', PRODUCT_THEMES, dry_run=dry_run)
+
+    product_themes_cache.clear()
+    return report
 
 
 def product_themes(query=None):
+    product_themes = product_themes_cache.get(query)
+    if product_themes is not None:
+        # Copied so that no caller can change what the others get
+        return [dict(theme) for theme in product_themes]
+
     try:
         tag_list = toolkit.get_action('tag_list')
         product_themes = tag_list(
@@ -57,18 +74,83 @@ def product_themes(query=None):
                 'all_fields': True,
                 'query': query
             })
-        return product_themes
     except toolkit.ObjectNotFound:
+        product_themes = []
+
+    product_themes_cache.set(query, product_themes)
+    return [dict(theme) for theme in product_themes]
+
+
+def _other_uploader(this_plugin, method, *args):
+    """
+    The uploader the other IUploader plugins would give. CKAN uses whatever
+    the last plugin returns, even None, so returning None ourselves would
+    replace theirs.
+    """
+    upload = None
+    for plugin in plugins.PluginImplementations(plugins.IUploader):
+        if plugin is not this_plugin:
+            upload = getattr(plugin, method)(*args)
+    return upload
+
+
+@toolkit.chained_action
+def tag_create(original_action, context, data_dict):
+    tag = original_action(context, data_dict)
+    if data_dict.get('vocabulary_id'):
+        product_themes_cache.clear()
+    return tag
+
+
+@toolkit.chained_action
+def tag_delete(original_action, context, data_dict):
+    original_action(context, data_dict)
+    if data_dict.get('vocabulary_id'):
+        product_themes_cache.clear()
+
+
+@toolkit.chained_action
+def resource_delete(original_action, context, data_dict):
+    original_action(context, data_dict)
+    # Free its file if it was stored as a shared blob
+    release_resources(blob_store_from_config(toolkit.config),
+                      [data_dict['id']])
+
+
+@toolkit.chained_action
+def package_delete(original_action, context, data_dict):
+    resource_ids = _resource_ids(data_dict)
+    original_action(context, data_dict)
+    release_resources(blob_store_from_config(toolkit.config), resource_ids)
+
+
+@toolkit.chained_action
+def dataset_purge(original_action, context, data_dict):
+    resource_ids = _resource_ids(data_dict)
+    original_action(context, data_dict)
+    release_resources(blob_store_from_config(toolkit.config), resource_ids)
+
+
+def _resource_ids(data_dict):
+    package = model.Package.get(data_dict.get('id'))
+    if package is None:
         return []
 
+    return [r.id for r in package.resources]
+
 
 class MapactionimporterPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     plugins.implements(plugins.IDatasetForm)
     plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
+    plugins.implements(plugins.IPluginObserver, inherit=True)
+    plugins.implements(plugins.IGroupController, inherit=True)
     plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.IFacets, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
+    plugins.implements(plugins.IUploader, inherit=True)
 
     # IFacets
     def dataset_facets(self, facets_dict, package_type):
@@ -107,6 +189,43 @@ class MapactionimporterPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetFor
         toolkit.add_public_directory(config_, 'public')
         toolkit.add_resource('fanstatic', 'mapactionimporter')
 
+    # IConfigurable
+    def configure(self, config_):
+        # Clear out workspaces left behind by workers that died mid-import
+        scratch_space_from_config(config_).sweep()
+        staging_store_from_config(config_).sweep(toolkit.asint(config_.get(
+            'ckanext.mapactionimporter.staging_max_age', 7 * 24 * 60 * 60)))
+        job_store_from_config(config_).sweep(toolkit.asint(config_.get(
+            'ckanext.mapactionimporter.jobs_max_age', 7 * 24 * 60 * 60)))
+        profile_store_from_config(config_).sweep(toolkit.asint(config_.get(
+            'ckanext.mapactionimporter.profile_max_age', 30 * 24 * 60 * 60)))
+        ckanext.mapactionimporter.logic.action.create.clear_schema_cache()
+        ckanext.mapactionimporter.logic.action.create.configure_operation_cache(
+            config_)
+        product_themes_cache.ttl = toolkit.asint(config_.get(
+            'ckanext.mapactionimporter.product_themes_cache_ttl', 3600))
+        product_themes_cache.clear()
+
+    # IGroupController
+    def create(self, entity):
+        # An operation may now exist
+        ckanext.mapactionimporter.logic.action.create.operation_cache.clear()
+
+    def edit(self, entity):
+        # It may have been renamed or had its state changed
+        ckanext.mapactionimporter.logic.action.create.operation_cache.clear()
+
+    def delete(self, entity):
+        ckanext.mapactionimporter.logic.action.create.operation_cache.clear()
+
+    # IPluginObserver
+    def after_load(self, service):
+        # Another plugin may now handle some package types
+        ckanext.mapactionimporter.logic.action.create.clear_schema_cache()
+
+    def after_unload(self, service):
+        ckanext.mapactionimporter.logic.action.create.clear_schema_cache()
+
     def before_map(self, map_):
         map_.connect(
             'import_mapactionzip_form',
@@ -122,6 +241,41 @@ class MapactionimporterPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetFor
             action='import_dataset',
             conditions=dict(method=['POST']),
         )
+        map_.connect(
+            'import_mapactionzip_job',
+            '/import_mapactionzip/job/{id}',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='job',
+            conditions=dict(method=['GET']),
+        )
+        map_.connect(
+            'import_mapactionzip_upload_start',
+            '/import_mapactionzip/upload',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='upload_start',
+            conditions=dict(method=['POST']),
+        )
+        map_.connect(
+            'import_mapactionzip_upload',
+            '/import_mapactionzip/upload/{id}',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='upload_status',
+            conditions=dict(method=['GET']),
+        )
+        map_.connect(
+            'import_mapactionzip_upload_chunk',
+            '/import_mapactionzip/upload/{id}',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='upload_chunk',
+            conditions=dict(method=['PUT']),
+        )
+        map_.connect(
+            'import_mapactionzip_profile',
+            '/import_mapactionzip/profile/{id}',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='profile',
+            conditions=dict(method=['GET']),
+        )
 
         return map_
 
@@ -129,8 +283,65 @@ class MapactionimporterPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetFor
         return {
             'create_dataset_from_mapaction_zip':
             ckanext.mapactionimporter.logic.action.create.create_dataset_from_zip,
+            'validate_mapaction_zip':
+            ckanext.mapactionimporter.logic.action.create.validate_zip,
+            'create_datasets_from_mapaction_zips':
+            ckanext.mapactionimporter.logic.action.create.create_datasets_from_zips,
+            'mapaction_import_job_status':
+            ckanext.mapactionimporter.logic.action.get.import_job_status,
+            'mapaction_import_profile_list':
+            ckanext.mapactionimporter.logic.action.get.import_profile_list,
+            'mapaction_import_profile_show':
+            ckanext.mapactionimporter.logic.action.get.import_profile_show,
+            'mapaction_blob_stats':
+            ckanext.mapactionimporter.logic.action.get.blob_stats,
+            # To keep the product_themes helper's cache up to date
+            'tag_create': tag_create,
+            'tag_delete': tag_delete,
+            # To free shared blobs no longer used by any resource
+            'resource_delete': resource_delete,
+            'package_delete': package_delete,
+            'dataset_purge': dataset_purge,
+        }
+
+    def get_auth_functions(self):
+        return {
+            'mapaction_import_job_status':
+            ckanext.mapactionimporter.logic.auth.import_job_status,
+            'mapaction_import_profile_list':
+            ckanext.mapactionimporter.logic.auth.import_profile_list,
+            'mapaction_import_profile_show':
+            ckanext.mapactionimporter.logic.auth.import_profile_show,
+            'mapaction_blob_stats':
+            ckanext.mapactionimporter.logic.auth.blob_stats,
         }
 
+    # IUploader
+    def get_resource_uploader(self, data_dict):
+        create = ckanext.mapactionimporter.logic.action.create
+        upload_field = data_dict.get('upload')
+
+        # Only the files of imported resources are stored as shared blobs
+        if (content_addressed_storage_enabled(toolkit.config) and
+                create.is_imported_file(upload_field)):
+            upload = ContentAddressedUpload(
+                data_dict, blob_store_from_config(toolkit.config))
+        else:
+            upload = _other_uploader(self, 'get_resource_uploader',
+                                     data_dict)
+
+        # Streamed files are hashed as they are uploaded, and the hash saved
+        # with the resource
+        if create.is_streamed_file(upload_field):
+            upload = create.HashRecordingUpload(
+                upload or uploader.ResourceUpload(data_dict),
+                upload_field.file)
+
+        return upload
+
+    def get_uploader(self, upload_to, old_filename=None):
+        return _other_uploader(self, 'get_uploader', upload_to, old_filename)
+
     def get_helpers(self):
         return {'product_themes': product_themes}
 
@@ -167,6 +378,11 @@ class MapactionimporterPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetFor
         schema = self._modify_package_schema(schema)
         return schema
 
+    def validate(self, context, data_dict, schema, action):
+        # Don't validate an imported dataset a second time on package_create
+        return ckanext.mapactionimporter.logic.action.create.prevalidated(
+            context, data_dict, action)
+
     def is_fallback(self):
         # Return True to register this plugin as the default handler for
         # package types not handled by any other IDatasetForm plugin.
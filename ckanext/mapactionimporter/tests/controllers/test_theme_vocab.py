@@ -8,6 +8,7 @@ import ckan.tests.factories as factories
 import ckan.tests.helpers as helpers
 import ckan.plugins.toolkit as toolkit
 
+import ckanext.mapactionimporter.plugin as plugin
 import ckanext.mapactionimporter.tests.factories as custom_factories
 import ckanext.mapactionimporter.tests.helpers as custom_helpers
 
@@ -55,3 +56,37 @@ class TestThemeVocab(custom_helpers.FunctionalTestBaseClass):
         context = {'user': user['name']}
         dataset_dict = toolkit.get_action('package_show')(context, {'id': dataset['id']})
         assert_equals(dataset_dict['product_themes'], ['Agriculture', 'Affected Population'])
+
+
+class TestProductThemesHelper(custom_helpers.FunctionalTestBaseClass):
+
+    def test_themes_cached_between_calls(self):
+        cache = plugin.product_themes_cache
+        hits, misses = cache.hits, cache.misses
+
+        first = plugin.product_themes()
+        second = plugin.product_themes()
+
+        assert_equals(first, second)
+        assert_equals(cache.misses - misses, 1)
+        assert_equals(cache.hits - hits, 1)
+
+    def test_cached_themes_cannot_be_changed_by_callers(self):
+        themes = plugin.product_themes()
+        count = len(themes)
+        themes.append({'name': 'Not a theme'})
+        themes[0]['name'] = 'Renamed'
+
+        themes = plugin.product_themes()
+        assert_equals(len(themes), count)
+        assert_true(themes[0]['name'] != 'Renamed')
+
+    def test_cache_cleared_when_theme_added(self):
+        plugin.product_themes()
+
+        vocab = helpers.call_action('vocabulary_show', id='product_themes')
+        helpers.call_action('tag_create', name='Floods',
+                            vocabulary_id=vocab['id'])
+
+        names = [t['name'] for t in plugin.product_themes()]
+        assert_true('Floods' in names)
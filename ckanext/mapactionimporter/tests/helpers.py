@@ -1,9 +1,12 @@
+import io
 import nose.tools
 import os
+import zipfile
 
 import ckan.tests.helpers as helpers
 import ckan.plugins as plugins
 
+from ckanext.mapactionimporter.logic.action.create import operation_cache
 from ckanext.mapactionimporter.plugin import create_product_themes
 
 assert_equal = nose.tools.assert_equal
@@ -57,6 +60,18 @@ def get_country_group_zip():
     return get_test_file('MA001_Country_Group.zip')
 
 
+def get_resubmitted_zip(zip_file):
+    """
+    A copy of the zip file that differs only in its comment, so it has the
+    same contents but a different hash.
+    """
+    copy = io.BytesIO(zip_file.read())
+    with zipfile.ZipFile(copy, 'a') as zip_copy:
+        zip_copy.comment = 'resubmitted'
+    copy.seek(0)
+    return copy
+
+
 def get_test_file(filename):
     return open(os.path.join(os.path.split(__file__)[0],
                              './test-data/', filename))
@@ -71,6 +86,8 @@ class FunctionalTestBaseClass(helpers.FunctionalTestBase):
 
     def setup(self):
         super(FunctionalTestBaseClass, self).setup()
+        # The database is reset without deleting any groups
+        operation_cache.clear()
         create_product_themes()
 
     @classmethod
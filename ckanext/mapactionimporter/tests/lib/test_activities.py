@@ -0,0 +1,122 @@
+import threading
+import unittest
+
+import mock
+
+import ckan.lib.activity_streams_session_extension as activity_extension
+import ckan.model as model
+
+from ckanext.mapactionimporter.lib import activities
+
+
+class _Package(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class TestSuppressed(unittest.TestCase):
+    def setUp(self):
+        # Stands in for CKAN's, which the activity session extension asks
+        # for the activity of each package changed in a commit
+        def activity_stream_item(obj, activity_type, revision, user_id):
+            return 'activity for {0}'.format(obj.name)
+
+        self.activity_stream_item = activity_stream_item
+        for patcher in (
+                mock.patch.object(activity_extension, 'activity_stream_item',
+                                  activity_stream_item),
+                mock.patch.object(model, 'Package', _Package)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _activity(self, name='189-ma001-v2'):
+        return activity_extension.activity_stream_item(
+            _Package(name), 'changed', None, None)
+
+    def test_activities_recorded_outside_block(self):
+        with activities.suppressed('189-ma001-v2'):
+            pass
+
+        self.assertEqual(self._activity(), 'activity for 189-ma001-v2')
+
+    def test_activities_not_recorded_in_block(self):
+        with activities.suppressed('189-ma001-v2'):
+            self.assertIsNone(self._activity())
+
+    def test_other_packages_recorded_in_block(self):
+        with activities.suppressed('189-ma001-v2'):
+            self.assertEqual(self._activity('189-ma001-v1'),
+                             'activity for 189-ma001-v1')
+
+    def test_disabled_block_records_activities(self):
+        with activities.suppressed('189-ma001-v2', enabled=False):
+            self.assertEqual(self._activity(), 'activity for 189-ma001-v2')
+
+    def test_nested_blocks_suppress_until_outer_ends(self):
+        with activities.suppressed('189-ma001-v2'):
+            with activities.suppressed('189-ma002-v1'):
+                pass
+            self.assertIsNone(self._activity())
+            self.assertEqual(self._activity('189-ma002-v1'),
+                             'activity for 189-ma002-v1')
+
+        self.assertEqual(self._activity(), 'activity for 189-ma001-v2')
+
+    def test_other_threads_record_activities(self):
+        recorded = []
+        with activities.suppressed('189-ma001-v2'):
+            thread = threading.Thread(
+                target=lambda: recorded.append(self._activity()))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(recorded, ['activity for 189-ma001-v2'])
+
+    def test_extension_restored_when_block_ends(self):
+        with self.assertRaises(ValueError):
+            with activities.suppressed('189-ma001-v2'):
+                self.assertFalse(activity_extension.activity_stream_item is
+                                 self.activity_stream_item)
+                raise ValueError()
+
+        self.assertTrue(activity_extension.activity_stream_item is
+                        self.activity_stream_item)
+
+
+class TestImportSummary(unittest.TestCase):
+    def _dataset_info(self, extras=None, **dataset_dict):
+        dataset_dict.setdefault('version', 2)
+        dataset_dict['extras'] = extras or []
+        return {'dataset_dict': dataset_dict, 'status': 'Update'}
+
+    def test_summary_of_map_number_version_and_resources(self):
+        summary = activities.import_summary(
+            self._dataset_info([{'key': 'mapNumber', 'value': 'MA001'}]),
+            {'name': '189-ma001-v2', 'resources': [{}, {}, {}]})
+
+        self.assertEqual(summary['summary'],
+                         'Imported MA001 v2 with 3 resources')
+        self.assertEqual(summary['map_number'], 'MA001')
+        self.assertEqual(summary['version'], 2)
+        self.assertEqual(summary['status'], 'Update')
+        self.assertEqual(summary['resources'], 3)
+        self.assertFalse('resource_changes' in summary)
+
+    def test_map_number_from_schema_field(self):
+        summary = activities.import_summary(
+            self._dataset_info(mapNumber='MA002', version=1),
+            {'name': '189-ma002-v1', 'resources': [{}]})
+
+        self.assertEqual(summary['summary'],
+                         'Imported MA002 v1 with 1 resource')
+
+    def test_summary_includes_resource_changes(self):
+        changes = {'added': [], 'changed': ['map.pdf'], 'removed': [],
+                   'unchanged': ['map.jpeg']}
+        summary = activities.import_summary(
+            self._dataset_info([{'key': 'mapNumber', 'value': 'MA001'}]),
+            {'name': '189-ma001-v2', 'resources': [{}, {}],
+             'resource_changes': changes})
+
+        self.assertEqual(summary['resource_changes'], changes)
+
@@ -0,0 +1,74 @@
+import json
+import os
+import unittest
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import (
+    benchmark,
+    hashes,
+    mappackage,
+    profiling,
+)
+
+
+class TestGeneratePackage(unittest.TestCase):
+    def test_package_has_requested_shape(self):
+        spec = benchmark.PackageSpec(members=3, member_size=1000, themes=4,
+                                     countries=5, xml_size=10000)
+
+        dataset_info = mappackage.to_dataset(
+            {}, benchmark.generate_package(spec, map_number='MA123'))
+
+        self.assertEqual(dataset_info['name'], '189-ma123-v1')
+        self.assertEqual(len(dataset_info['members']), 3)
+        self.assertEqual([m.file_size for m in dataset_info['members']],
+                         [1000] * 3)
+        self.assertEqual(
+            len(dataset_info['dataset_dict']['product_themes']), 4)
+
+        extras = dict((e['key'], e['value'])
+                      for e in dataset_info['dataset_dict']['extras'])
+        self.assertEqual(len(extras['country-iso3']), 5)
+        self.assertEqual(len(extras['accessnotes']), 10000)
+
+
+class TestRunBenchmark(unittest.TestCase):
+    def test_results_are_json(self):
+        spec = benchmark.PackageSpec(members=1, member_size=1000)
+
+        results = benchmark.run_benchmark(spec, iterations=3,
+                                          stages=['to_dataset'])
+
+        stage = json.loads(json.dumps(results))['stages']['to_dataset']
+        self.assertEqual(results['iterations'], 3)
+        self.assertTrue(stage['p50'] <= stage['p90'] <= stage['max'])
+        self.assertTrue(stage['packages_per_second'] > 0)
+        self.assertTrue(stage['peak_rss_kb'] > 0)
+        self.assertTrue(0 <= stage['rss_growth_kb'] <= stage['peak_rss_kb'])
+
+    def test_stage_failure_raised(self):
+        spec = benchmark.PackageSpec(members=1, member_size=1000)
+
+        with self.assertRaises(RuntimeError):
+            benchmark.run_benchmark(spec, iterations=1, stages=['missing'])
+
+    def test_stores_in_temporary_directory(self):
+        key = 'ckanext.mapactionimporter.hash_index_dir'
+        before = toolkit.config.get(key)
+
+        with benchmark.temporary_stores() as root:
+            for store in (hashes.hash_index_from_config(toolkit.config),
+                          profiling.profile_store_from_config(toolkit.config)):
+                self.assertTrue(store.root.startswith(root))
+
+        self.assertFalse(os.path.exists(root))
+        self.assertEqual(toolkit.config.get(key), before)
+
+    def test_percentile(self):
+        values = range(1, 101)
+
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile(values, 100), 100)
+        self.assertEqual(benchmark.percentile([3], 90), 3)
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from io import BytesIO
+
+from ckanext.mapactionimporter.lib import blobs, hashes
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = blobs.BlobStore(os.path.join(self.root, 'blobs'))
+        self.data = b'map' * 1000
+        self.sha256 = hashes.hash_file(BytesIO(self.data))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _path(self, resource_id):
+        return os.path.join(self.root, 'resources', resource_id)
+
+    def _add(self, resource_id, data=None, sha256=None):
+        return self.store.add(resource_id, self._path(resource_id),
+                              BytesIO(data or self.data), sha256=sha256)
+
+    def test_identical_files_share_a_blob(self):
+        self.assertEqual(self._add('resource-1'), self.sha256)
+        self._add('resource-2')
+
+        for resource_id in ('resource-1', 'resource-2'):
+            with open(self._path(resource_id), 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+
+        self.assertTrue(os.path.samefile(self._path('resource-1'),
+                                         self._path('resource-2')))
+        self.assertEqual(self.store.stats(), {
+            'blobs': 1,
+            'references': 2,
+            'stored_bytes': len(self.data),
+            'referenced_bytes': 2 * len(self.data),
+            'saved_bytes': len(self.data),
+        })
+
+    def test_known_hash_of_stored_blob_not_read(self):
+        self._add('resource-1')
+
+        class Unreadable(object):
+            def seek(self, *args):
+                raise AssertionError('File was read')
+            read = seek
+
+        self.store.add('resource-2', self._path('resource-2'), Unreadable(),
+                       sha256=self.sha256)
+        self.assertTrue(os.path.samefile(self._path('resource-1'),
+                                         self._path('resource-2')))
+
+    def test_blob_removed_with_last_reference(self):
+        self._add('resource-1')
+        self._add('resource-2')
+
+        self.assertEqual(
+            self.store.release('resource-1', self._path('resource-1')),
+            self.sha256)
+        self.assertFalse(os.path.exists(self._path('resource-1')))
+        self.assertTrue(os.path.exists(self.store.blob_path(self.sha256)))
+
+        self.store.release('resource-2', self._path('resource-2'))
+        self.assertFalse(os.path.exists(self.store.blob_path(self.sha256)))
+        self.assertEqual(self.store.stats()['blobs'], 0)
+
+    def test_replacing_file_releases_old_blob(self):
+        self._add('resource-1')
+        new_sha256 = self._add('resource-1', data=b'new map')
+
+        self.assertFalse(os.path.exists(self.store.blob_path(self.sha256)))
+        self.assertEqual(self.store.stats()['references'], 1)
+        with open(self._path('resource-1'), 'rb') as f:
+            self.assertEqual(f.read(), b'new map')
+
+        # Adding the same file again keeps its blob
+        self._add('resource-1', data=b'new map')
+        self.assertTrue(os.path.exists(self.store.blob_path(new_sha256)))
+
+    def test_release_of_unknown_resource(self):
+        path = self._path('not-stored')
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+        self.assertIsNone(self.store.release('not-stored', path))
+        self.assertTrue(os.path.exists(path))
+
+    def test_empty_store_stats(self):
+        self.assertEqual(self.store.stats()['saved_bytes'], 0)
@@ -0,0 +1,88 @@
+import os
+import unittest
+
+import ckan.tests.helpers as helpers
+import ckan.tests.factories as factories
+
+from ckanext.mapactionimporter.lib import bulk
+from ckanext.mapactionimporter.tests.helpers import (
+    FunctionalTestBaseClass,
+    assert_equal,
+    assert_true,
+)
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), '..', 'test-data')
+
+
+def _test_data(filename):
+    return os.path.join(TEST_DATA, filename)
+
+
+class TestPlanImports(unittest.TestCase):
+    def test_finds_zip_files_in_directory(self):
+        paths = bulk.find_packages([TEST_DATA])
+
+        self.assertIn(_test_data('MA001_Aptivate_Example.zip'), paths)
+        self.assertNotIn(_test_data('MA001_Aptivate_Example.xml'), paths)
+        self.assertEqual(paths, sorted(paths))
+
+    def test_finds_files_matching_glob(self):
+        paths = bulk.find_packages([_test_data('MA001_Aptivate_*.zip')])
+
+        self.assertEqual(len(paths), 3)
+
+    def test_versions_of_a_map_imported_in_order(self):
+        paths = [
+            _test_data('MA001_Aptivate_Example_Update.zip'),
+            _test_data('MA001_Aptivate_Example_Correction.zip'),
+            _test_data('MA001_Aptivate_Example.zip'),
+        ]
+
+        groups = bulk.plan_imports(paths)
+
+        self.assertEqual(groups, [[
+            _test_data('MA001_Aptivate_Example.zip'),
+            _test_data('MA001_Aptivate_Example_Correction.zip'),
+            _test_data('MA001_Aptivate_Example_Update.zip'),
+        ]])
+
+    def test_unreadable_packages_imported_on_their_own(self):
+        paths = [
+            _test_data('MA001_Aptivate_Example.zip'),
+            _test_data('MA001_Missing_Metadata.zip'),
+            _test_data('MA001_Missing_Fields.zip'),
+        ]
+
+        groups = bulk.plan_imports(paths)
+
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(sorted(sum(groups, [])), sorted(paths))
+
+
+class TestRunImports(FunctionalTestBaseClass):
+    def setup(self):
+        super(TestRunImports, self).setup()
+        self.user = factories.User()
+        factories.Group(name='189', user=self.user, type='event')
+
+    def test_it_continues_past_failures(self):
+        paths = [
+            _test_data('MA001_Aptivate_Example.zip'),
+            _test_data('MA001_Aptivate_Example_Update.zip'),
+            _test_data('MA001_Missing_Metadata.zip'),
+        ]
+
+        results = list(bulk.run_imports(bulk.plan_imports(paths),
+                                        self.user['name']))
+        results = dict((os.path.basename(r.path), r) for r in results)
+
+        assert_equal(results['MA001_Aptivate_Example.zip'].name,
+                     '189-ma001-v1')
+        assert_equal(results['MA001_Aptivate_Example_Update.zip'].name,
+                     '189-ma001-v2')
+        assert_equal(results['MA001_Missing_Metadata.zip'].error,
+                     'Upload: Could not find metadata XML in zip file')
+        assert_true(all(r.size > 0 for r in results.values()))
+
+        datasets = helpers.call_action('package_list')
+        assert_equal(sorted(datasets), ['189-ma001-v1', '189-ma001-v2'])
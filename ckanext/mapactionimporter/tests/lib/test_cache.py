@@ -0,0 +1,78 @@
+import unittest
+
+from ckanext.mapactionimporter.lib.cache import TTLCache
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self.cache = TTLCache(max_size=3, ttl=60, clock=self.clock)
+
+    def test_returns_value_until_expired(self):
+        self.cache.set('189', True)
+
+        self.clock.now += 59
+        self.assertTrue(self.cache.get('189'))
+
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get('189'))
+
+    def test_caches_false(self):
+        self.cache.set('189', False)
+
+        self.assertIs(self.cache.get('189'), False)
+
+    def test_evicts_oldest_when_full(self):
+        for key in ('a', 'b', 'c', 'd'):
+            self.cache.set(key, key)
+
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('d'), 'd')
+
+    def test_evicts_expired_before_oldest(self):
+        self.cache.set('a', 'a')
+        self.clock.now += 30
+        self.cache.set('b', 'b')
+        self.cache.set('c', 'c')
+        self.clock.now += 30
+
+        self.cache.set('d', 'd')
+
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get('b'), 'b')
+
+    def test_invalidate_and_clear(self):
+        self.cache.set('a', 'a')
+        self.cache.set('b', 'b')
+
+        self.cache.invalidate('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 'b')
+
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_counts_hits_and_misses(self):
+        self.cache.set('a', 'a')
+
+        self.cache.get('a')
+        self.cache.get('b')
+        self.clock.now += 60
+        self.cache.get('a')
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_disabled_with_zero_ttl(self):
+        self.cache.ttl = 0
+        self.cache.set('a', 'a')
+
+        self.assertIsNone(self.cache.get('a'))
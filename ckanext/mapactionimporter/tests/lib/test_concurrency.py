@@ -0,0 +1,48 @@
+import threading
+import time
+import unittest
+
+from ckanext.mapactionimporter.lib import concurrency
+
+
+class TestMapBounded(unittest.TestCase):
+    def test_results_in_item_order(self):
+        def slow_for_early_items(n):
+            time.sleep((10 - n) * 0.005)
+            return n * 2
+
+        results = concurrency.map_bounded(slow_for_early_items, range(10), 4)
+
+        self.assertEqual(results, [n * 2 for n in range(10)])
+
+    def test_uses_at_most_workers_threads(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def track(n):
+            with lock:
+                running.append(n)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(n)
+
+        concurrency.map_bounded(track, range(12), 3)
+
+        self.assertTrue(max(peak) <= 3)
+
+    def test_raises_first_error_after_all_finished(self):
+        finished = []
+
+        def fail_odd(n):
+            time.sleep(0.01)
+            finished.append(n)
+            if n % 2:
+                raise ValueError(n)
+
+        with self.assertRaises(ValueError) as e:
+            concurrency.map_bounded(fail_odd, range(6), 3)
+
+        self.assertEqual(e.exception.args[0], 1)
+        self.assertEqual(sorted(finished), range(6))
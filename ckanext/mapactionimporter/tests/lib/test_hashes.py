@@ -0,0 +1,105 @@
+import hashlib
+import io
+import shutil
+import tempfile
+import unittest
+
+from ckanext.mapactionimporter.lib import hashes
+from ckanext.mapactionimporter.tests.helpers import get_test_zip
+
+
+class TestHashFile(unittest.TestCase):
+    def test_hashes_whole_file_and_rewinds(self):
+        package = get_test_zip()
+        package.read(10)
+
+        digest = hashes.hash_file(package, chunk_size=100)
+
+        self.assertEqual(digest,
+                         hashlib.sha256(get_test_zip().read()).hexdigest())
+        self.assertEqual(package.tell(), 0)
+
+    def test_copy_and_hash(self):
+        copy = io.BytesIO()
+        digest = hashes.copy_and_hash(get_test_zip(), copy, chunk_size=100)
+
+        self.assertEqual(copy.getvalue(), get_test_zip().read())
+        self.assertEqual(digest, hashes.hash_file(get_test_zip()))
+
+
+class TestBackgroundHash(unittest.TestCase):
+    def test_hashes_file_without_moving_its_position(self):
+        with tempfile.TemporaryFile() as package:
+            package.write(get_test_zip().read())
+            package.seek(10)
+
+            hashing = hashes.BackgroundHash(package, chunk_size=100)
+            self.assertEqual(package.read(5), get_test_zip().read()[10:15])
+
+            self.assertEqual(hashing.result(),
+                             hashes.hash_file(get_test_zip()))
+            self.assertEqual(hashing.size, len(get_test_zip().read()))
+
+    def test_hashes_file_in_memory(self):
+        hashing = hashes.BackgroundHash(io.BytesIO(get_test_zip().read()))
+
+        self.assertEqual(hashing.result(), hashes.hash_file(get_test_zip()))
+
+    def test_hashes_empty_file(self):
+        with tempfile.TemporaryFile() as empty:
+            hashing = hashes.BackgroundHash(empty)
+
+            self.assertEqual(hashing.result(),
+                             hashlib.sha256('').hexdigest())
+            self.assertEqual(hashing.size, 0)
+
+
+class TestDatasetHash(unittest.TestCase):
+    def test_hash_from_extras(self):
+        self.assertEqual(hashes.dataset_hash({'extras': [
+            {'key': 'mapNumber', 'value': 'MA001'},
+            {'key': hashes.HASH_EXTRA, 'value': 'abc'},
+        ]}), 'abc')
+
+    def test_hash_from_schema_field(self):
+        self.assertEqual(
+            hashes.dataset_hash({hashes.HASH_EXTRA: 'abc', 'extras': []}),
+            'abc')
+
+    def test_no_hash(self):
+        self.assertIsNone(hashes.dataset_hash({'extras': []}))
+
+
+class TestPackageHashIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.index = hashes.PackageHashIndex(self.root)
+        self.digest = hashes.hash_file(get_test_zip())
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_add_and_get(self):
+        self.assertIsNone(self.index.get(self.digest))
+
+        self.index.add(self.digest, 'dataset-1')
+        self.assertEqual(self.index.get(self.digest), 'dataset-1')
+
+        self.index.add(self.digest, 'dataset-2')
+        self.assertEqual(self.index.get(self.digest), 'dataset-2')
+
+    def test_remove(self):
+        self.index.add(self.digest, 'dataset-1')
+        self.index.remove(self.digest)
+
+        self.assertIsNone(self.index.get(self.digest))
+
+    def test_persists_across_instances(self):
+        self.index.add(self.digest, 'dataset-1')
+
+        index = hashes.PackageHashIndex(self.root)
+        self.assertEqual(index.get(self.digest), 'dataset-1')
+
+    def test_ignores_anything_but_a_hash(self):
+        for digest in (None, '', '../../etc/passwd', self.digest.upper()):
+            self.assertIsNone(self.index.get(digest))
@@ -0,0 +1,122 @@
+import threading
+import unittest
+
+import mock
+
+import ckan.lib.search as search
+import ckan.model as model
+
+from ckanext.mapactionimporter.lib import indexing
+
+
+class TestDeferred(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(indexing, '_index_package')
+        self.index_package = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(search, 'index_for')
+        self.index_for = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _indexed(self):
+        return [c[0][1] for c in self.index_package.call_args_list]
+
+    def test_package_indexed_once_when_block_ends(self):
+        package = model.Package(id='package-1', name='package-1')
+        plugin = search.SynchronousSearchPlugin()
+
+        with mock.patch.object(search, 'dispatch_by_operation') as dispatch:
+            with indexing.deferred() as batch:
+                for i in range(3):
+                    plugin.notify(package, 'changed')
+                self.assertEqual(list(batch.package_ids), ['package-1'])
+                self.assertEqual(self._indexed(), [])
+
+        self.assertFalse(dispatch.called)
+        self.assertEqual(self._indexed(), ['package-1'])
+        self.assertEqual(self.index_for.return_value.commit.call_count, 1)
+
+    def test_search_plugin_restored_when_last_block_ends(self):
+        notify = search.SynchronousSearchPlugin.notify
+
+        with indexing.deferred():
+            self.assertNotEqual(search.SynchronousSearchPlugin.notify,
+                                notify)
+
+            other_thread_in_block = threading.Event()
+            leave_block = threading.Event()
+
+            def import_in_other_thread():
+                with indexing.deferred():
+                    other_thread_in_block.set()
+                    leave_block.wait()
+
+            thread = threading.Thread(target=import_in_other_thread)
+            thread.start()
+            other_thread_in_block.wait()
+
+        # Still needed by the other thread
+        self.assertNotEqual(search.SynchronousSearchPlugin.notify, notify)
+
+        leave_block.set()
+        thread.join()
+        self.assertEqual(search.SynchronousSearchPlugin.notify, notify)
+
+    def test_search_plugin_restored_when_block_fails(self):
+        notify = search.SynchronousSearchPlugin.notify
+
+        with self.assertRaises(ValueError):
+            with indexing.deferred():
+                raise ValueError()
+
+        self.assertEqual(search.SynchronousSearchPlugin.notify, notify)
+
+    def test_flushed_when_block_fails(self):
+        with self.assertRaises(ValueError):
+            with indexing.deferred() as batch:
+                batch.add('package-1')
+                raise ValueError()
+
+        self.assertEqual(self._indexed(), ['package-1'])
+
+    def test_nested_blocks_share_outer_batch(self):
+        with indexing.deferred() as outer:
+            with indexing.deferred() as inner:
+                inner.add('package-1')
+            self.assertEqual(self._indexed(), [])
+            outer.add('package-2')
+
+        self.assertTrue(inner is outer)
+        self.assertEqual(self._indexed(), ['package-1', 'package-2'])
+
+    def test_given_batch_left_to_caller_to_flush(self):
+        batch = indexing.IndexBatch()
+        with indexing.deferred(batch):
+            batch.add('package-1')
+
+        self.assertEqual(self._indexed(), [])
+
+        batch.flush()
+        self.assertEqual(self._indexed(), ['package-1'])
+
+    def test_indexing_error_does_not_stop_others(self):
+        self.index_package.side_effect = [search.SearchIndexError(), None]
+
+        batch = indexing.IndexBatch()
+        batch.add('package-1')
+        batch.add('package-2')
+        batch.flush()
+
+        self.assertEqual(self._indexed(), ['package-1', 'package-2'])
+
+    def test_commit_error_does_not_hide_original_error(self):
+        self.index_for.return_value.commit.side_effect = \
+            search.SearchIndexError()
+
+        with self.assertRaises(ValueError):
+            with indexing.deferred() as batch:
+                batch.add('package-1')
+                raise ValueError()
+
+        self.assertEqual(self._indexed(), ['package-1'])
@@ -0,0 +1,151 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from ckanext.mapactionimporter.lib import hashes, jobs
+from ckanext.mapactionimporter.tests.helpers import get_test_zip
+
+
+class TestImportJobStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = jobs.ImportJobStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_create_persists_upload(self):
+        job = self.store.create(get_test_zip(), 'joe', {'private': 'True'})
+
+        self.assertEqual(job['status'], jobs.PENDING)
+        self.assertEqual(self.store.get(job['id']), job)
+
+        with open(self.store.package_path(job['id']), 'rb') as f:
+            self.assertEqual(f.read(), get_test_zip().read())
+
+    def test_create_hashes_upload(self):
+        job = self.store.create(get_test_zip(), 'joe')
+
+        self.assertEqual(job['sha256'], hashes.hash_file(get_test_zip()))
+
+    def test_get_raises_for_unknown_job(self):
+        with self.assertRaises(jobs.JobNotFound):
+            self.store.get('missing')
+
+    def test_get_rejects_ids_outside_store(self):
+        os.makedirs(os.path.join(self.root, 'outside'))
+        with open(os.path.join(self.root, 'outside', 'job.json'), 'w') as f:
+            f.write('{}')
+        store = jobs.ImportJobStore(os.path.join(self.root, 'jobs'))
+
+        for job_id in ('../outside', '', None):
+            with self.assertRaises(jobs.JobNotFound):
+                store.get(job_id)
+
+    def test_claims_oldest_pending_job(self):
+        first = self.store.create(get_test_zip(), 'joe')
+        time.sleep(0.01)
+        second = self.store.create(get_test_zip(), 'joe')
+
+        claimed = self.store.claim_next()
+        self.assertEqual(claimed['id'], first['id'])
+        self.assertEqual(claimed['status'], jobs.RUNNING)
+
+        self.assertEqual(self.store.claim_next()['id'], second['id'])
+        self.assertIsNone(self.store.claim_next())
+
+    def test_breaks_claim_of_dead_worker(self):
+        job = self.store.create(get_test_zip(), 'joe')
+        claim_path = os.path.join(self.root, job['id'], 'claim')
+        with open(claim_path, 'w') as f:
+            # No process will have a pid this large
+            f.write('{0} {1}'.format(socket.gethostname(), 2 ** 30))
+
+        self.assertEqual(self.store.claim_next()['id'], job['id'])
+
+    def _claim_from(self, job, host, age=0):
+        claim_path = os.path.join(self.root, job['id'], 'claim')
+        with open(claim_path, 'w') as f:
+            f.write('{0} {1}'.format(host, os.getpid()))
+        claimed_at = time.time() - age
+        os.utime(claim_path, (claimed_at, claimed_at))
+
+        return claim_path
+
+    def test_keeps_claim_of_live_worker_on_another_host(self):
+        store = jobs.ImportJobStore(self.root, claim_timeout=3600)
+        job = store.create(get_test_zip(), 'joe')
+        self._claim_from(job, 'elsewhere', age=60)
+
+        self.assertIsNone(store.claim_next())
+
+    def test_breaks_timed_out_claim_from_another_host(self):
+        store = jobs.ImportJobStore(self.root, claim_timeout=3600)
+        job = store.create(get_test_zip(), 'joe')
+        self._claim_from(job, 'elsewhere', age=7200)
+
+        self.assertEqual(store.claim_next()['id'], job['id'])
+
+    def test_claims_from_another_host_kept_without_timeout(self):
+        job = self.store.create(get_test_zip(), 'joe')
+        self._claim_from(job, 'elsewhere', age=7200)
+
+        self.assertIsNone(self.store.claim_next())
+
+    def test_update_refreshes_claim(self):
+        store = jobs.ImportJobStore(self.root, claim_timeout=3600)
+        job = store.create(get_test_zip(), 'joe')
+        claim_path = self._claim_from(job, 'elsewhere', age=7200)
+
+        store.update(job['id'], stage='uploading')
+
+        self.assertTrue(time.time() - os.path.getmtime(claim_path) < 60)
+        self.assertIsNone(store.claim_next())
+
+    def test_stale_claim_broken_by_one_worker(self):
+        job = self.store.create(get_test_zip(), 'joe')
+        with open(os.path.join(self.root, job['id'], 'claim'), 'w') as f:
+            f.write('{0} {1}'.format(socket.gethostname(), 2 ** 30))
+
+        claimed = []
+        workers = [
+            threading.Thread(target=lambda: claimed.append(
+                jobs.ImportJobStore(self.root)._claim(job['id'])))
+            for i in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(claimed.count(True), 1)
+
+    def test_finish_removes_package(self):
+        job = self.store.create(get_test_zip(), 'joe')
+        self.store.claim_next()
+
+        job = self.store.finish(job['id'], status=jobs.COMPLETE,
+                                result={'name': '189-ma001-v1'})
+
+        self.assertEqual(job['status'], jobs.COMPLETE)
+        self.assertFalse(os.path.exists(self.store.package_path(job['id'])))
+        self.assertIsNone(self.store.claim_next())
+
+    def test_sweep_removes_old_finished_jobs(self):
+        old = self.store.create(get_test_zip(), 'joe')
+        self.store.finish(old['id'], status=jobs.COMPLETE)
+        recent = self.store.create(get_test_zip(), 'joe')
+        self.store.finish(recent['id'], status=jobs.ERROR)
+        pending = self.store.create(get_test_zip(), 'joe')
+
+        an_hour_ago = time.time() - 3600
+        for job in (old, pending):
+            record = os.path.join(self.root, job['id'], 'job.json')
+            os.utime(record, (an_hour_ago, an_hour_ago))
+
+        self.assertEqual(self.store.sweep(60), [old['id']])
+        self.assertEqual(self.store.get(recent['id'])['id'], recent['id'])
+        self.assertEqual(self.store.get(pending['id'])['id'], pending['id'])
@@ -0,0 +1,288 @@
+import hashlib
+import io
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+
+from ckanext.mapactionimporter.lib import mappackage, scratch
+from ckanext.mapactionimporter.tests.helpers import (
+    get_not_zip,
+    get_test_zip,
+    get_zip_no_metadata,
+)
+
+
+def _make_zip(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, data in members:
+            z.writestr(name, data)
+    buf.seek(0)
+    return buf
+
+
+class TestZipMemberStream(unittest.TestCase):
+    def setUp(self):
+        self.data = b'0123456789' * 100000
+        self.zip_file = zipfile.ZipFile(_make_zip([('map.pdf', self.data)]))
+        self.info = self.zip_file.getinfo('map.pdf')
+
+    def test_reads_member_in_chunks(self):
+        stream = mappackage.ZipMemberStream(self.zip_file, self.info)
+        chunks = []
+        while True:
+            chunk = stream.read(2 ** 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertEqual(stream.tell(), len(self.data))
+        self.assertEqual(stream.name, 'map.pdf')
+
+    def test_rewinds_and_reports_size(self):
+        stream = mappackage.ZipMemberStream(self.zip_file, self.info)
+        stream.read(10)
+        stream.seek(0, 2)
+        self.assertEqual(stream.tell(), len(self.data))
+        stream.seek(0)
+
+        self.assertEqual(stream.read(), self.data)
+
+    def test_members_can_be_read_together(self):
+        zip_file = zipfile.ZipFile(_make_zip([('a.pdf', b'a' * 100000),
+                                              ('b.pdf', b'b' * 100000)]))
+        a, b = [mappackage.ZipMemberStream(zip_file, i)
+                for i in zip_file.infolist()]
+
+        chunks = [(a.read(1000), b.read(1000)) for n in range(100)]
+
+        self.assertEqual(b''.join(c[0] for c in chunks), b'a' * 100000)
+        self.assertEqual(b''.join(c[1] for c in chunks), b'b' * 100000)
+
+    def test_members_read_without_reading_central_directory_again(self):
+        zip_file = zipfile.ZipFile(_make_zip([('a.pdf', b'a' * 1000),
+                                              ('b.pdf', b'b' * 1000)]))
+
+        with mock.patch.object(zipfile.ZipFile, '_RealGetContents') as read:
+            data = [mappackage.ZipMemberStream(zip_file, i).read()
+                    for i in zip_file.infolist()]
+
+        self.assertEqual(data, [b'a' * 1000, b'b' * 1000])
+        self.assertFalse(read.called)
+
+    def test_each_zip_file_has_own_read_lock(self):
+        other_zip_file = zipfile.ZipFile(_make_zip([('a.pdf', b'a')]))
+
+        self.assertTrue(mappackage._zip_read_lock(self.zip_file) is
+                        mappackage._zip_read_lock(self.zip_file))
+        self.assertFalse(mappackage._zip_read_lock(self.zip_file) is
+                         mappackage._zip_read_lock(other_zip_file))
+
+    def test_cannot_seek_to_middle(self):
+        stream = mappackage.ZipMemberStream(self.zip_file, self.info)
+
+        with self.assertRaises(IOError):
+            stream.seek(5)
+
+    def test_hashes_member_as_it_is_read(self):
+        stream = mappackage.ZipMemberStream(self.zip_file, self.info)
+        stream.read(10)
+        self.assertEqual(stream.sha256, None)
+
+        stream.seek(0)
+        stream.read()
+
+        self.assertEqual(stream.sha256, hashlib.sha256(self.data).hexdigest())
+
+    def test_raises_on_crc_mismatch(self):
+        self.info.CRC ^= 0xffff
+        stream = mappackage.ZipMemberStream(self.zip_file, self.info)
+
+        with self.assertRaises(mappackage.MapPackageException):
+            while stream.read(2 ** 16):
+                pass
+
+
+class TestStreamMembers(unittest.TestCase):
+    def test_returns_streams_without_extracting(self):
+        zip_file = mappackage.open_zip(get_test_zip())
+        et, infos = mappackage.read_metadata(zip_file)
+        members = mappackage.stream_members(zip_file, infos)
+
+        self.assertEqual(mappackage.get_text_node(et, 'mapNumber'), 'MA001')
+        self.assertEqual(
+            sorted(m.name for m in members),
+            ['MA001_Aptivate_Example-300dpi.jpeg',
+             'MA001_Aptivate_Example-300dpi.pdf'])
+        for member in members:
+            self.assertTrue(
+                isinstance(member, mappackage.ZipMemberStream))
+
+    def test_raises_if_no_metadata(self):
+        with self.assertRaises(mappackage.MapPackageException) as e:
+            mappackage.read_metadata(
+                mappackage.open_zip(get_zip_no_metadata()))
+
+        self.assertEqual(e.exception.args[0],
+                         'Could not find metadata XML in zip file')
+
+
+class TestReadMetadata(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.scratch_space = scratch.ScratchSpace(root)
+
+    def test_only_metadata_is_decompressed(self):
+        zip_file = mappackage.open_zip(get_test_zip())
+
+        with mock.patch.object(zipfile.ZipFile, 'open', autospec=True,
+                               side_effect=zipfile.ZipFile.open) as mock_open:
+            et, members = mappackage.read_metadata(zip_file)
+
+        self.assertEqual(mock_open.call_count, 1)
+        self.assertEqual(mock_open.call_args[0][1].filename,
+                         'MA001_Aptivate_Example.xml')
+        self.assertEqual(
+            sorted(i.filename for i in members),
+            ['MA001_Aptivate_Example-300dpi.jpeg',
+             'MA001_Aptivate_Example-300dpi.pdf'])
+
+    def test_to_dataset_leaves_members_in_zip(self):
+        dataset_info = mappackage.to_dataset({}, get_test_zip())
+
+        self.assertEqual(dataset_info['name'], '189-ma001-v1')
+        self.assertEqual(len(dataset_info['members']), 2)
+        self.assertNotIn('file_paths', dataset_info)
+
+        with self.scratch_space.workspace() as workspace:
+            file_paths = mappackage.extract_resources(
+                dataset_info, workspace=workspace)
+
+        self.assertEqual(dataset_info['file_paths'], file_paths)
+        self.assertEqual(
+            sorted(os.path.basename(p) for p in file_paths),
+            ['MA001_Aptivate_Example-300dpi.jpeg',
+             'MA001_Aptivate_Example-300dpi.pdf'])
+
+    def test_extracted_files_are_hashed(self):
+        dataset_info = mappackage.to_dataset({}, get_test_zip())
+
+        with mock.patch('ckanext.mapactionimporter.lib.hashes.hash_file') \
+                as hash_file, self.scratch_space.workspace() as workspace:
+            file_paths = mappackage.extract_resources(
+                dataset_info, workspace=workspace)
+
+            self.assertFalse(hash_file.called)
+            for path in file_paths:
+                with open(path, 'rb') as the_file:
+                    self.assertEqual(
+                        dataset_info['file_hashes'][os.path.basename(path)],
+                        hashlib.sha256(the_file.read()).hexdigest())
+
+    def test_streamed_files_are_not_hashed_yet(self):
+        dataset_info = mappackage.to_dataset({}, get_test_zip())
+
+        mappackage.extract_resources(dataset_info, stream=True)
+
+        self.assertEqual(dataset_info['file_hashes'], {})
+
+    def test_raises_if_not_a_zip(self):
+        with self.assertRaises(mappackage.MapPackageException) as e:
+            mappackage.open_zip(get_not_zip())
+
+        self.assertEqual(e.exception.args[0], 'File is not a zip file')
+
+
+class TestPackageLimits(unittest.TestCase):
+    def setUp(self):
+        self.zip_file = zipfile.ZipFile(_make_zip([
+            ('map.xml', b'<mapdoc><mapdata/></mapdoc>'),
+            ('map.pdf', b'%PDF' + b'\0' * (4 * 2 ** 20)),
+        ]))
+
+    def test_allows_package_within_limits(self):
+        limits = mappackage.PackageLimits(
+            max_total_size=5 * 2 ** 20, max_members=2)
+
+        et, members = mappackage.read_metadata(self.zip_file, limits=limits)
+        mappackage.stream_members(self.zip_file, members, limits)[0].read()
+
+    def test_rejects_too_many_members(self):
+        self._assert_rejected(mappackage.PackageLimits(max_members=1),
+                              'Zip file contains 2 files, the maximum is 1')
+
+    def test_rejects_large_total_size(self):
+        self._assert_rejected(
+            mappackage.PackageLimits(max_total_size=2 ** 20),
+            'Zip file is larger than the maximum of 1048576 bytes uncompressed')
+
+    def test_rejects_large_member(self):
+        self._assert_rejected(
+            mappackage.PackageLimits(max_member_size=2 ** 20),
+            "File 'map.pdf' is larger than the maximum of 1048576 bytes")
+
+    def test_rejects_high_compression_ratio(self):
+        self._assert_rejected(
+            mappackage.PackageLimits(max_ratio=100),
+            "File 'map.pdf' is compressed more than 100 to 1")
+
+    def test_enforced_on_decompressed_bytes(self):
+        # Central directory claims the member is tiny
+        info = self.zip_file.getinfo('map.pdf')
+        info.file_size = 10
+        limits = mappackage.PackageLimits(max_total_size=2 ** 20)
+        et, members = mappackage.read_metadata(self.zip_file, limits=limits)
+        stream = mappackage.stream_members(self.zip_file, members, limits)[0]
+
+        with self.assertRaises(mappackage.MapPackageException) as e:
+            while stream.read(2 ** 16):
+                pass
+
+        self.assertEqual(
+            e.exception.args[0],
+            "Corrupt file 'map.pdf' in zip file: larger than its declared size")
+
+    def test_rewound_bytes_counted_once(self):
+        limits = mappackage.PackageLimits()
+        stream = mappackage.ZipMemberStream(
+            self.zip_file, self.zip_file.getinfo('map.pdf'), limits)
+        stream.read()
+        stream.seek(0)
+        stream.read()
+
+        self.assertEqual(limits.total_size, 4 + 4 * 2 ** 20)
+
+    def test_bytes_counted_from_several_threads(self):
+        limits = mappackage.PackageLimits()
+        info = self.zip_file.getinfo('map.pdf')
+
+        def consume():
+            for size in range(1, 1001):
+                limits.consume(info, size, 1)
+
+        threads = [threading.Thread(target=consume) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(limits.total_size, 8000)
+
+    def test_no_limits_unless_configured(self):
+        limits = mappackage.PackageLimits.from_config({})
+
+        self.assertEqual((limits.max_total_size, limits.max_members,
+                          limits.max_member_size, limits.max_ratio),
+                         (0, 0, 0, 0))
+
+    def _assert_rejected(self, limits, message):
+        with self.assertRaises(mappackage.MapPackageException) as e:
+            mappackage.read_metadata(self.zip_file, limits=limits)
+
+        self.assertEqual(e.exception.args[0], message)
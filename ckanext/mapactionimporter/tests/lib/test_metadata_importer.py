@@ -1,4 +1,5 @@
 import unittest
+from io import BytesIO
 
 from lxml.etree import fromstring, Element
 from ckanext.mapactionimporter.lib import mappackage
@@ -202,3 +203,66 @@ class TestPopulateDatasetDictFromXml(TestXmlParse):
             child = Element(name)
             child.text = text
             parent.append(child)
+
+
+class TestMapMetadata(TestXmlParse):
+    template_xml = """<?xml version="1.0" encoding="utf-8"?>
+<mapdoc>
+  <mapdata>
+    <operationID>{operationid}</operationID>
+    <title>{title}</title>
+    <status>{status}</status>
+    <themes>
+      <theme>{theme}</theme>
+      <theme>Agriculture</theme>
+    </themes>
+    <mapNumber>{mapnumber}</mapNumber>
+    <versionNumber>{versionnumber}</versionNumber>
+    <countries-iso3>
+      <country-iso3>NPL</country-iso3>
+      <country-iso3>CHN</country-iso3>
+    </countries-iso3>
+  </mapdata>
+  <padding>
+    <junk>ignored</junk>
+  </padding>
+</mapdoc>
+    """
+
+    def test_fields_indexed_from_tree(self):
+        metadata = mappackage.MapMetadata.from_tree(
+            self.parse_xml(mapnumber='MA042'))
+
+        self._check_metadata(metadata)
+
+    def test_fields_indexed_incrementally(self):
+        xml = self.template_xml.format(
+            mapnumber='MA042', operationid='default-op-id',
+            ref='default-ref', status='default-status',
+            summary='default-summary', theme='default-theme',
+            title='default-title', versionnumber='987')
+
+        metadata = mappackage.parse_metadata(
+            BytesIO(xml.encode('utf-8')), incremental=True)
+
+        self._check_metadata(metadata)
+
+    def test_accessors_accept_metadata(self):
+        metadata = mappackage.get_metadata(self.parse_xml())
+
+        self.assertEqual(
+            mappackage.get_mandatory_text_node(metadata, 'versionNumber'),
+            '987')
+        self.assertEqual(
+            mappackage.map_metadata_to_ckan_extras(metadata)['country-iso3'],
+            ['NPL', 'CHN'])
+        self.assertEqual(
+            mappackage.populate_dataset_dict_from_xml(metadata)['name'],
+            'default-op-id-default-map-no-v987')
+
+    def _check_metadata(self, metadata):
+        self.assertEqual(metadata.get('mapNumber'), 'MA042')
+        self.assertEqual(metadata.get('versionNumber'), '987')
+        self.assertEqual(metadata.get('countries-iso3'), ['NPL', 'CHN'])
+        self.assertEqual(metadata.themes, ['default-theme', 'Agriculture'])
+        self.assertIsNone(metadata.get('junk'))
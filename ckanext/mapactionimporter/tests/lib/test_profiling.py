@@ -0,0 +1,88 @@
+import cProfile
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from ckanext.mapactionimporter.lib import profiling
+
+
+class TestProfileStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = profiling.ProfileStore(os.path.join(self.root, 'p'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _profile(self):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        sorted(range(1000))
+        profiler.disable()
+        return profiler
+
+    def test_saves_loadable_stats(self):
+        record = self.store.save(self._profile(), user='joe',
+                                 name='189-ma001-v1', outcome='success')
+
+        self.assertEqual(self.store.get(record['id']), record)
+        self.assertEqual(record['user'], 'joe')
+        pstats.Stats(self.store.stats_path(record['id']))
+
+    def test_lists_most_recent_first(self):
+        first = self.store.save(self._profile())
+        second = self.store.save(self._profile())
+
+        ids = [r['id'] for r in self.store.list()]
+        self.assertEqual(sorted(ids), sorted([first['id'], second['id']]))
+        self.assertEqual(len(self.store.list()), 2)
+
+    def test_list_empty_store(self):
+        self.assertEqual(self.store.list(), [])
+
+    def test_get_rejects_paths(self):
+        with self.assertRaises(profiling.ProfileNotFound):
+            self.store.get('../../etc/passwd')
+
+
+    def test_sweep_removes_old_profiles(self):
+        old = self.store.save(self._profile())
+        new = self.store.save(self._profile())
+        for path in (self.store.stats_path(old['id']),
+                     self.store._record_path(old['id'])):
+            os.utime(path, (0, 0))
+
+        self.assertEqual(self.store.sweep(60), [old['id']])
+        self.assertEqual([r['id'] for r in self.store.list()], [new['id']])
+        self.assertFalse(os.path.exists(self.store.stats_path(old['id'])))
+
+    def test_sweep_removes_stats_without_record(self):
+        profile = self._profile()
+        os.makedirs(self.store.root)
+        profile.dump_stats(self.store.stats_path('abc123'))
+        os.utime(self.store.stats_path('abc123'), (0, 0))
+
+        self.assertEqual(self.store.sweep(60), ['abc123'])
+        self.assertEqual(os.listdir(self.store.root), [])
+
+    def test_sweep_empty_store(self):
+        self.assertEqual(self.store.sweep(60), [])
+
+
+class TestShouldProfile(unittest.TestCase):
+    def test_sysadmin_request(self):
+        self.assertTrue(profiling.should_profile(
+            {}, requested=True, is_sysadmin=True))
+        self.assertFalse(profiling.should_profile(
+            {}, requested=True, is_sysadmin=False))
+
+    def test_sampled(self):
+        config = {'ckanext.mapactionimporter.profile_sample_rate': '0.1'}
+
+        self.assertTrue(profiling.should_profile(config, sample=lambda: 0.05))
+        self.assertFalse(profiling.should_profile(config, sample=lambda: 0.5))
+
+    def test_off_by_default(self):
+        self.assertFalse(profiling.should_profile({}, sample=lambda: 0))
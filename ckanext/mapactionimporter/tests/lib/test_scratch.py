@@ -0,0 +1,103 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from ckanext.mapactionimporter.lib import mappackage, scratch
+from ckanext.mapactionimporter.tests.helpers import get_test_zip
+
+
+class TestScratchSpace(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.scratch_space = scratch.ScratchSpace(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_workspace_removed_after_import(self):
+        with self.scratch_space.workspace() as workspace:
+            file_paths = self._extract(workspace)
+            self.assertTrue(all(os.path.exists(p) for p in file_paths))
+
+        self.assertFalse(any(os.path.exists(p) for p in file_paths))
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(workspace.bytes_used, 1177183 + 641641)
+
+    def test_workspace_removed_on_failure(self):
+        with self.assertRaises(ValueError):
+            with self.scratch_space.workspace() as workspace:
+                self._extract(workspace)
+                raise ValueError()
+
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_workspace_not_created_until_used(self):
+        with self.scratch_space.workspace():
+            self.assertEqual(os.listdir(self.root), [])
+
+    def test_raises_when_cap_exceeded(self):
+        self.scratch_space.max_bytes = 1000000
+
+        with self.assertRaises(scratch.ScratchSpaceExceeded):
+            with self.scratch_space.workspace() as workspace:
+                self._extract(workspace)
+
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_cap_shared_by_concurrent_imports(self):
+        self.scratch_space.max_bytes = 2000000
+
+        with self.scratch_space.workspace() as first:
+            self._extract(first)
+            with self.assertRaises(scratch.ScratchSpaceExceeded):
+                with self.scratch_space.workspace() as second:
+                    self._extract(second)
+
+        with self.scratch_space.workspace() as workspace:
+            self._extract(workspace)
+
+    def test_cap_counts_other_processes_workspaces(self):
+        self.scratch_space.max_bytes = 2000000
+        other = self._make_workspace(os.getpid() + 1)
+        with open(os.path.join(other, 'map.pdf'), 'wb') as the_file:
+            the_file.write(b'\0' * 1000000)
+
+        with self.assertRaises(scratch.ScratchSpaceExceeded):
+            with self.scratch_space.workspace() as workspace:
+                self._extract(workspace)
+
+    def test_reservations_released_with_workspace(self):
+        with self.scratch_space.workspace() as workspace:
+            self._extract(workspace)
+            self.assertEqual(self.scratch_space._reserved, 1177183 + 641641)
+
+        self.assertEqual(self.scratch_space._reserved, 0)
+
+    def test_sweep_removes_orphaned_workspaces(self):
+        # No process will have a pid this large
+        orphaned = self._make_workspace(2 ** 30)
+        active = self._make_workspace(os.getpid())
+
+        removed = self.scratch_space.sweep()
+
+        self.assertEqual(removed, [orphaned])
+        self.assertTrue(os.path.exists(active))
+
+    def test_sweep_removes_expired_workspaces(self):
+        self.scratch_space.max_age = 60
+        expired = self._make_workspace(os.getpid())
+        os.utime(expired, (0, 0))
+
+        self.assertEqual(self.scratch_space.sweep(), [expired])
+
+    def _extract(self, workspace):
+        dataset_info = mappackage.to_dataset({}, get_test_zip())
+        return mappackage.extract_resources(dataset_info, workspace=workspace)
+
+    def _make_workspace(self, pid):
+        return tempfile.mkdtemp(
+            scratch.WORKSPACE_SUFFIX,
+            prefix='{0}-{1}-'.format(socket.gethostname(), pid),
+            dir=self.root)
@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from io import BytesIO
+
+from ckanext.mapactionimporter.lib import jobs, staging
+from ckanext.mapactionimporter.tests.helpers import get_test_zip
+
+
+class TestUploadStagingStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = staging.UploadStagingStore(self.root)
+        self.package = get_test_zip().read()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _send(self, session, first, last):
+        return self.store.append(session['id'], first, last,
+                                 BytesIO(self.package[first:last + 1]),
+                                 total=len(self.package))
+
+    def test_chunks_assembled_in_order(self):
+        session = self.store.start('joe', filename='MA001.zip')
+
+        middle = len(self.package) // 2
+        self._send(session, 0, middle - 1)
+        session = self._send(session, middle, len(self.package) - 1)
+
+        self.assertEqual(session['received'], len(self.package))
+        with open(self.store.complete(session['id']), 'rb') as f:
+            self.assertEqual(f.read(), self.package)
+
+    def test_resumes_after_partial_chunk(self):
+        session = self.store.start('joe', size=len(self.package))
+        self._send(session, 0, 999)
+
+        # The connection dropped part way through the next chunk
+        with self.assertRaises(staging.InvalidChunk):
+            self.store.append(session['id'], 1000, 2999,
+                              BytesIO(self.package[1000:1500]))
+        received = self.store.get(session['id'])['received']
+        self.assertEqual(received, 1000)
+
+        self._send(session, received, len(self.package) - 1)
+
+        with open(self.store.complete(session['id']), 'rb') as f:
+            self.assertEqual(f.read(), self.package)
+
+    def test_rejects_chunk_not_at_end(self):
+        session = self.store.start('joe')
+        self._send(session, 0, 999)
+
+        with self.assertRaises(staging.UploadRangeError) as cm:
+            self._send(session, 2000, 2999)
+        self.assertEqual(cm.exception.session['received'], 1000)
+
+        # A repeated chunk is rejected too
+        with self.assertRaises(staging.UploadRangeError):
+            self._send(session, 0, 999)
+
+    def test_rejects_chunk_longer_than_range(self):
+        session = self.store.start('joe', size=len(self.package))
+
+        with self.assertRaises(staging.InvalidChunk):
+            self.store.append(session['id'], 0, 999,
+                              BytesIO(self.package[:2000]))
+
+        self.assertEqual(self.store.get(session['id'])['received'], 0)
+        self.assertEqual(
+            os.path.getsize(self.store.package_path(session['id'])), 0)
+
+    def test_rejects_chunk_past_declared_size(self):
+        session = self.store.start('joe', size=1000)
+
+        with self.assertRaises(staging.InvalidChunk):
+            self.store.append(session['id'], 0, 1999,
+                              BytesIO(self.package[:2000]))
+
+        self.assertEqual(self.store.get(session['id'])['received'], 0)
+
+    def test_rejects_upload_over_max_size(self):
+        self.store.max_size = 1000
+
+        with self.assertRaises(staging.UploadTooLarge):
+            self.store.start('joe', size=2000)
+
+        # Nor can a chunk take an upload of unknown size over it
+        session = self.store.start('joe')
+        self.store.append(session['id'], 0, 999,
+                          BytesIO(self.package[:1000]))
+        with self.assertRaises(staging.UploadTooLarge):
+            self.store.append(session['id'], 1000, 1999,
+                              BytesIO(self.package[1000:2000]))
+        self.assertEqual(self.store.get(session['id'])['received'], 1000)
+
+    def test_rejects_upload_when_store_is_full(self):
+        self.store.max_bytes = 1500
+        first = self.store.start('joe')
+        self._send(first, 0, 999)
+
+        second = self.store.start('joe')
+        with self.assertRaises(staging.UploadTooLarge):
+            self._send(second, 0, 999)
+
+        self.store.discard(first['id'])
+        self._send(second, 0, 999)
+
+    def test_incomplete_upload_cannot_be_imported(self):
+        session = self.store.start('joe', size=len(self.package))
+        self._send(session, 0, 999)
+
+        with self.assertRaises(staging.UploadIncomplete):
+            self.store.complete(session['id'])
+
+    def test_unknown_upload(self):
+        with self.assertRaises(staging.UploadNotFound):
+            self.store.get('0123abcd')
+        with self.assertRaises(staging.UploadNotFound):
+            self.store.get('../jobs')
+
+    def test_sweep_removes_abandoned_uploads(self):
+        old = self.store.start('joe')
+        new = self.store.start('joe')
+        record = os.path.join(self.root, old['id'], 'upload.json')
+        an_hour_ago = time.time() - 3600
+        os.utime(record, (an_hour_ago, an_hour_ago))
+
+        self.assertEqual(self.store.sweep(60), [old['id']])
+        self.assertEqual(self.store.get(new['id'])['id'], new['id'])
+
+    def test_staged_package_moved_into_job_queue(self):
+        session = self.store.start('joe')
+        self._send(session, 0, len(self.package) - 1)
+        path = self.store.complete(session['id'])
+
+        job_store = jobs.ImportJobStore(os.path.join(self.root, 'jobs'))
+        job = job_store.create_from_path(path, 'joe')
+
+        self.assertFalse(os.path.exists(path))
+        with open(job_store.package_path(job['id']), 'rb') as f:
+            self.assertEqual(f.read(), self.package)
+
+
+class TestStagingStoreFromConfig(unittest.TestCase):
+    def _max_size(self, **config):
+        return staging.staging_store_from_config(dict(
+            ('ckanext.mapactionimporter.' + k, v)
+            for k, v in config.items())).max_size
+
+    def test_uploads_limited_by_default(self):
+        self.assertEqual(self._max_size(), 2 * 2 ** 30)
+
+    def test_limited_to_max_uncompressed_size(self):
+        self.assertEqual(self._max_size(max_uncompressed_size='1000'), 1000)
+
+    def test_configured_limit_used(self):
+        self.assertEqual(self._max_size(staging_max_size='1000',
+                                        max_uncompressed_size='2000'), 1000)
+        self.assertEqual(self._max_size(staging_max_size='0'), 0)
+
+
+class TestParseContentRange(unittest.TestCase):
+    def test_parses_range(self):
+        self.assertEqual(staging.parse_content_range('bytes 0-99/1000'),
+                         (0, 99, 1000))
+        self.assertEqual(staging.parse_content_range('bytes 100-199/*'),
+                         (100, 199, None))
+
+    def test_rejects_invalid_range(self):
+        for header in (None, '', 'bytes 0-99', 'bytes 99-0/1000',
+                       'bytes 0-1000/1000', 'items 0-1/2'):
+            with self.assertRaises(ValueError):
+                staging.parse_content_range(header)
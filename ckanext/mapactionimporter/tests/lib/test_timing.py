@@ -0,0 +1,75 @@
+import threading
+import unittest
+
+from ckanext.mapactionimporter.lib import mappackage
+from ckanext.mapactionimporter.lib.timing import StageTimer, timed
+from ckanext.mapactionimporter.tests.helpers import get_test_zip
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestStageTimer(unittest.TestCase):
+    def test_records_time_and_bytes_per_stage(self):
+        clock = _Clock()
+        timer = StageTimer(clock=clock)
+
+        with timer.stage('extract', 1000):
+            clock.now += 2
+        with timer.stage('upload', item='map.pdf') as record:
+            clock.now += 3
+            record['bytes'] = 500
+
+        self.assertEqual(timer.as_dict(), {
+            'total_seconds': 5,
+            'total_bytes': 1500,
+            'stages': [
+                {'stage': 'extract', 'bytes': 1000, 'seconds': 2},
+                {'stage': 'upload', 'item': 'map.pdf', 'bytes': 500,
+                 'seconds': 3},
+            ],
+        })
+
+    def test_records_failed_stage(self):
+        timer = StageTimer()
+
+        with self.assertRaises(ValueError):
+            with timer.stage('parse_metadata'):
+                raise ValueError()
+
+        self.assertEqual([s['stage'] for s in timer.stages],
+                         ['parse_metadata'])
+
+    def test_stages_timed_from_threads(self):
+        timer = StageTimer()
+
+        def upload(i):
+            with timer.stage('upload', i):
+                pass
+
+        threads = [threading.Thread(target=upload, args=(i,))
+                   for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(timer.as_dict()['total_bytes'], sum(range(10)))
+
+    def test_timed_without_timer(self):
+        with timed(None, 'extract', 10) as record:
+            record['bytes'] = 20
+
+    def test_to_dataset_stages(self):
+        timer = StageTimer()
+
+        mappackage.to_dataset({}, get_test_zip(), timer=timer)
+
+        self.assertEqual([s['stage'] for s in timer.stages],
+                         ['open_zip', 'parse_metadata', 'populate_dataset'])
+        self.assertEqual(timer.stages[1]['bytes'], 1926)
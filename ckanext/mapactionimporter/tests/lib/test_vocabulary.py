@@ -0,0 +1,80 @@
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.helpers as helpers
+import ckan.tests.factories as factories
+
+from ckanext.mapactionimporter.lib.mappackage import PRODUCT_THEMES
+from ckanext.mapactionimporter.lib.vocabulary import sync_vocabulary
+from ckanext.mapactionimporter.plugin import create_product_themes
+from ckanext.mapactionimporter.tests.helpers import (
+    FunctionalTestBaseClass,
+    assert_equal,
+    assert_raises,
+)
+
+
+class TestSyncVocabulary(FunctionalTestBaseClass):
+    def setup(self):
+        super(TestSyncVocabulary, self).setup()
+        self.context = {
+            'model': model,
+            'session': model.Session,
+            'user': factories.Sysadmin()['name'],
+        }
+
+    def _tags(self, name):
+        return sorted(helpers.call_action('tag_list', vocabulary_id=name))
+
+    def test_creates_vocabulary(self):
+        report = sync_vocabulary(self.context, 'languages',
+                                 ['French', 'English'])
+
+        assert_equal(report, {
+            'vocabulary': 'languages',
+            'created': True,
+            'added': ['English', 'French'],
+            'removed': [],
+        })
+        assert_equal(self._tags('languages'), ['English', 'French'])
+
+    def test_applies_differences(self):
+        sync_vocabulary(self.context, 'languages', ['English', 'French'])
+
+        report = sync_vocabulary(self.context, 'languages',
+                                 ['English', 'Spanish'])
+
+        assert_equal(report['created'], False)
+        assert_equal(report['added'], ['Spanish'])
+        assert_equal(report['removed'], ['French'])
+        assert_equal(self._tags('languages'), ['English', 'Spanish'])
+
+    def test_dry_run_changes_nothing(self):
+        sync_vocabulary(self.context, 'languages', ['English'])
+
+        report = sync_vocabulary(self.context, 'languages', ['French'],
+                                 dry_run=True)
+
+        assert_equal(report['added'], ['French'])
+        assert_equal(report['removed'], ['English'])
+        assert_equal(self._tags('languages'), ['English'])
+
+    def test_invalid_tag_changes_nothing(self):
+        sync_vocabulary(self.context, 'languages', ['English'])
+
+        with assert_raises(toolkit.ValidationError):
+            sync_vocabulary(self.context, 'languages', ['French', 'x' * 200])
+
+        assert_equal(self._tags('languages'), ['English'])
+
+    def test_requires_sysadmin(self):
+        context = dict(self.context, user=factories.User()['name'])
+
+        with assert_raises(toolkit.NotAuthorized):
+            sync_vocabulary(context, 'languages', ['English'])
+
+    def test_product_themes_up_to_date(self):
+        report = create_product_themes()
+
+        assert_equal(report['added'], [])
+        assert_equal(report['removed'], [])
+        assert_equal(self._tags('product_themes'), sorted(PRODUCT_THEMES))
@@ -1,13 +1,25 @@
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
 import mock
 from defusedxml.ElementTree import parse
 import xml.etree.ElementTree as ET
 
 from ckan.common import config
+import ckan.lib.plugins as lib_plugins
+import ckan.lib.search as search
+import ckan.model as model
+import ckan.plugins as plugins
 import ckan.tests.helpers as helpers
 import ckan.tests.factories as factories
 import ckan.plugins.toolkit as toolkit
 import ckan.lib.uploader as uploader
 
+from ckanext.mapactionimporter.lib import hashes, jobs, mappackage, staging
+from ckanext.mapactionimporter.logic.action import create
+from ckanext.mapactionimporter.logic.action.create import run_import_job
 from ckanext.mapactionimporter.tests.helpers import (
     FunctionalTestBaseClass,
     assert_equal,
@@ -19,6 +31,7 @@ from ckanext.mapactionimporter.tests.helpers import (
     get_country_group_zip,
     get_missing_fields_zip,
     get_not_zip,
+    get_resubmitted_zip,
     get_special_characters_zip,
     get_test_zip,
     get_test_schema_zip,
@@ -188,7 +201,7 @@ class TestCreateDatasetForEvent(TestDatasetForEvent):
             'package_list',
             context={'user': self.user['name']})
 
-        # The dataset will be in the trash so won't appear here
+        # The dataset will have been purged
         assert_equal(len(datasets), 0)
 
         uploader._max_resource_size = old_max_resource_size
@@ -201,6 +214,438 @@ class TestCreateDatasetForEvent(TestDatasetForEvent):
             dataset['name'],
             '189-ma001-v1')
 
+    def test_it_returns_timings_when_debugging(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            upload=_UploadFile(get_test_zip()),
+            debug=True)
+
+        timings = dataset['import_timings']
+        stages = [s['stage'] for s in timings['stages']]
+        for stage in ('parse_metadata', 'validate', 'extract',
+                      'package_create', 'upload', 'dataset_version_create'):
+            assert_true(stage in stages, stage)
+
+        uploads = dict((s['item'], s['bytes']) for s in timings['stages']
+                       if s['stage'] == 'upload')
+        assert_equal(uploads, {
+            'MA001_Aptivate_Example-300dpi.jpeg': 1177183,
+            'MA001_Aptivate_Example-300dpi.pdf': 641641,
+        })
+
+    def test_timings_not_returned_by_default(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            upload=_UploadFile(get_test_zip()))
+
+        assert_false('import_timings' in dataset)
+
+    def test_it_profiles_import_for_sysadmin(self):
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+        before = len(helpers.call_action('mapaction_import_profile_list',
+                                         context=dict(context)))
+
+        helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context=dict(context),
+            upload=_UploadFile(get_test_zip()),
+            profile=True)
+
+        profiles = helpers.call_action('mapaction_import_profile_list',
+                                       context=dict(context))
+        assert_equal(len(profiles), before + 1)
+        assert_equal(profiles[0]['name'], '189-ma001-v1')
+        assert_equal(profiles[0]['outcome'], 'success')
+
+    def test_only_sysadmins_see_profiles(self):
+        with assert_raises(toolkit.NotAuthorized):
+            helpers.call_action(
+                'mapaction_import_profile_list',
+                context={'user': self.user['name'], 'ignore_auth': False})
+
+    @helpers.change_config('ckanext.mapactionimporter.upload_workers', 4)
+    def test_it_uploads_files_concurrently(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            upload=_UploadFile(get_test_zip()))
+
+        dataset = helpers.call_action('ckan_package_show', id=dataset['id'])
+        resources = sorted(dataset['resources'], key=lambda k: k['format'])
+
+        assert_equal(len(resources), 2)
+        self._check_uploaded_resource(resources[0],
+                                      'JPEG',
+                                      'MA001_Aptivate_Example-300dpi.jpeg',
+                                      'ma001_aptivate_example-300dpi.jpeg')
+        self._check_uploaded_resource(resources[1],
+                                      'PDF',
+                                      'MA001_Aptivate_Example-300dpi.pdf',
+                                      'ma001_aptivate_example-300dpi.pdf')
+
+    @helpers.change_config('ckanext.mapactionimporter.stream_uploads', True)
+    def test_streamed_files_hashed_without_another_update(self):
+        get_action = toolkit.get_action
+        called = []
+
+        def record_action(name):
+            called.append(name)
+            return get_action(name)
+
+        with mock.patch.object(toolkit, 'get_action',
+                               side_effect=record_action):
+            dataset = helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                upload=_UploadFile(get_test_zip()))
+
+        # Leaving aside the parent dataset's, made by dataset_version_create
+        import_actions = called[:called.index('dataset_version_create')]
+        assert_false('package_update' in import_actions)
+
+        dataset = helpers.call_action('ckan_package_show', id=dataset['id'])
+        for resource in dataset['resources']:
+            assert_equal(len(resource['hash']), 64)
+
+    @helpers.change_config('ckanext.mapactionimporter.stream_uploads', True)
+    @helpers.change_config('ckanext.mapactionimporter.upload_workers', 4)
+    def test_concurrently_streamed_files_hashed(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            upload=_UploadFile(get_test_zip()))
+
+        dataset = helpers.call_action('ckan_package_show', id=dataset['id'])
+        for resource in dataset['resources']:
+            assert_equal(len(resource['hash']), 64)
+
+    @helpers.change_config('ckanext.mapactionimporter.upload_workers', 4)
+    def test_it_tidies_up_if_concurrent_upload_fails(self):
+        old_max_resource_size = uploader._max_resource_size
+        uploader._max_resource_size = 1
+
+        try:
+            with assert_raises(toolkit.ValidationError) as cm:
+                helpers.call_action(
+                    'create_dataset_from_mapaction_zip',
+                    upload=_UploadFile(get_test_zip()))
+        finally:
+            uploader._max_resource_size = old_max_resource_size
+
+        assert_equal(cm.exception.error_summary,
+                     {'Upload':
+                      'File upload too large'})
+
+        datasets = helpers.call_action(
+            'package_list',
+            context={'user': self.user['name']})
+        assert_equal(len(datasets), 0)
+
+    def test_it_queues_import_in_background(self):
+        result = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()),
+            background=True)
+
+        assert_equal(result['status'], 'pending')
+        assert_equal(
+            helpers.call_action('package_list',
+                                context={'user': self.user['name']}),
+            [])
+
+        store = jobs.job_store_from_config(config)
+        job = run_import_job(store, store.claim_next())
+
+        assert_equal(job['status'], 'complete')
+        assert_equal(job['result']['name'], '189-ma001-v1')
+
+        dataset = helpers.call_action('ckan_package_show', id='189-ma001-v1')
+        assert_equal(len(dataset['resources']), 2)
+
+        status = helpers.call_action(
+            'mapaction_import_job_status',
+            context={'user': self.user['name']},
+            id=result['job_id'])
+        assert_equal(status['status'], 'complete')
+
+    def test_job_status_same_for_missing_and_others_jobs(self):
+        result = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()),
+            background=True)
+        another_user = factories.User()
+
+        for job_id in (result['job_id'], 'abc123'):
+            with assert_raises(toolkit.NotAuthorized):
+                helpers.call_action(
+                    'mapaction_import_job_status',
+                    context={'user': another_user['name'],
+                             'ignore_auth': False},
+                    id=job_id)
+
+        sysadmin = factories.Sysadmin()
+        with assert_raises(toolkit.ObjectNotFound):
+            helpers.call_action(
+                'mapaction_import_job_status',
+                context={'user': sysadmin['name'], 'ignore_auth': False},
+                id='abc123')
+
+    def test_background_import_records_errors(self):
+        result = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_zip_no_metadata()),
+            background=True)
+
+        store = jobs.job_store_from_config(config)
+        job = run_import_job(store, store.claim_next())
+
+        assert_equal(job['id'], result['job_id'])
+        assert_equal(job['status'], 'error')
+        assert_equal(job['error'],
+                     {'Upload': 'Could not find metadata XML in zip file'})
+
+    def _stage_upload(self, package, complete=True):
+        store = staging.staging_store_from_config(config)
+        session = store.start(self.user['name'], size=len(package))
+        if complete:
+            store.append(session['id'], 0, len(package) - 1,
+                         BytesIO(package))
+
+        return store, session['id']
+
+    def test_it_imports_staged_upload(self):
+        store, upload_id = self._stage_upload(get_test_zip().read())
+
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            staged_upload=upload_id)
+
+        assert_equal(dataset['name'], '189-ma001-v1')
+        assert_equal(len(dataset['resources']), 2)
+        assert_raises(staging.UploadNotFound, store.get, upload_id)
+
+    def test_it_keeps_staged_upload_if_import_fails(self):
+        store, upload_id = self._stage_upload(get_zip_no_metadata().read())
+
+        assert_raises(
+            toolkit.ValidationError,
+            helpers.call_action,
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            staged_upload=upload_id)
+
+        assert_equal(store.get(upload_id)['id'], upload_id)
+
+    def test_it_rejects_incomplete_staged_upload(self):
+        store, upload_id = self._stage_upload(get_test_zip().read(),
+                                              complete=False)
+
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                staged_upload=upload_id)
+
+        assert_equal(cm.exception.error_dict,
+                     {'staged_upload': ['Upload is not complete']})
+
+    def test_it_rejects_another_users_staged_upload(self):
+        store, upload_id = self._stage_upload(get_test_zip().read())
+        other_user = factories.User()
+
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': other_user['name']},
+                staged_upload=upload_id)
+
+        assert_equal(cm.exception.error_dict,
+                     {'staged_upload': ['Upload not found']})
+
+    def test_it_queues_staged_upload_in_background(self):
+        store, upload_id = self._stage_upload(get_test_zip().read())
+
+        result = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            staged_upload=upload_id,
+            background=True)
+
+        assert_raises(staging.UploadNotFound, store.get, upload_id)
+
+        job_store = jobs.job_store_from_config(config)
+        job = run_import_job(job_store, job_store.claim_next())
+
+        assert_equal(job['id'], result['job_id'])
+        assert_equal(job['result']['name'], '189-ma001-v1')
+
+    def test_dataset_indexed_once(self):
+        index_package = search.index.PackageSearchIndex.index_package
+        with mock.patch.object(search.index.PackageSearchIndex,
+                               'index_package', autospec=True,
+                               side_effect=index_package) as mocked:
+            dataset = helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_test_zip()))
+
+        indexed = [c[0][1]['id'] for c in mocked.call_args_list]
+        assert_equal(indexed.count(dataset['id']), 1)
+
+        found = helpers.call_action('package_search',
+                                    q='name:189-ma001-v1')
+        assert_equal(found['count'], 1)
+        assert_equal(len(found['results'][0]['resources']), 2)
+
+    def test_import_records_one_activity(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+
+        activities = helpers.call_action('package_activity_list',
+                                         id=dataset['id'])
+        assert_equal(len(activities), 1)
+        assert_equal(activities[0]['activity_type'], 'new package')
+        assert_equal(activities[0]['user_id'], self.user['id'])
+        assert_equal(activities[0]['data']['package']['name'],
+                     '189-ma001-v1')
+        assert_equal(activities[0]['data']['import']['summary'],
+                     'Imported MA001 v1 with 2 resources')
+
+    def test_update_records_one_activity(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+
+        helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_correction_zip()))
+
+        activities = helpers.call_action('package_activity_list',
+                                         id=dataset['id'])
+        assert_equal(len(activities), 2)
+        assert_equal(activities[0]['activity_type'], 'changed package')
+        summary = activities[0]['data']['import']
+        assert_equal(summary['status'], 'Correction')
+        assert_equal(summary['resource_changes']['changed'],
+                     ['MA001_Aptivate_Example-300dpi.jpeg'])
+
+    def test_activities_of_other_datasets_recorded(self):
+        helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+
+        # The dataset that dataset_version_create adds the version to
+        activities = helpers.call_action('package_activity_list',
+                                         id='189-ma001')
+        assert_true(activities)
+        assert_false(any('import' in a['data'] for a in activities))
+
+    def test_activities_not_collapsed_if_disabled(self):
+        config['ckanext.mapactionimporter.collapse_activities'] = 'false'
+        try:
+            dataset = helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_test_zip()))
+        finally:
+            config.pop('ckanext.mapactionimporter.collapse_activities')
+
+        activities = helpers.call_action('package_activity_list',
+                                         id=dataset['id'])
+        assert_true(activities)
+        assert_false(any('import' in a['data'] for a in activities))
+
+    def test_dataset_records_package_hash(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        assert_equal(hashes.dataset_hash(dataset),
+                     hashes.hash_file(get_test_zip()))
+
+    def test_resubmitted_package_returns_existing_dataset(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+
+        with mock.patch.object(mappackage, 'to_dataset') as to_dataset:
+            duplicate = helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_test_zip()))
+
+        assert_false(to_dataset.called)
+        assert_equal(duplicate['id'], dataset['id'])
+        assert_equal(
+            len(helpers.call_action('package_list',
+                                    context={'user': self.user['name']})),
+            1)
+
+    def test_package_imported_again_once_dataset_deleted(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+        helpers.call_action('dataset_purge', id=dataset['id'])
+
+        dataset_again = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+
+        assert_true(dataset_again['id'] != dataset['id'])
+
+    def test_it_raises_before_writing_if_dataset_invalid(self):
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_test_zip()),
+                owner_org='does-not-exist')
+
+        assert_true('owner_org' in cm.exception.error_dict)
+
+        datasets = helpers.call_action(
+            'package_list',
+            context={'user': self.user['name']})
+        assert_equal(len(datasets), 0)
+
+    def test_package_create_uses_validated_dataset(self):
+        prevalidated = create.prevalidated
+        results = []
+
+        def record(context, data_dict, action):
+            result = prevalidated(context, data_dict, action)
+            results.append((action, result))
+            return result
+
+        with mock.patch.object(create, 'prevalidated', side_effect=record):
+            dataset = helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                upload=_UploadFile(get_test_zip()))
+
+        reused = [(action, result) for (action, result) in results
+                  if result is not None]
+        assert_equal([action for (action, result) in reused],
+                     ['package_create'])
+
+        # As package_create unpacks what IDatasetForm.validate returns
+        data, errors = reused[0][1]
+        assert_equal(data['name'], '189-ma001-v1')
+        assert_equal(errors, {})
+        assert_equal(dataset['name'], '189-ma001-v1')
+        assert_equal(dataset['product_themes'], ['Orientation and Reference'])
+
     def test_it_raises_if_file_has_special_characters(self):
         with assert_raises(toolkit.ValidationError) as cm:
             helpers.call_action(
@@ -239,6 +684,30 @@ class TestCreateDatasetForEvent(TestDatasetForEvent):
         assert_equal(len(events), 1)
         assert_equal(events[0]['name'], '189')
 
+    def test_group_member_can_import_without_updating_group(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name'], 'ignore_auth': False},
+            upload=_UploadFile(get_test_zip()),
+        )
+
+        assert_equal(dataset['name'], '189-ma001-v1')
+        assert_equal(len(dataset['resources']), 2)
+        assert_equal([g['name'] for g in dataset['groups']], ['189'])
+
+    def test_it_raises_if_user_not_member_of_event(self):
+        user = factories.User()
+
+        with assert_raises(toolkit.NotAuthorized):
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': user['name'], 'ignore_auth': False},
+                upload=_UploadFile(get_test_zip()),
+            )
+
+        datasets = helpers.call_action('package_list')
+        assert_equal(len(datasets), 0)
+
     def test_new_version_associated_with_existing(self):
         organization = factories.Organization(user=self.user)
         version_1 = helpers.call_action(
@@ -309,7 +778,7 @@ class TestCreateDatasetForEvent(TestDatasetForEvent):
             helpers.call_action(
                 'create_dataset_from_mapaction_zip',
                 context={'user': self.user['name']},
-                upload=_UploadFile(get_update_zip())
+                upload=_UploadFile(get_resubmitted_zip(get_update_zip()))
             )
 
         assert_equal(
@@ -331,6 +800,278 @@ class TestCreateDatasetForEvent(TestDatasetForEvent):
         })
 
 
+class TestValidateZip(TestDatasetForEvent):
+    def test_it_returns_dataset_without_importing(self):
+        with mock.patch.object(mappackage, 'extract_resources') as extract:
+            result = helpers.call_action(
+                'validate_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_test_zip()))
+
+        assert_false(extract.called)
+        assert_equal(result['action'], 'create')
+        assert_equal(result['status'], 'New')
+        assert_equal(result['operation_id'], '189')
+        assert_equal(result['dataset']['name'], '189-ma001-v1')
+        assert_equal(result['dataset']['groups'], [{'name': '189'}])
+        assert_equal(
+            sorted(r['name'] for r in result['resources']),
+            ['MA001_Aptivate_Example-300dpi.jpeg',
+             'MA001_Aptivate_Example-300dpi.pdf'])
+        assert_true(all(r['size'] > 0 for r in result['resources']))
+
+        assert_equal(
+            helpers.call_action('package_list',
+                                context={'user': self.user['name']}),
+            [])
+
+    def test_it_returns_dataset_to_be_corrected(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+
+        result = helpers.call_action(
+            'validate_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_correction_zip()))
+
+        assert_equal(result['action'], 'update')
+        assert_equal(result['dataset']['id'], dataset['id'])
+        assert_equal(result['dataset']['notes'], 'Updated summary')
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        assert_true(dataset['notes'] != 'Updated summary')
+
+    def test_it_raises_if_status_conflicts(self):
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'validate_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_correction_zip()))
+
+        assert_equal(
+            cm.exception.error_summary,
+            {
+                'Upload':
+                "Status is 'Correction' but dataset '189-ma001-v1' does not exist"
+            })
+
+    def test_it_raises_if_no_metadata(self):
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'validate_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_zip_no_metadata()))
+
+        assert_equal(cm.exception.error_summary,
+                     {'Upload': 'Could not find metadata XML in zip file'})
+
+    def test_it_raises_if_operation_does_not_exist(self):
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'validate_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_country_group_zip()))
+
+        assert_equal(cm.exception.error_summary, {
+            'Upload':
+            "Event or country code 'product-type-testing' does not exist",
+        })
+
+
+class TestContentAddressedStorage(TestDatasetForEvent):
+    def setup(self):
+        super(TestContentAddressedStorage, self).setup()
+        self.blob_dir = tempfile.mkdtemp()
+        config['ckanext.mapactionimporter.content_addressed_storage'] = True
+        config['ckanext.mapactionimporter.blob_dir'] = self.blob_dir
+
+    def teardown(self):
+        config.pop('ckanext.mapactionimporter.content_addressed_storage')
+        config.pop('ckanext.mapactionimporter.blob_dir')
+        shutil.rmtree(self.blob_dir, ignore_errors=True)
+
+    def _import_versions(self):
+        return [
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(zip_file))
+            for zip_file in (get_test_zip(), get_update_zip())
+        ]
+
+    def _stats(self):
+        sysadmin = factories.Sysadmin()
+        return helpers.call_action('mapaction_blob_stats',
+                                   context={'user': sysadmin['name']})
+
+    def test_versions_share_unchanged_files(self):
+        v1, v2 = self._import_versions()
+
+        upload = uploader.ResourceUpload({'url': ''})
+        v1_paths = dict((r['name'], upload.get_path(r['id']))
+                        for r in v1['resources'])
+        v2_paths = dict((r['name'], upload.get_path(r['id']))
+                        for r in v2['resources'])
+        for name in v1_paths:
+            assert_true(os.path.samefile(v1_paths[name], v2_paths[name]))
+
+        stats = self._stats()
+        assert_equal(stats['blobs'], 2)
+        assert_equal(stats['references'], 4)
+        assert_equal(stats['saved_bytes'], 1177183 + 641641)
+
+    def test_blobs_freed_with_last_dataset(self):
+        v1, v2 = self._import_versions()
+
+        helpers.call_action('package_delete', id=v1['id'])
+        stats = self._stats()
+        assert_equal(stats['blobs'], 2)
+        assert_equal(stats['references'], 2)
+        assert_equal(stats['saved_bytes'], 0)
+
+        helpers.call_action('dataset_purge', id=v2['id'])
+        assert_equal(self._stats()['blobs'], 0)
+
+    def test_blob_freed_when_correction_replaces_file(self):
+        helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+        helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_correction_zip()))
+
+        stats = self._stats()
+        assert_equal(stats['blobs'], 2)
+        assert_equal(stats['stored_bytes'], 1464780 + 641641)
+
+    def test_only_sysadmins_see_blob_stats(self):
+        with assert_raises(toolkit.NotAuthorized):
+            helpers.call_action(
+                'mapaction_blob_stats',
+                context={'user': self.user['name'], 'ignore_auth': False})
+
+
+class _OtherStorageUpload(object):
+    def __init__(self, data_dict):
+        self.data_dict = data_dict
+
+
+class _OtherStoragePlugin(object):
+    '''Stands in for another storage plugin, e.g. ckanext-s3filestore.'''
+    def get_resource_uploader(self, data_dict):
+        return _OtherStorageUpload(data_dict)
+
+    def get_uploader(self, upload_to, old_filename=None):
+        return _OtherStorageUpload({'upload_to': upload_to})
+
+
+class TestOtherUploaderPlugin(TestCreateDatasetFromZip):
+    def _uploader_plugins(self, *uploader_plugins):
+        return mock.patch.object(plugins, 'PluginImplementations',
+                                 return_value=uploader_plugins)
+
+    def test_other_plugin_uploads_resources(self):
+        this_plugin = plugins.get_plugin('mapactionimporter')
+        other_plugin = _OtherStoragePlugin()
+
+        for order in ((this_plugin, other_plugin),
+                      (other_plugin, this_plugin)):
+            with self._uploader_plugins(*order):
+                upload = uploader.get_resource_uploader({'url': ''})
+            assert_true(isinstance(upload, _OtherStorageUpload))
+
+    def test_other_plugin_uploads_images(self):
+        with self._uploader_plugins(_OtherStoragePlugin(),
+                                    plugins.get_plugin('mapactionimporter')):
+            upload = uploader.get_uploader('group')
+
+        assert_true(isinstance(upload, _OtherStorageUpload))
+
+    def test_ckan_uploads_without_other_plugin(self):
+        with self._uploader_plugins(plugins.get_plugin('mapactionimporter')):
+            upload = uploader.get_resource_uploader({'url': ''})
+
+        assert_true(isinstance(upload, uploader.ResourceUpload))
+
+
+class TestCreateDatasetsFromZips(TestDatasetForEvent):
+    def _import_batch(self, *zips, **kwargs):
+        return helpers.call_action(
+            'create_datasets_from_mapaction_zips',
+            context={'user': self.user['name']},
+            upload=[_UploadFile(z) for z in zips],
+            **kwargs)
+
+    def test_it_imports_each_package(self):
+        results = self._import_batch(get_test_zip(), get_update_zip())
+
+        assert_equal([r['status'] for r in results], ['success', 'success'])
+        assert_equal([r['result']['name'] for r in results],
+                     ['189-ma001-v1', '189-ma001-v2'])
+        assert_equal(
+            sorted(helpers.call_action('package_list',
+                                       context={'user': self.user['name']})),
+            ['189-ma001', '189-ma001-v1', '189-ma001-v2'])
+
+    def test_it_continues_after_failure(self):
+        results = self._import_batch(
+            get_test_zip(), get_zip_no_metadata(), get_update_zip())
+
+        assert_equal([r['status'] for r in results],
+                     ['success', 'error', 'success'])
+        assert_equal(results[1]['error'],
+                     {'Upload': 'Could not find metadata XML in zip file'})
+
+    def test_it_stops_on_error_when_asked(self):
+        results = self._import_batch(
+            get_test_zip(), get_zip_no_metadata(), get_update_zip(),
+            stop_on_error=True)
+
+        assert_equal([r['status'] for r in results],
+                     ['success', 'error', 'skipped'])
+
+    def test_it_imports_staged_uploads(self):
+        store = staging.staging_store_from_config(config)
+        package = get_test_zip().read()
+        session = store.start(self.user['name'], size=len(package))
+        store.append(session['id'], 0, len(package) - 1,
+                     BytesIO(package))
+
+        results = helpers.call_action(
+            'create_datasets_from_mapaction_zips',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_update_zip()),
+            staged_upload=session['id'])
+
+        assert_equal([r['status'] for r in results], ['success', 'success'])
+        assert_equal(results[1]['staged_upload'], session['id'])
+        assert_equal(results[1]['result']['name'], '189-ma001-v1')
+
+    @helpers.change_config('ckanext.mapactionimporter.batch_workers', 4)
+    def test_versions_of_a_map_imported_in_order(self):
+        results = self._import_batch(
+            get_test_zip(), get_correction_zip(), get_update_zip())
+
+        assert_equal([r['status'] for r in results],
+                     ['success', 'success', 'success'])
+
+        dataset = helpers.call_action('package_show', id='189-ma001-v1')
+        assert_equal(dataset['notes'], 'Updated summary')
+
+    def test_it_raises_if_no_zip_files(self):
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'create_datasets_from_mapaction_zips',
+                context={'user': self.user['name']})
+
+        assert_equal(cm.exception.error_summary,
+                     {'Upload': 'You must select a file to be imported'})
+
+
 class TestCorrectExistingDataset(TestDatasetForEvent):
     def setup(self):
         super(TestCorrectExistingDataset, self).setup()
@@ -375,10 +1116,66 @@ class TestCorrectExistingDataset(TestDatasetForEvent):
                                    key=lambda k: k['format'])
         assert_equal(len(updated_resources), 2)
 
+        # Only the JPEG differs in the correction, the PDF is kept as it is
         assert_true(
             original_resources[0]['id'] != updated_resources[0]['id'])
+        assert_equal(original_resources[1]['id'], updated_resources[1]['id'])
+
+        assert_equal(updated_dataset['resource_changes'], {
+            'added': [],
+            'changed': ['MA001_Aptivate_Example-300dpi.jpeg'],
+            'removed': [],
+            'unchanged': ['MA001_Aptivate_Example-300dpi.pdf'],
+        })
+
+    def test_resources_record_size_and_hash(self):
+        resources = dict((r['name'], r) for r in self.dataset['resources'])
+        pdf = resources['MA001_Aptivate_Example-300dpi.pdf']
+
+        assert_equal(int(pdf['size']), 641641)
+        assert_equal(len(pdf['hash']), 64)
+
+    def test_streamed_resources_record_hash(self):
+        original = dict((r['name'], r) for r in self.dataset['resources'])
+
+        config['ckanext.mapactionimporter.stream_uploads'] = 'true'
+        try:
+            updated_dataset = helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_correction_zip()),
+                owner_org=self.organization['id'])
+        finally:
+            config.pop('ckanext.mapactionimporter.stream_uploads')
+
+        assert_equal(updated_dataset['resource_changes']['unchanged'],
+                     ['MA001_Aptivate_Example-300dpi.pdf'])
+
+        resources = dict((r['name'], r) for r in helpers.call_action(
+            'package_show', id=self.dataset['id'])['resources'])
+        jpeg = resources['MA001_Aptivate_Example-300dpi.jpeg']
+        assert_equal(len(jpeg['hash']), 64)
         assert_true(
-            original_resources[1]['id'] != updated_resources[1]['id'])
+            jpeg['hash'] !=
+            original['MA001_Aptivate_Example-300dpi.jpeg']['hash'])
+
+    def test_resources_without_hash_are_replaced(self):
+        # As for resources imported before hashes were recorded
+        for resource in self.dataset['resources']:
+            helpers.call_action('resource_patch', id=resource['id'],
+                                hash='')
+
+        updated_dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_correction_zip()),
+            owner_org=self.organization['id'])
+
+        assert_equal(
+            sorted(updated_dataset['resource_changes']['changed']),
+            ['MA001_Aptivate_Example-300dpi.jpeg',
+             'MA001_Aptivate_Example-300dpi.pdf'])
+        assert_equal(len(updated_dataset['resources']), 2)
 
     def test_nothing_changed_if_resource_update_fails(self):
         old_max_resource_size = uploader._max_resource_size
@@ -416,6 +1213,57 @@ class TestCorrectExistingDataset(TestDatasetForEvent):
         assert_equal(len(resources), 2)
         assert_equal(original_resources, resources)
 
+    def test_nothing_changed_if_updated_dataset_invalid(self):
+        plugin_validate = lib_plugins.plugin_validate
+
+        def validate(package_plugin, context, data_dict, schema, action):
+            data, errors = plugin_validate(
+                package_plugin, context, data_dict, schema, action)
+            if action == 'package_update':
+                errors['title'] = ['Missing value']
+            return data, errors
+
+        with mock.patch.object(lib_plugins, 'plugin_validate',
+                               side_effect=validate):
+            with assert_raises(toolkit.ValidationError) as cm:
+                helpers.call_action(
+                    'create_dataset_from_mapaction_zip',
+                    context={'user': self.user['name']},
+                    upload=_UploadFile(get_correction_zip()),
+                    owner_org=self.organization['id'])
+
+        assert_equal(cm.exception.error_dict, {'title': ['Missing value']})
+
+        dataset = helpers.call_action('package_show', id='189-ma001-v1')
+        assert_equal(
+            sorted(r['id'] for r in dataset['resources']),
+            sorted(r['id'] for r in self.dataset['resources']))
+
+    def test_nothing_changed_if_package_update_fails(self):
+        get_action = toolkit.get_action
+
+        def failing_package_update(context, data_dict):
+            raise toolkit.ValidationError({'title': ['Missing value']})
+
+        def get_failing_action(name):
+            if name == 'package_update':
+                return failing_package_update
+            return get_action(name)
+
+        with mock.patch.object(toolkit, 'get_action',
+                               side_effect=get_failing_action):
+            with assert_raises(toolkit.ValidationError):
+                helpers.call_action(
+                    'create_dataset_from_mapaction_zip',
+                    context={'user': self.user['name']},
+                    upload=_UploadFile(get_correction_zip()),
+                    owner_org=self.organization['id'])
+
+        dataset = helpers.call_action('package_show', id='189-ma001-v1')
+        assert_equal(
+            sorted(r['id'] for r in dataset['resources']),
+            sorted(r['id'] for r in self.dataset['resources']))
+
     def test_updated_dataset_public_if_original_public(self):
         self.dataset['private'] = False
 
@@ -440,7 +1288,7 @@ class TestCorrectExistingDataset(TestDatasetForEvent):
                 'create_dataset_from_mapaction_zip',
                 context={'user': self.user['name']},
                 upload=_UploadFile(
-                    get_test_zip()),
+                    get_resubmitted_zip(get_test_zip())),
                 owner_org=self.organization['id']
             )
 
@@ -451,6 +1299,45 @@ class TestCorrectExistingDataset(TestDatasetForEvent):
                 "Status is 'New' but dataset '189-ma001-v1' already exists"
             })
 
+    def test_corrected_dataset_not_duplicate_of_original(self):
+        helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_correction_zip()),
+            owner_org=self.organization['id'])
+
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_test_zip()),
+                owner_org=self.organization['id'])
+
+        assert_equal(
+            cm.exception.error_summary,
+            {
+                'Upload':
+                "Status is 'New' but dataset '189-ma001-v1' already exists"
+            })
+
+    def test_resubmitted_correction_returns_corrected_dataset(self):
+        corrected = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_correction_zip()),
+            owner_org=self.organization['id'])
+
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_correction_zip()),
+            owner_org=self.organization['id'])
+
+        assert_equal(dataset['id'], corrected['id'])
+        assert_equal(
+            sorted(r['id'] for r in dataset['resources']),
+            sorted(r['id'] for r in corrected['resources']))
+
 
 class TestCreateDatasetForNoEvent(TestCreateDatasetFromZip):
     def test_it_raises_if_event_does_not_exist(self):
@@ -464,6 +1351,63 @@ class TestCreateDatasetForNoEvent(TestCreateDatasetFromZip):
             "Event or country code '189' does not exist",
         })
 
+    def test_it_sees_event_created_after_failed_import(self):
+        user = factories.User()
+        with assert_raises(toolkit.ValidationError):
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                upload=_UploadFile(get_test_zip()))
+
+        factories.Group(name='189', user=user, type='event')
+
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': user['name']},
+            upload=_UploadFile(get_test_zip()))
+        assert_equal(dataset['name'], '189-ma001-v1')
+
+    def test_event_existence_is_cached(self):
+        factories.Group(name='189', type='event')
+
+        with mock.patch.object(model.Group, 'get',
+                               wraps=model.Group.get) as group_get:
+            for i in range(2):
+                with assert_raises(toolkit.ValidationError):
+                    helpers.call_action(
+                        'create_dataset_from_mapaction_zip',
+                        upload=_UploadFile(get_test_zip()),
+                        owner_org='does-not-exist')
+
+        operation_lookups = [c for c in group_get.call_args_list
+                             if c[0] == ('189',)]
+        assert_equal(len(operation_lookups), 1)
+
+    def test_missing_event_is_not_cached(self):
+        with mock.patch.object(model.Group, 'get',
+                               wraps=model.Group.get) as group_get:
+            for i in range(2):
+                with assert_raises(toolkit.ValidationError):
+                    helpers.call_action(
+                        'create_dataset_from_mapaction_zip',
+                        upload=_UploadFile(get_test_zip()))
+
+        operation_lookups = [c for c in group_get.call_args_list
+                             if c[0] == ('189',)]
+        assert_equal(len(operation_lookups), 2)
+
+    def test_it_raises_if_operation_is_an_organization(self):
+        factories.Organization(name='189')
+
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                upload=_UploadFile(get_test_zip()))
+
+        assert_equal(cm.exception.error_summary, {
+            'Upload':
+            "Event or country code '189' does not exist",
+        })
+
 
 class TestCreateDatasetForCountry(TestCreateDatasetFromZip):
     def setup(self):
@@ -517,7 +1461,7 @@ class TestCreateWithPackageTypeSchema(TestDatasetForEvent):
         self.mapdata.append(new_el)
 
     @mock.patch(
-        'ckanext.mapactionimporter.lib.mappackage.extract_zip',
+        'ckanext.mapactionimporter.lib.mappackage.read_metadata',
     )
     def test_created_with_package_type(self, mocked):
         self.append_mapdata('productType', 'test_schema')
@@ -530,6 +1474,39 @@ class TestCreateWithPackageTypeSchema(TestDatasetForEvent):
         assert_equal(dataset['type'], 'test_schema')
 
 
+class TestSchemaCache(TestDatasetForEvent):
+    def setup(self):
+        super(TestSchemaCache, self).setup()
+        create.clear_schema_cache()
+
+    def teardown(self):
+        create.clear_schema_cache()
+
+    def test_schema_built_once_per_package_type(self):
+        with mock.patch(
+                'ckan.lib.plugins.lookup_package_plugin',
+                wraps=lib_plugins.lookup_package_plugin) as lookup:
+            for i in range(2):
+                dataset_info = mappackage.to_dataset({}, get_test_zip())
+                create.transform_for_schema(
+                    {'model': model, 'session': model.Session,
+                     'user': self.user['name']},
+                    dataset_info)
+
+        assert_equal(lookup.call_count, 1)
+
+    def test_clear_schema_cache(self):
+        create.transform_for_schema(
+            {'model': model, 'session': model.Session,
+             'user': self.user['name']},
+            mappackage.to_dataset({}, get_test_zip()))
+        assert_true(create._schema_cache)
+
+        create.clear_schema_cache()
+
+        assert_false(create._schema_cache)
+
+
 class _UploadFile(object):
     '''Mock the parts from cgi.FileStorage we use.'''
     def __init__(self, fp):